@@ -23,11 +23,18 @@
 #
 
 import copy
+import gzip
+import multiprocessing
+import numpy
+import sys
+from xml import sax
 
 from pylal import SearchSummaryUtils
 from pylal.xlal.datatypes.ligotimegps import LIGOTimeGPS
 from glue.ligolw import ligolw
 from glue.ligolw import table
+from glue.ligolw import tokenizer
+from glue.ligolw import types as ligolwtypes
 from glue.ligolw import lsctables
 from glue.ligolw import utils
 from glue.ligolw.utils import ligolw_add
@@ -73,7 +80,52 @@ class SnglInspiralID_old(object):
     return lsctables.SnglInspiralID(a * 1000000000 + row.get_id_parts()[1] * 100000 + b)
 
 
-def ReadSnglInspiralFromFiles(fileList, verbose=False, filterFunc=None):
+def _ReadSnglInspiralFile(file, verbose=False, filterFunc=None):
+  """
+  Read the SnglInspiralTable from one file, applying filterFunc if it is
+  not None.  Returns None if the file has no sngl_inspiral table.
+  """
+  lsctables.use_in(ExtractSnglInspiralTableLIGOLWContentHandler)
+  xmldoc = utils.load_filename(file, verbose=verbose, contenthandler=ExtractSnglInspiralTableLIGOLWContentHandler)
+  try:
+    sngl_table = table.get_table(xmldoc, lsctables.SnglInspiralTable.tableName)
+    if filterFunc is not None:
+      iterutils.inplace_filter(filterFunc, sngl_table)
+  except ValueError: #some xml files have no sngl table, that's OK
+    sngl_table = None
+  if sngl_table:
+    sngl_table = list(sngl_table)
+  xmldoc.unlink()    #free memory
+  return sngl_table
+
+
+#
+# filterFunc is typically a lambda, which cannot be pickled, so it is handed
+# to each worker process by the pool initializer, whose arguments are
+# inherited when the workers fork rather than being pickled
+#
+
+_pool_filterFunc = None
+
+
+def _set_pool_filterFunc(filterFunc):
+  global _pool_filterFunc
+  _pool_filterFunc = filterFunc
+
+
+def _ReadSnglInspiralFileColumns(file):
+  """
+  Worker function for ReadSnglInspiralFromFiles().  Returns the number
+  of filtered triggers in file and a dictionary of their loaded
+  columns, which pickles far more compactly than the row objects.
+  """
+  sngls = _ReadSnglInspiralFile(file, filterFunc=_pool_filterFunc) or []
+  names = [_strip_column_name(name) for name in lsctables.SnglInspiralTable.loadcolumns or lsctables.SnglInspiralTable.validcolumns]
+  names = [name for name in names if sngls and hasattr(sngls[0], name)]
+  return len(sngls), dict((name, [getattr(row, name) for row in sngls]) for name in names)
+
+
+def ReadSnglInspiralFromFiles(fileList, verbose=False, filterFunc=None, nproc=1):
   """
   Read the SnglInspiralTables from a list of files.
   If filterFunc is not None, only keep triggers for which filterFunc
@@ -81,6 +133,9 @@ def ReadSnglInspiralFromFiles(fileList, verbose=False, filterFunc=None):
 
   @param fileList: list of input files
   @param verbose: print progress
+  @param nproc: number of worker processes used to parse the files.
+                filterFunc is applied in the workers, and the triggers
+                are returned in the same order as with nproc=1
   """
   # NOTE: this function no longer carries out event ID mangling (AKA
   # reassignment). Please adjust calling codes accordingly!
@@ -96,18 +151,25 @@ def ReadSnglInspiralFromFiles(fileList, verbose=False, filterFunc=None):
   sngls = lsctables.New(lsctables.SnglInspiralTable, \
       columns=lsctables.SnglInspiralTable.loadcolumns)
 
-  lsctables.use_in(ExtractSnglInspiralTableLIGOLWContentHandler)
+  if nproc > 1 and len(fileList) > 1:
+    pool = multiprocessing.Pool(min(nproc, len(fileList)), initializer = _set_pool_filterFunc, initargs = (filterFunc,))
+    try:
+      for i, (n, columns) in enumerate(pool.imap(_ReadSnglInspiralFileColumns, fileList)):
+        if verbose: print str(i+1)+"/"+str(len(fileList))+": "
+        for j in xrange(n):
+          row = sngls.RowType()
+          for name, values in columns.items():
+            setattr(row, name, values[j])
+          sngls.append(row)
+    finally:
+      pool.terminate()
+      pool.join()
+    return sngls
+
   for i,file in enumerate(fileList):
     if verbose: print str(i+1)+"/"+str(len(fileList))+": "
-    xmldoc = utils.load_filename(file, verbose=verbose, contenthandler=ExtractSnglInspiralTableLIGOLWContentHandler)
-    try:
-      sngl_table = table.get_table(xmldoc, lsctables.SnglInspiralTable.tableName)
-      if filterFunc is not None:
-        iterutils.inplace_filter(filterFunc, sngl_table)
-    except ValueError: #some xml files have no sngl table, that's OK
-      sngl_table = None
+    sngl_table = _ReadSnglInspiralFile(file, verbose=verbose, filterFunc=filterFunc)
     if sngl_table: sngls.extend(sngl_table)
-    xmldoc.unlink()    #free memory
 
   return sngls
 
@@ -195,6 +257,356 @@ def ReadSnglInspiralsForPipelineStage(xmldoc, slideDict, stage):
     return sngls_tbl
 
 
+#
+# =============================================================================
+#
+#                                Columnar Input
+#
+# =============================================================================
+#
+
+#
+# the row-object reader above builds a full glue row for every trigger, which
+# dominates both the run time and the memory footprint of jobs that read
+# millions of triggers but only ever look at a handful of columns.  the code
+# below parses the sngl_inspiral Stream directly into numpy arrays, loading
+# only the requested columns and applying time and SNR cuts as the document
+# is parsed.
+#
+
+
+def _strip_table_name(name):
+  """
+  Return the bare table name from a LIGO Light Weight Table Name
+  attribute, e.g. "sngl_inspiral" from "process:sngl_inspiral:table".
+  """
+  name = name.lower()
+  if name.endswith(":table"):
+    name = name[:-len(":table")]
+  return name.split(":")[-1]
+
+
+def _strip_column_name(name):
+  """
+  Return the bare column name from a LIGO Light Weight Column Name
+  attribute, e.g. "snr" from "sngl_inspiral:snr".  The case is kept,
+  as column names like "Gamma0" are not all lower case.
+  """
+  return str(name.split(":")[-1])
+
+
+class SnglInspiralRowView(object):
+  """
+  Light-weight, read-only view of one row of a SnglInspiralColumns
+  object.  Column values are retrieved as attributes, as for a
+  lsctables.SnglInspiral row object, but nothing is copied.
+  """
+  __slots__ = ("_columns", "_index")
+
+  def __init__(self, columns, index):
+    self._columns = columns
+    self._index = index
+
+  def __getattr__(self, name):
+    try:
+      return self._columns[name][self._index]
+    except KeyError:
+      raise AttributeError(name)
+
+  def get_end(self):
+    return LIGOTimeGPS(int(self.end_time), int(self.end_time_ns))
+
+  def __repr__(self):
+    return "<SnglInspiralRowView %d>" % self._index
+
+
+class SnglInspiralColumns(object):
+  """
+  Column-oriented container of sngl_inspiral triggers.  The columns
+  attribute is a dictionary mapping column name to a numpy array, all
+  arrays having the same length.  Numeric columns are stored with the
+  numpy type corresponding to their LIGO Light Weight type, other
+  columns (ifo, search, event_id, ...) are stored as object arrays.
+
+  Row objects are not constructed unless asked for:  row(i) and
+  iteration return SnglInspiralRowView objects, and to_table() builds
+  a full lsctables.SnglInspiralTable for code that needs one.
+
+  Example:
+
+  >>> import numpy
+  >>> triggers = SnglInspiralColumns({"snr": numpy.array([5.5, 8.0]), "end_time": numpy.array([100, 101], dtype = "int32"), "end_time_ns": numpy.array([0, 500000000], dtype = "int32")})
+  >>> len(triggers)
+  2
+  >>> triggers.get_end().tolist()
+  [100.0, 101.5]
+  >>> triggers.row(1).snr
+  8.0
+  >>> len(triggers.select(triggers["snr"] > 6.))
+  1
+  """
+  def __init__(self, columns = None):
+    self.columns = dict(columns or {})
+    lengths = set(len(column) for column in self.columns.values())
+    if len(lengths) > 1:
+      raise ValueError("columns have different lengths")
+
+  def __len__(self):
+    for column in self.columns.values():
+      return len(column)
+    return 0
+
+  def __getitem__(self, name):
+    return self.columns[name]
+
+  def __contains__(self, name):
+    return name in self.columns
+
+  def keys(self):
+    return self.columns.keys()
+
+  def row(self, i):
+    """
+    Return a SnglInspiralRowView of the i-th trigger.
+    """
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    return SnglInspiralRowView(self.columns, i)
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield SnglInspiralRowView(self.columns, i)
+
+  def get_end(self):
+    """
+    Return the trigger end times as an array of floats.
+    """
+    return self.columns["end_time"] + 1e-9 * self.columns["end_time_ns"]
+
+  def get_end_ns(self):
+    """
+    Return the trigger end times as an array of integer nanoseconds.
+    """
+    return self.columns["end_time"].astype("int64") * 1000000000 + self.columns["end_time_ns"]
+
+  def select(self, keep):
+    """
+    Return a new SnglInspiralColumns containing the triggers selected
+    by keep, which can be a boolean mask or an array of indexes.
+    """
+    return SnglInspiralColumns((name, column[keep]) for name, column in self.columns.items())
+
+  def sort(self, order = None):
+    """
+    Return a new SnglInspiralColumns with the triggers ordered by
+    order, an array of indexes.  The default is to sort by end time.
+    """
+    if order is None:
+      order = numpy.argsort(self.get_end_ns(), kind = "mergesort")
+    return self.select(order)
+
+  @classmethod
+  def concatenate(cls, seq):
+    """
+    Join a sequence of SnglInspiralColumns objects into one.  Only
+    the columns common to all of them are retained.
+    """
+    seq = [triggers for triggers in seq if triggers.columns]
+    if not seq:
+      return cls()
+    names = reduce(lambda a, b: a & b, (set(triggers.keys()) for triggers in seq))
+    return cls((name, numpy.concatenate([triggers[name] for triggers in seq])) for name in names)
+
+  def to_table(self):
+    """
+    Build and return a lsctables.SnglInspiralTable containing the
+    triggers.  Only the loaded columns are populated.
+    """
+    names = [name for name in lsctables.SnglInspiralTable.validcolumns if _strip_column_name(name) in self.columns]
+    sngls = lsctables.New(lsctables.SnglInspiralTable, columns = names)
+    names = [_strip_column_name(name) for name in names]
+    columns = [self.columns[name].tolist() for name in names]
+    for values in zip(*columns):
+      row = sngls.RowType()
+      for name, value in zip(names, values):
+        setattr(row, name, value)
+      sngls.append(row)
+    return sngls
+
+
+class _SnglInspiralColumnHandler(sax.handler.ContentHandler):
+  """
+  SAX content handler that tokenizes the Stream of any sngl_inspiral
+  tables in a document into numpy arrays.  Rows are decoded in blocks
+  so that the time and SNR cuts are applied while parsing, and rows
+  that fail them are never accumulated.
+  """
+  blocksize = 65536
+
+  def __init__(self, columns = None, segment = None, snr_threshold = None):
+    sax.handler.ContentHandler.__init__(self)
+    self.columns = columns and set(columns)
+    self.segment = segment
+    self.snr_threshold = snr_threshold
+    self.blocks = []
+    self.in_table = False
+    self.tokenizer = None
+
+  def startElement(self, name, attrs):
+    if name == u"Table":
+      self.in_table = _strip_table_name(attrs.get(u"Name", u"")) == _strip_table_name(lsctables.SnglInspiralTable.tableName)
+      self.table_columns = []
+    elif name == u"Column" and self.in_table:
+      self.table_columns.append((_strip_column_name(attrs[u"Name"]), attrs[u"Type"]))
+    elif name == u"Stream" and self.in_table:
+      # columns needed by the cuts are loaded even if they were
+      # not asked for, and are dropped again in finish()
+      wanted = set(name for name, coltype in self.table_columns) if self.columns is None else set(self.columns)
+      if self.segment is not None:
+        wanted |= set(("end_time", "end_time_ns"))
+      if self.snr_threshold is not None:
+        wanted.add("snr")
+      self.names = [name for name, coltype in self.table_columns if name in wanted]
+      self.dtypes = [ligolwtypes.ToNumPyType.get(coltype, object) for name, coltype in self.table_columns if name in wanted]
+      self.delimiter = attrs.get(u"Delimiter", u",")
+      self.tokenizer = tokenizer.Tokenizer(self.delimiter)
+      self.tokenizer.set_types([(ligolwtypes.ToPyType[coltype] if name in wanted else None) for name, coltype in self.table_columns])
+      self.tokens = []
+
+  def characters(self, content):
+    if self.tokenizer is not None:
+      self.tokens.extend(self.tokenizer.append(content))
+      if len(self.tokens) >= self.blocksize * max(len(self.names), 1):
+        self._flush()
+
+  def endElement(self, name):
+    if name == u"Stream" and self.tokenizer is not None:
+      if not self.tokenizer.data.isspace():
+        self.characters(self.delimiter)
+      self._flush()
+      self.tokenizer = None
+    elif name == u"Table":
+      self.in_table = False
+
+  def _flush(self):
+    if not self.names:
+      self.tokens = []
+      return
+    n = len(self.tokens) // len(self.names)
+    tokens, self.tokens = self.tokens[:n * len(self.names)], self.tokens[n * len(self.names):]
+    if not n:
+      return
+    block = dict((name, numpy.array(tokens[i::len(self.names)], dtype = dtype)) for i, (name, dtype) in enumerate(zip(self.names, self.dtypes)))
+    keep = numpy.ones(n, dtype = bool)
+    if self.segment is not None:
+      end_ns = block["end_time"].astype("int64") * 1000000000 + block["end_time_ns"]
+      lo, hi = self.segment
+      if lo is not None:
+        keep &= end_ns >= LIGOTimeGPS(lo).ns()
+      if hi is not None:
+        keep &= end_ns < LIGOTimeGPS(hi).ns()
+    if self.snr_threshold is not None:
+      keep &= block["snr"] >= self.snr_threshold
+    if not keep.all():
+      block = dict((name, column[keep]) for name, column in block.items())
+    self.blocks.append(block)
+
+  def finish(self):
+    """
+    Return the accumulated triggers as a SnglInspiralColumns object.
+    """
+    names = [name for name in (self.blocks[0] if self.blocks else ()) if self.columns is None or name in self.columns]
+    triggers = SnglInspiralColumns((name, numpy.concatenate([block[name] for block in self.blocks])) for name in names)
+    self.blocks = []
+    return triggers
+
+
+def _open_xml(filename):
+  """
+  Open filename for reading, decompressing it on the fly if it is
+  gzip compressed.
+  """
+  fileobj = open(filename, "rb")
+  magic = fileobj.read(2)
+  fileobj.seek(0)
+  if magic == "\x1f\x8b":
+    fileobj = gzip.GzipFile(mode = "rb", fileobj = fileobj)
+  return fileobj
+
+
+def ReadSnglInspiralColumnsFromFile(filename, columns = None, segment = None, snr_threshold = None):
+  """
+  Read the sngl_inspiral triggers from a single LIGO Light Weight XML
+  file into a SnglInspiralColumns object.  See
+  ReadSnglInspiralColumnsFromFiles() for the meaning of the
+  arguments.
+  """
+  handler = _SnglInspiralColumnHandler(columns = columns, segment = segment, snr_threshold = snr_threshold)
+  parser = sax.make_parser()
+  parser.setFeature(sax.handler.feature_namespaces, False)
+  parser.setFeature(sax.handler.feature_external_ges, False)
+  parser.setContentHandler(handler)
+  fileobj = _open_xml(filename)
+  try:
+    parser.parse(fileobj)
+  finally:
+    fileobj.close()
+  return handler.finish()
+
+
+def _ReadSnglInspiralColumnsFromFile(args):
+  """
+  Worker function for ReadSnglInspiralColumnsFromFiles().
+  """
+  filename, columns, segment, snr_threshold = args
+  return ReadSnglInspiralColumnsFromFile(filename, columns = columns, segment = segment, snr_threshold = snr_threshold)
+
+
+def ReadSnglInspiralColumnsFromFiles(fileList, columns = None, segment = None, snr_threshold = None, verbose = False, nproc = 1):
+  """
+  Read the sngl_inspiral triggers from a list of files into a single
+  SnglInspiralColumns object, without constructing row objects.
+
+  @param fileList: list of input files
+  @param columns: iterable of the names of the columns to load, or
+                  None (the default) to load all of them
+  @param segment: (start, stop) GPS times;  if not None only triggers
+                  with start <= end time < stop are kept.  Either end
+                  can be None to leave it unbounded
+  @param snr_threshold: if not None only triggers with snr >= this
+                        are kept
+  @param verbose: print progress
+  @param nproc: number of worker processes used to parse the files.
+                The cuts are applied in the workers so only the
+                surviving triggers are sent back;  the files are merged
+                in the order given
+
+  Files that contain no sngl_inspiral table contribute no triggers.
+  Example:
+
+  >>> triggers = ReadSnglInspiralColumnsFromFiles(files, columns = ("ifo", "end_time", "end_time_ns", "snr", "chisq"), snr_threshold = 6.0)
+  >>> triggers["snr"].max()
+  """
+  if nproc > 1 and len(fileList) > 1:
+    pool = multiprocessing.Pool(min(nproc, len(fileList)))
+    results = pool.imap(_ReadSnglInspiralColumnsFromFile, [(filename, columns, segment, snr_threshold) for filename in fileList])
+  else:
+    pool = None
+    results = (ReadSnglInspiralColumnsFromFile(filename, columns = columns, segment = segment, snr_threshold = snr_threshold) for filename in fileList)
+  try:
+    triggers = []
+    for i, (filename, result) in enumerate(zip(fileList, results)):
+      if verbose: print >>sys.stderr, str(i+1)+"/"+str(len(fileList))+": "+filename
+      triggers.append(result)
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+  return SnglInspiralColumns.concatenate(triggers)
+
+
 #
 # =============================================================================
 #
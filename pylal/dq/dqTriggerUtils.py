@@ -5,10 +5,12 @@
 # =============================================================================
 
 from __future__ import division
-import sys,os,re,math,datetime,glob,copy
+import sys,os,re,math,datetime,glob,copy,time,hashlib,json
+import multiprocessing
 from socket import getfqdn
 
 from glue.ligolw import ligolw,table,lsctables,utils
+from glue.ligolw import types as ligolwtypes
 from glue.ligolw.utils import process as ligolw_process
 from glue import segments
 
@@ -566,10 +568,273 @@ def totrigfile(file,table,etg,header=True,columns=None):
 
     file.write('%s\n' % d.join(line))
 
+# =============================================================================
+# On-disk trigger cache
+# =============================================================================
+
+class TriggerCache(object):
+
+  """
+    Persistent, size-limited store of parsed trigger tables.
+
+    Each entry holds the triggers returned by one of the from*file readers
+    for one file, as a numpy structured array saved in .npy format, so
+    re-reading it is a single (memory-mappable) load rather than a full
+    parse.  Entries are keyed on the source path, its size and mtime, the
+    reader and all of its other arguments (ETG, columns, time window,
+    ...), so a file that changes on disk is simply re-parsed.  When the
+    total size of the entries exceeds maxsize bytes the least recently
+    used are removed.
+
+    There is no shared index:  each entry's table metadata is kept in a
+    small JSON file beside it, and its last use is the modification time
+    of its .npy file, so several processes can use one cache directory
+    without locking, and a hit only touches its own entry.
+
+    Arguments:
+
+      directory : str
+        path of the cache directory, created if needed
+
+    Keyword arguments:
+
+      maxsize : int
+        size budget for the cache in bytes
+  """
+
+  def __init__(self, directory, maxsize=2**30):
+    self.directory = os.path.abspath(os.path.expanduser(directory))
+    self.maxsize = maxsize
+    if not os.path.isdir(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError:
+        # another process may have created it
+        if not os.path.isdir(self.directory):
+          raise
+
+  def _path(self, key, ext):
+    return os.path.join(self.directory, key + ext)
+
+  def _write(self, path, write):
+    # write then rename so concurrent readers never see a partial file
+    tmp = '%s.%d' % (path, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+      write(f)
+    finally:
+      f.close()
+    os.rename(tmp, path)
+
+  def key(self, path, reader, args):
+    """
+      Return the cache key for the file at path read by reader with
+      the given (repr-able) arguments, or None if path is not a
+      regular file.
+    """
+    try:
+      stat = os.stat(path)
+    except (OSError, TypeError):
+      return None
+    h = hashlib.sha1(repr((os.path.abspath(path), stat.st_size,\
+                           stat.st_mtime, reader, args)))
+    return h.hexdigest()
+
+  def get(self, key):
+    """
+      Return the table stored under key, or None.
+    """
+    try:
+      f = open(self._path(key, '.json'))
+      try:
+        entry = json.load(f)
+      finally:
+        f.close()
+      data = numpy.load(self._path(key, '.npy'), mmap_mode='r')
+      # an entry for a table this version of lsctables does not know is
+      # a miss
+      out = lsctables.New(lsctables.TableByName[entry['table']],\
+                          columns=entry['columns'])
+    except (IOError, ValueError, KeyError):
+      return None
+
+    names = [str(c) for c in data.dtype.names or ()]
+    cols = []
+    for c in names:
+      coltype = entry['types'][c]
+      if coltype in ligolwtypes.IDTypes:
+        cols.append(map(ligolwtypes.ToPyType[coltype], data[c].tolist()))
+      else:
+        cols.append(data[c].tolist())
+    RowType = out.RowType
+    append = out.append
+    for vals in zip(*cols):
+      t = RowType()
+      for c,v in zip(names, vals):
+        setattr(t, c, v)
+      append(t)
+
+    # mark as recently used
+    try:
+      os.utime(self._path(key, '.npy'), None)
+    except OSError:
+      pass
+    return out
+
+  def put(self, key, table):
+    """
+      Store table under key.  Tables that cannot be represented as a
+      plain structured array (e.g. with null values) are not cached.
+    """
+    tablename = re.sub(':table\Z', '', table.tableName).split(':')[-1]
+    columns = [c.split(':')[-1] for c in table.columnnames]
+    # the readers can set attributes beyond the table's columns, so store
+    # everything that is set on the rows
+    if len(table):
+      names = [c for c in getattr(table.RowType, '__slots__', columns)\
+               if hasattr(table[0], c)]
+    else:
+      names = columns
+    arrays = []
+    types = {}
+    for c in names:
+      vals = [getattr(t, c, None) for t in table]
+      coltype = table.validcolumns.get(c, table.validcolumns.get(\
+                    '%s:%s' % (tablename, c)))
+      if coltype in ligolwtypes.IDTypes:
+        vals = map(str, vals)
+      if len(table):
+        arr = numpy.array(vals)
+      elif coltype in ligolwtypes.ToNumPyType:
+        arr = numpy.array([], dtype=ligolwtypes.ToNumPyType[coltype])
+      else:
+        arr = numpy.array([], dtype='S1')
+      if arr.dtype.kind == 'O':
+        return
+      arrays.append(arr)
+      types[c] = coltype
+    data = numpy.rec.fromarrays(arrays, names=names) if arrays\
+           else numpy.zeros(0)
+
+    # the metadata goes first, so an entry's .npy file never exists
+    # without it except while the entry is being removed
+    entry = {'table': tablename, 'columns': columns, 'types': types}
+    self._write(self._path(key, '.json'), lambda f: json.dump(entry, f))
+    self._write(self._path(key, '.npy'), lambda f: numpy.save(f, data))
+    self._evict()
+
+  def _entries(self):
+    # map each key to the (mtime, size) of its .npy file, and return it
+    # with the list of metadata files found
+    entries = {}
+    metadata = []
+    for name in os.listdir(self.directory):
+      key, ext = os.path.splitext(name)
+      if ext == '.json':
+        metadata.append(key)
+      elif ext == '.npy':
+        try:
+          stat = os.stat(os.path.join(self.directory, name))
+        except OSError:
+          continue
+        entries[key] = (stat.st_mtime, stat.st_size)
+    return entries, metadata
+
+  def _remove(self, key):
+    # data first, see put()
+    for ext in ('.npy', '.json'):
+      try:
+        os.remove(self._path(key, ext))
+      except OSError:
+        pass
+
+  def _evict(self):
+    # remove least recently used entries until within budget.  a .npy
+    # file without metadata (left by an interrupted removal) cannot be
+    # read, so it is removed, as is a metadata file whose data has been
+    # gone for a while
+    entries, metadata = self._entries()
+    now = time.time()
+    for key in metadata:
+      if key not in entries:
+        try:
+          if now - os.path.getmtime(self._path(key, '.json')) > 3600:
+            self._remove(key)
+        except OSError:
+          pass
+    metadata = set(metadata)
+    for key in [key for key in entries if key not in metadata]:
+      self._remove(key)
+      del entries[key]
+    total = sum(size for mtime, size in entries.values())
+    for key in sorted(entries, key=lambda k: entries[k][0]):
+      if total <= self.maxsize:
+        break
+      total -= entries[key][1]
+      self._remove(key)
+
+  def clear(self):
+    """
+      Remove all entries from the cache.
+    """
+    entries, metadata = self._entries()
+    for key in set(entries) | set(metadata):
+      self._remove(key)
+
+# the cache used by the from*file readers.  set it with set_trigger_cache(),
+# or by pointing the PYLAL_TRIGGER_CACHE environment variable at a directory
+# (with PYLAL_TRIGGER_CACHE_SIZE giving the budget in bytes)
+_trigger_cache = None
+if os.environ.get('PYLAL_TRIGGER_CACHE'):
+  _trigger_cache = TriggerCache(os.environ['PYLAL_TRIGGER_CACHE'],\
+                      int(os.environ.get('PYLAL_TRIGGER_CACHE_SIZE', 2**30)))
+
+def set_trigger_cache(directory, maxsize=2**30):
+
+  """
+    Enable the on-disk trigger cache for all from*file readers, storing
+    entries in directory up to maxsize bytes.  Pass directory=None to
+    disable it.
+  """
+
+  global _trigger_cache
+  if directory is None:
+    _trigger_cache = None
+  else:
+    _trigger_cache = TriggerCache(directory, maxsize=maxsize)
+  return _trigger_cache
+
+def _cached_reader(func):
+
+  """
+    Decorator making a from*file reader consult the trigger cache.  The
+    first argument of the reader must be a file path or a file object
+    with a name attribute.
+  """
+
+  def reader(fname, *args, **kwargs):
+    cache = _trigger_cache
+    if cache is None:
+      return func(fname, *args, **kwargs)
+    path = getattr(fname, 'name', fname)
+    key = cache.key(path, func.__name__, (args, sorted(kwargs.items())))
+    if key is None:
+      return func(fname, *args, **kwargs)
+    out = cache.get(key)
+    if out is None:
+      out = func(fname, *args, **kwargs)
+      cache.put(key, out)
+    return out
+
+  reader.__name__ = func.__name__
+  reader.__doc__ = func.__doc__
+  return reader
+
 # =============================================================================
 # Function to load triggers from xml
 # =============================================================================
 
+@_cached_reader
 def fromtrigxml(file,tablename='sngl_inspiral:table',start=None,end=None,\
                 columns=None):
 
@@ -691,12 +956,67 @@ def fromtrigfile(file,etg,start=None,end=None,ifo=None,channel=None,\
 # Load triggers from a cache
 # =============================================================================
 
+def _fromLALCache_file(path, etg, tablename, start, end, columns, virgo, snr):
+
+  """
+    Read the triggers from a single cache entry path, keeping only those
+    above the SNR threshold if one is given.  This is the unit of work of
+    fromLALCache, and is run in the worker processes when nproc > 1.
+  """
+
+  if re.search('(xml|xml.gz)\Z', path):
+    trigs = fromtrigxml(open(path), tablename=tablename,\
+                        start=start, end=end, columns=columns)
+  else:
+    trigs = fromtrigfile(open(path), etg=etg, start=start, end=end,\
+                         columns=columns, virgo=virgo)
+
+  # keep only triggers above SNR threshold if requested
+  if snr:
+    return [t for t in trigs if t.snr > snr]
+  return list(trigs)
+
+# the arguments shared by all files, set in each worker process by the pool
+# initializer so that only the path is sent with each task
+_pool_args = None
+
+def _fromLALCache_init(*args):
+  global _pool_args
+  _pool_args = args
+
+def _fromLALCache_columns(path):
+
+  """
+    Worker wrapper around _fromLALCache_file that returns the filtered
+    triggers as a dict of columns rather than row objects, to keep the
+    amount of data pickled back to the parent process small.
+  """
+
+  trigs = _fromLALCache_file(path, *_pool_args)
+  columns = dict()
+  if trigs:
+    for c in trigs[0].__slots__:
+      if not hasattr(trigs[0], c):
+        continue
+      vals = [getattr(t, c, None) for t in trigs]
+      arr = numpy.array(vals)
+      if arr.dtype.kind not in 'biuf':
+        arr = numpy.empty(len(vals), dtype=object)
+        arr[:] = vals
+      columns[c] = arr
+  return len(trigs), columns
+
 def fromLALCache(cache, etg, start=None, end=None, columns=None,\
-                 virgo=False, verbose=False, snr=False):
+                 virgo=False, verbose=False, snr=False, nproc=1):
 
   """
     Extract triggers froa given ETG from all files in a glue.lal.Cache object.
     Returns a glue.ligolw.Table relevant to the given trigger generator etg.
+
+    If nproc is greater than 1 the files are read by a pool of that many
+    worker processes.  The time and SNR cuts are applied in the workers and
+    only the surviving triggers are sent back, column by column.  Files are
+    merged in cache order, so the result is the same as for nproc=1.
   """
 
   # set up counter
@@ -710,24 +1030,43 @@ def fromLALCache(cache, etg, start=None, end=None, columns=None,\
   trigs = SnglTriggerTable(etg, columns=columns)
 
   # load files
-  for i,e in enumerate(cache):
-    if re.search('(xml|xml.gz)\Z', e.path):
-      trigsTmp = fromtrigxml(open(e.path), tablename=trigs.tableName,\
-                               start=start, end=end, columns=columns)
-    else:
-      trigsTmp = fromtrigfile(open(e.path), etg=etg, start=start, end=end,\
-                                columns=columns, virgo=virgo)
-    # keep only triggers above SNR threshold if requested
-    if snr:
-      trigs.extend(t for t in trigsTmp if t.snr > snr)
-    else:
+  paths = [e.path for e in cache]
+  args = (etg, trigs.tableName, start, end, columns, virgo, snr)
+  if nproc > 1 and len(paths) > 1:
+    pool = multiprocessing.Pool(min(nproc, len(paths)),\
+                                initializer=_fromLALCache_init,\
+                                initargs=args)
+    results = pool.imap(_fromLALCache_columns, paths)
+  else:
+    pool = None
+    results = (_fromLALCache_file(p, *args) for p in paths)
+
+  try:
+    for i,trigsTmp in enumerate(results):
+      if pool is not None:
+        # rebuild row objects from the columns sent back by the worker
+        n, cols = trigsTmp
+        cols = dict((c, v.tolist()) for c,v in cols.items())
+        RowType = trigs.RowType
+        trigsTmp = []
+        for j in xrange(n):
+          t = RowType()
+          for c,v in cols.items():
+            setattr(t, c, v[j])
+          trigsTmp.append(t)
       trigs.extend(trigsTmp)
 
-    # print verbose message
-    if verbose and len(cache)>1:
-      progress = int((i+1)/num)
-      sys.stdout.write('%s%.2d%%' % (delete, progress))
-      sys.stdout.flush()
+      # print verbose message
+      if verbose and len(cache)>1:
+        progress = int((i+1)/num)
+        sys.stdout.write('%s%.2d%%' % (delete, progress))
+        sys.stdout.flush()
+  finally:
+    # all results have been collected, or reading failed and the remaining
+    # work is abandoned
+    if pool is not None:
+      pool.terminate()
+      pool.join()
 
   if verbose: sys.stdout.write("\n")  
   return trigs
@@ -1566,6 +1905,7 @@ def vetoed(self, seglist):
 # read triggers from file
 # =============================================================================
 
+@_cached_reader
 def fromomegafile(fname, start=None, end=None, ifo=None, channel=None,\
                   columns=None, virgo=False):
 
@@ -1721,6 +2061,7 @@ def fromomegafile(fname, start=None, end=None, ifo=None, channel=None,\
   
   return out
 
+@_cached_reader
 def fromkwfile(fname, start=None, end=None, ifo=None, channel=None,\
                columns=None):
 
@@ -1857,6 +2198,7 @@ def fromkwfile(fname, start=None, end=None, ifo=None, channel=None,\
   
   return out
 
+@_cached_reader
 def fromomegaspectrumfile(fname, start=None, end=None, ifo=None, channel=None,\
                           columns=None):
 
@@ -1957,6 +2299,7 @@ def fromomegaspectrumfile(fname, start=None, end=None, ifo=None, channel=None,\
   
   return out
 
+@_cached_reader
 def fromomegadqfile(fname, start=None, end=None, ifo=None, channel=None,\
                     columns=None):
 
@@ -2089,6 +2432,7 @@ def fromomegadqfile(fname, start=None, end=None, ifo=None, channel=None,\
   
   return out
 
+@_cached_reader
 def fromhacrfile(fname, start=None, end=None, ifo=None, channel=None,\
                  columns=None):
 
@@ -2242,6 +2586,7 @@ def fromhacrfile(fname, start=None, end=None, ifo=None, channel=None,\
   
   return out
 
+@_cached_reader
 def fromihopefile(fname, start=None, end=None, ifo=None, channel=None,\
                   columns=None):
 
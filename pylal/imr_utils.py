@@ -15,6 +15,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import sys
+import os
+import hashlib
+import itertools
+import multiprocessing
+import tempfile
+import cPickle as pickle
 from glue.ligolw import lsctables
 from glue.ligolw import dbtables
 from glue import segments
@@ -59,31 +65,79 @@ def time_within_segments(geocent_end_time, geocent_end_time_ns, zero_lag_segment
 		return lsctables.LIGOTimeGPS(geocent_end_time, geocent_end_time_ns) in zero_lag_segments
 
 
-def get_min_far_inspiral_injections(connection, segments = None, table_name = "coinc_inspiral"):
-	"""
-	This function returns the found injections from a database and the
-	minimum far associated with them as tuple of the form (far, sim). It also tells
-	you all of the injections that should have been injected.  Subtracting the two
-	outputs	should tell you the missed injections
-	"""
-
-	if table_name == dbtables.lsctables.CoincInspiralTable.tableName:
-		found_query = 'SELECT sim_inspiral.*, coinc_inspiral.combined_far FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_inspiral ON coinc_inspiral.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_inspiral.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event" AND injection_in_segments(sim_inspiral.geocent_end_time, sim_inspiral.geocent_end_time_ns)'
-
-	elif table_name == dbtables.lsctables.CoincRingdownTable.tableName:
-		found_query = 'SELECT sim_inspiral.*, coinc_ringdown.false_alarm_rate FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_ringdown ON coinc_ringdown.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_ringdown.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event" AND injection_in_segments(sim_inspiral.geocent_end_time, sim_inspiral.geocent_end_time_ns)'
-
-	elif table_name == dbtables.lsctables.MultiBurstTable.tableName:
-		found_query = 'SELECT sim_inspiral.*, multi_burst.false_alarm_rate FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN multi_burst ON multi_burst.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == multi_burst.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event" AND injection_in_segments(sim_inspiral.geocent_end_time, sim_inspiral.geocent_end_time_ns)'
-
-	else:
-		raise ValueError("table must be in " + " ".join(allowed_analysis_table_names()))
-
-	def injection_was_made(end_time, end_time_ns, segments = segments):
-		return time_within_segments(end_time, end_time_ns, segments)
-
-	# restrict the found injections to only be within certain segments
-	connection.create_function("injection_in_segments", 2, injection_was_made)
+def segments_to_boundaries(seglist):
+	"""
+	Return the start and end times of the coalesced segments in seglist
+	as two sorted arrays of integer nanoseconds, for use with
+	times_within_segments().  Infinite boundaries are clipped to the
+	range of the integers.  If seglist is None return None.
+	"""
+	if seglist is None:
+		return None
+	def to_ns(t):
+		if t == segments.PosInfinity:
+			return numpy.iinfo(numpy.int64).max
+		if t == segments.NegInfinity:
+			return numpy.iinfo(numpy.int64).min
+		return lsctables.LIGOTimeGPS(t).ns()
+	seglist = segments.segmentlist(seglist).coalesce()
+	return numpy.array([to_ns(seg[0]) for seg in seglist], dtype = numpy.int64), numpy.array([to_ns(seg[1]) for seg in seglist], dtype = numpy.int64)
+
+
+def times_within_segments(end_times, end_times_ns, boundaries = None):
+	"""
+	Array version of time_within_segments():  return a boolean array
+	telling which of the times given by the arrays end_times and
+	end_times_ns lie in the segments whose boundaries were computed by
+	segments_to_boundaries().  If boundaries is None all are True.
+	"""
+	times = numpy.asarray(end_times, dtype = numpy.int64) * 1000000000 + numpy.asarray(end_times_ns, dtype = numpy.int64)
+	if boundaries is None:
+		return numpy.ones(len(times), dtype = bool)
+	starts, ends = boundaries
+	if not len(starts):
+		return numpy.zeros(len(times), dtype = bool)
+	# index of the last segment starting at or before each time
+	idx = starts.searchsorted(times, side = "right") - 1
+	return (idx >= 0) & (times < ends[numpy.maximum(idx, 0)])
+
+
+def get_sim_inspiral_columns(connection, segments = None):
+	"""
+	Return the names of the columns in the sim_inspiral table and a
+	dictionary mapping each name to an array of that column's values.
+	Only injections made within the given segmentlist are kept (all of
+	them if segments is None).  The segment test is done on the arrays,
+	not in the database.
+	"""
+	names = [name for (cid, name, ctype, notnull, default, pk) in connection.cursor().execute('PRAGMA table_info(sim_inspiral)')]
+	rows = connection.cursor().execute('SELECT * FROM sim_inspiral').fetchall()
+	columns = {}
+	for i, name in enumerate(names):
+		columns[name] = numpy.empty(len(rows), dtype = object)
+		columns[name][:] = [row[i] for row in rows]
+	keep = times_within_segments(columns["geocent_end_time"], columns["geocent_end_time_ns"], segments_to_boundaries(segments))
+	return names, dict((name, column[keep]) for name, column in columns.items())
+
+
+def get_inspiral_injections(connection, found_query, is_better, segments = None):
+	"""
+	Return the found, total and missed injections made within segments.
+	found_query must return (simulation_id, ranking statistic) for each
+	coinc an injection was found in;  each found injection is returned as
+	(stat, sim) using the best statistic according to is_better(new, old).
+	This is the common part of get_min_far_inspiral_injections() and
+	get_max_snr_inspiral_injections().
+	"""
+	names, columns = get_sim_inspiral_columns(connection, segments)
+	rows = zip(*[columns[name] for name in names])
+	index = dict((sim_id, i) for i, sim_id in enumerate(columns["simulation_id"]))
+
+	# the best statistic of each injection made in the segments
+	best = {}
+	for sim_id, stat in connection.cursor().execute(found_query):
+		if sim_id in index and (sim_id not in best or is_better(stat, best[sim_id])):
+			best[sim_id] = stat
 
 	# get the mapping of a record returned by the database to a sim
 	# inspiral row. Note that this is DB dependent potentially, so always
@@ -91,85 +145,63 @@ def get_min_far_inspiral_injections(connection, segments = None, table_name = "c
 	make_sim_inspiral = make_sim_inspiral_row_from_columns_in_db(connection)
 
 	found_injections = {}
-
-	for values in connection.cursor().execute(found_query):
-		# all but the last column is used to build a sim inspiral object
-		sim = make_sim_inspiral(values[:-1])
-		far = values[-1]
-		# update with the minimum far seen until now
-		this_inj = found_injections.setdefault(sim.simulation_id, (far, sim))
-		if far < this_inj[0]:
-			found_injections[sim.simulation_id] = (far, sim)
-
-	total_query = 'SELECT * FROM sim_inspiral WHERE injection_in_segments(geocent_end_time, geocent_end_time_ns)'
-
 	total_injections = {}
 	# Missed injections start as a copy of the found injections
 	missed_injections = {}
-	for values in connection.cursor().execute(total_query):
+	for values in rows:
 		sim = make_sim_inspiral(values)
 		total_injections[sim.simulation_id] = sim
 		missed_injections[sim.simulation_id] = sim
+	for sim_id, stat in best.items():
+		sim = make_sim_inspiral(rows[index[sim_id]])
+		found_injections[sim.simulation_id] = (stat, sim)
 
 	# now actually remove the missed injections
 	for k in found_injections:
 		del missed_injections[k]
-		
 
 	return found_injections.values(), total_injections.values(), missed_injections.values()
 
 
-def get_max_snr_inspiral_injections(connection, segments = None, table_name = "coinc_inspiral"):
+def get_min_far_inspiral_injections(connection, segments = None, table_name = "coinc_inspiral"):
 	"""
-	Like get_min_far_inspiral_injections but uses SNR to rank injections.
+	This function returns the found injections from a database and the
+	minimum far associated with them as tuple of the form (far, sim). It also tells
+	you all of the injections that should have been injected.  Subtracting the two
+	outputs	should tell you the missed injections
 	"""
 
 	if table_name == dbtables.lsctables.CoincInspiralTable.tableName:
-		found_query = 'SELECT sim_inspiral.*, coinc_inspiral.snr FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_inspiral ON coinc_inspiral.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_inspiral.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event" AND injection_in_segments(sim_inspiral.geocent_end_time, sim_inspiral.geocent_end_time_ns)'
-
-	elif table_name in allowed_analysis_table_names():
-		raise NotImplementedError("get_max_snr_inspiral_injections has not yet implemented querying against the table %s. Please consider submitting a patch. See get_min_far_inspiral_injections for how to construct your query." % table_name)
-	else:
-		raise ValueError("table must be in " + " ".join(allowed_analysis_table_names()))
+		found_query = 'SELECT sim_inspiral.simulation_id, coinc_inspiral.combined_far FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_inspiral ON coinc_inspiral.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_inspiral.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event"'
 
+	elif table_name == dbtables.lsctables.CoincRingdownTable.tableName:
+		found_query = 'SELECT sim_inspiral.simulation_id, coinc_ringdown.false_alarm_rate FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_ringdown ON coinc_ringdown.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_ringdown.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event"'
 
-	def injection_was_made(end_time, end_time_ns, segments = segments):
-		return time_within_segments(end_time, end_time_ns, segments)
-
-	# restrict the found injections to only be within certain segments
-	connection.create_function("injection_in_segments", 2, injection_was_made)
+	elif table_name == dbtables.lsctables.MultiBurstTable.tableName:
+		found_query = 'SELECT sim_inspiral.simulation_id, multi_burst.false_alarm_rate FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN multi_burst ON multi_burst.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == multi_burst.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event"'
 
-	# get the mapping of a record returned by the database to a sim
-	# inspiral row. Note that this is DB dependent potentially, so always
-	# do this!
-	make_sim_inspiral = make_sim_inspiral_row_from_columns_in_db(connection)
+	else:
+		raise ValueError("table must be in " + " ".join(allowed_analysis_table_names()))
 
-	found_injections = {}
+	# update with the minimum far seen
+	return get_inspiral_injections(connection, found_query, lambda far, best_far: far < best_far, segments = segments)
 
-	for values in connection.cursor().execute(found_query):
-		# all but the last column is used to build a sim inspiral object
-		sim = make_sim_inspiral(values[:-1])
-		snr = values[-1]
-		# update with the minimum far seen until now
-		this_inj = found_injections.setdefault(sim.simulation_id, (snr, sim))
-		if snr > this_inj[0]:
-			found_injections[sim.simulation_id] = (snr, sim)
 
-	total_query = 'SELECT * FROM sim_inspiral WHERE injection_in_segments(geocent_end_time, geocent_end_time_ns)'
+def get_max_snr_inspiral_injections(connection, segments = None, table_name = "coinc_inspiral"):
+	"""
+	Like get_min_far_inspiral_injections but uses SNR to rank injections.
+	"""
 
-	total_injections = {}
-	# Missed injections start as a copy of the found injections
-	missed_injections = {}
-	for values in connection.cursor().execute(total_query):
-		sim = make_sim_inspiral(values)
-		total_injections[sim.simulation_id] = sim
-		missed_injections[sim.simulation_id] = sim
+	if table_name == dbtables.lsctables.CoincInspiralTable.tableName:
+		found_query = 'SELECT sim_inspiral.simulation_id, coinc_inspiral.snr FROM sim_inspiral JOIN coinc_event_map AS mapA ON mapA.event_id == sim_inspiral.simulation_id JOIN coinc_event_map AS mapB ON mapB.coinc_event_id == mapA.coinc_event_id JOIN coinc_inspiral ON coinc_inspiral.coinc_event_id == mapB.event_id JOIN coinc_event on coinc_event.coinc_event_id == coinc_inspiral.coinc_event_id WHERE mapA.table_name = "sim_inspiral" AND mapB.table_name = "coinc_event"'
 
-	# now actually remove the missed injections
-	for k in found_injections:
-		del missed_injections[k]
+	elif table_name in allowed_analysis_table_names():
+		raise NotImplementedError("get_max_snr_inspiral_injections has not yet implemented querying against the table %s. Please consider submitting a patch. See get_min_far_inspiral_injections for how to construct your query." % table_name)
+	else:
+		raise ValueError("table must be in " + " ".join(allowed_analysis_table_names()))
 
-	return found_injections.values(), total_injections.values(), missed_injections.values()
+	# update with the maximum snr seen
+	return get_inspiral_injections(connection, found_query, lambda snr, best_snr: snr > best_snr, segments = segments)
 
 
 def get_instruments_from_coinc_event_table(connection):
@@ -229,26 +261,36 @@ def get_event_fars(connection, table_name, segments = None):
 	return the false alarm rate of the most rare zero-lag coinc by instruments
 	"""
 
-	def event_in_requested_segments(end_time, end_time_ns, segments = segments):
-		return time_within_segments(end_time, end_time_ns, segments)
-
-	connection.create_function("event_in_requested_segments", 2, event_in_requested_segments)
-
 	if table_name == dbtables.lsctables.CoincInspiralTable.tableName:
-		query = 'SELECT coinc_event.instruments, coinc_inspiral.combined_far AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0) FROM coinc_inspiral JOIN coinc_event ON (coinc_inspiral.coinc_event_id == coinc_event.coinc_event_id) WHERE event_in_requested_segments(coinc_inspiral.end_time, coinc_inspiral.end_time_ns);'
+		query = 'SELECT coinc_event.instruments, coinc_inspiral.combined_far AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0), coinc_inspiral.end_time, coinc_inspiral.end_time_ns FROM coinc_inspiral JOIN coinc_event ON (coinc_inspiral.coinc_event_id == coinc_event.coinc_event_id);'
 
 	elif table_name == dbtables.lsctables.MultiBurstTable.tableName:
-		query = 'SELECT coinc_event.instruments, multi_burst.false_alarm_rate AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0) FROM multi_burst JOIN coinc_event ON (multi_burst.coinc_event_id == coinc_event.coinc_event_id) WHERE event_in_requested_segments(multi_burst.peak_time, multi_burst.peak_time_ns);'
+		query = 'SELECT coinc_event.instruments, multi_burst.false_alarm_rate AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0), multi_burst.peak_time, multi_burst.peak_time_ns FROM multi_burst JOIN coinc_event ON (multi_burst.coinc_event_id == coinc_event.coinc_event_id);'
 
 	elif table_name == dbtables.lsctables.CoincRingdownTable.tableName:
-		query = 'SELECT coinc_event.instruments, coinc_ringdown.false_alarm_rate AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0) FROM coinc_ringdown JOIN coinc_event ON (coinc_ringdown.coinc_event_id == coinc_event.coinc_event_id) WHERE event_in_requested_segments(coinc_ringdown.start_time, coinc_ringdown.start_time_ns);'
+		query = 'SELECT coinc_event.instruments, coinc_ringdown.false_alarm_rate AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0), coinc_ringdown.start_time, coinc_ringdown.start_time_ns FROM coinc_ringdown JOIN coinc_event ON (coinc_ringdown.coinc_event_id == coinc_event.coinc_event_id);'
 
 	else:
 		raise ValueError("table must be in " + " ".join(allowed_analysis_table_names()))
 
-	for inst, far, ts in connection.cursor().execute(query):
-		inst = frozenset(lsctables.instrument_set_from_ifos(inst))
-		yield (inst, far, ts)
+	cursor = connection.cursor()
+	cursor.arraysize = 10000
+	cursor.execute(query)
+	if segments is None:
+		for inst, far, ts, end_time, end_time_ns in cursor:
+			inst = frozenset(lsctables.instrument_set_from_ifos(inst))
+			yield (inst, far, ts)
+		return
+
+	# restrict the events to the requested segments, testing
+	# cursor.arraysize rows at a time
+	boundaries = segments_to_boundaries(segments)
+	for rows in iter(cursor.fetchmany, []):
+		keep = times_within_segments([row[3] for row in rows], [row[4] for row in rows], boundaries)
+		for (inst, far, ts, end_time, end_time_ns), k in zip(rows, keep):
+			if k:
+				inst = frozenset(lsctables.instrument_set_from_ifos(inst))
+				yield (inst, far, ts)
 
 
 def compute_search_efficiency_in_bins(found, total, ndbins, sim_to_bins_function = lambda sim: (sim.distance,)):
@@ -260,11 +302,13 @@ def compute_search_efficiency_in_bins(found, total, ndbins, sim_to_bins_function
 
 	input = rate.BinnedRatios(ndbins)
 
-	# increment the numerator with the missed injections
-	[input.incnumerator(sim_to_bins_function(sim)) for sim in found]
+	# increment the numerator with the found injections
+	if found:
+		input.fillnumerator(zip(*map(sim_to_bins_function, found)))
 
 	# increment the denominator with the total injections
-	[input.incdenominator(sim_to_bins_function(sim)) for sim in total]
+	if total:
+		input.filldenominator(zip(*map(sim_to_bins_function, total)))
 
 	# regularize by setting denoms to 1 to avoid nans
 	input.regularize()
@@ -472,10 +516,15 @@ def symmetrize_sims(sims, col1, col2):
 
 class DataBaseSummary(object):
 	"""
-	This class stores summary information gathered across the databases
+	This class stores summary information gathered across the databases.
+	Each database is summarized on its own and the summaries are then
+	merged, so with nproc > 1 the databases are summarized in that many
+	worker processes.  If cache_dir is given the summary of each
+	database is stored there, keyed by a hash of the file's contents and
+	the options, so that only new or changed databases are read again.
 	"""
 
-	def __init__(self, filelist, live_time_program = None, veto_segments_name = None, data_segments_name = "datasegments", tmp_path = None, verbose = False):
+	def __init__(self, filelist, live_time_program = None, veto_segments_name = None, data_segments_name = "datasegments", tmp_path = None, verbose = False, nproc = 1, cache_dir = None):
 
 		self.segments = segments.segmentlistdict()
 		self.instruments = set()
@@ -485,77 +534,182 @@ class DataBaseSummary(object):
 		self.total_injections_by_instrument_set = {}
 		self.zerolag_fars_by_instrument_set = {}
 		self.ts_fars_by_instrument_set = {}
-		self.numslides = set()
-
-		for f in filelist:
-			if verbose:
-				print >> sys.stderr, "Gathering stats from: %s...." % (f,)
-			working_filename = dbtables.get_connection_filename(f, tmp_path = tmp_path, verbose = verbose)
-			connection = sqlite3.connect(working_filename)
-			xmldoc = dbtables.get_xml(connection)
+		# the numbers of time slides found in the non-injection databases
+		self.distinct_numslides = set()
+		self.numslides = 0
+		for table_name in allowed_analysis_table_names():
+			setattr(self, table_name, None)
+
+		jobs = [(f, live_time_program, veto_segments_name, data_segments_name, tmp_path, verbose, cache_dir) for f in filelist]
+		if nproc > 1 and len(jobs) > 1:
+			pool = multiprocessing.Pool(nproc)
+			try:
+				# imap keeps the order of the files
+				for partial in pool.imap(_summarize_database, jobs):
+					self += partial
+			finally:
+				pool.terminate()
+		else:
+			for partial in itertools.imap(_summarize_database, jobs):
+				self += partial
 
-			sim = False
+		# FIXME
+		# Things left to do
+		# 1) summarize the far threshold over the entire dataset
 
-			# look for a sim inspiral table.  This is IMR work we have to have one of these :)
+	def add_database(self, f, live_time_program = None, veto_segments_name = None, data_segments_name = "datasegments", tmp_path = None, verbose = False):
+		"""
+		Gather the stats from the database f into self.
+		"""
+		if verbose:
+			print >> sys.stderr, "Gathering stats from: %s...." % (f,)
+		working_filename = dbtables.get_connection_filename(f, tmp_path = tmp_path, verbose = verbose)
+		connection = sqlite3.connect(working_filename)
+		xmldoc = dbtables.get_xml(connection)
+
+		sim = False
+
+		# look for a sim inspiral table.  This is IMR work we have to have one of these :)
+		try:
+			sim_inspiral_table = table.get_table(xmldoc, dbtables.lsctables.SimInspiralTable.tableName)
+			sim = True
+		except ValueError:
+			pass
+
+		# look for the relevant table for analyses
+		for table_name in allowed_analysis_table_names():
 			try:
-				sim_inspiral_table = table.get_table(xmldoc, dbtables.lsctables.SimInspiralTable.tableName)
-				sim = True
+				table.get_table(xmldoc, table_name)
+				if self.table_name is None or self.table_name == table_name:
+					self.table_name = table_name
+				else:
+					raise ValueError("detected more than one table type out of " + " ".join(allowed_analysis_table_names()))
 			except ValueError:
 				pass
 
-			# look for the relevant table for analyses
-			for table_name in allowed_analysis_table_names():
-				try:
-					setattr(self, table_name, table.get_table(xmldoc, table_name))
-					if self.table_name is None or self.table_name == table_name:
-						self.table_name = table_name
-					else:
-						raise ValueError("detected more than one table type out of " + " ".join(allowed_analysis_table_names()))
-				except ValueError:
-					setattr(self, table_name, None)
-
-			# the non simulation databases are where we get information about segments
-			if not sim:
-				self.numslides.add(connection.cursor().execute('SELECT count(DISTINCT(time_slide_id)) FROM time_slide').fetchone()[0])
-				[self.instruments.add(ifos) for ifos in get_instruments_from_coinc_event_table(connection)]
-				# save a reference to the segments for this file, needed to figure out the missed and found injections
-				self.this_segments = get_segments(connection, xmldoc, self.table_name, live_time_program, veto_segments_name, data_segments_name = data_segments_name)
-				# FIXME we don't really have any reason to use playground segments, but I put this here as a reminder
-				# self.this_playground_segments = segmentsUtils.S2playground(self.this_segments.extent_all())
-				self.segments += self.this_segments
-
-				# get the far thresholds for the loudest events in these databases
-				for (instruments_set, far, ts) in get_event_fars(connection, self.table_name):
-					if not ts:
-						self.zerolag_fars_by_instrument_set.setdefault(instruments_set, []).append(far)
-					else:
-						self.ts_fars_by_instrument_set.setdefault(instruments_set, []).append(far)
-			# get the injections
-			else:
-				# We need to know the segments in this file to determine which injections are found
-				self.this_injection_segments = get_segments(connection, xmldoc, self.table_name, live_time_program, veto_segments_name, data_segments_name = data_segments_name)
-				self.this_injection_instruments = []
-				distinct_instruments = connection.cursor().execute('SELECT DISTINCT(instruments) FROM coinc_event WHERE instruments!=""').fetchall()
-				for instruments, in distinct_instruments:
-					instruments_set = frozenset(lsctables.instrument_set_from_ifos(instruments))
-					self.this_injection_instruments.append(instruments_set)
-					segments_to_consider_for_these_injections = self.this_injection_segments.intersection(instruments_set) - self.this_injection_segments.union(set(self.this_injection_segments.keys()) - instruments_set)
-					found, total, missed = get_min_far_inspiral_injections(connection, segments = segments_to_consider_for_these_injections, table_name = self.table_name)
-					if verbose:
-						print >> sys.stderr, "%s total injections: %d; Found injections %d: Missed injections %d" % (instruments, len(total), len(found), len(missed))
-					self.found_injections_by_instrument_set.setdefault(instruments_set, []).extend(found)
-					self.total_injections_by_instrument_set.setdefault(instruments_set, []).extend(total)
-					self.missed_injections_by_instrument_set.setdefault(instruments_set, []).extend(missed)
-
-			# All done
-			dbtables.discard_connection_filename(f, working_filename, verbose = verbose)
-		if len(self.numslides) > 1:
-			raise ValueError('number of slides differs between input files')
-		elif self.numslides:
-			self.numslides = min(self.numslides)
+		# the non simulation databases are where we get information about segments
+		if not sim:
+			self.distinct_numslides.add(connection.cursor().execute('SELECT count(DISTINCT(time_slide_id)) FROM time_slide').fetchone()[0])
+			self._update_numslides()
+			[self.instruments.add(ifos) for ifos in get_instruments_from_coinc_event_table(connection)]
+			# save a reference to the segments for this file, needed to figure out the missed and found injections
+			self.this_segments = get_segments(connection, xmldoc, self.table_name, live_time_program, veto_segments_name, data_segments_name = data_segments_name)
+			# FIXME we don't really have any reason to use playground segments, but I put this here as a reminder
+			# self.this_playground_segments = segmentsUtils.S2playground(self.this_segments.extent_all())
+			self.segments += self.this_segments
+
+			# get the far thresholds for the loudest events in these databases
+			for (instruments_set, far, ts) in get_event_fars(connection, self.table_name):
+				if not ts:
+					self.zerolag_fars_by_instrument_set.setdefault(instruments_set, []).append(far)
+				else:
+					self.ts_fars_by_instrument_set.setdefault(instruments_set, []).append(far)
+		# get the injections
+		else:
+			# We need to know the segments in this file to determine which injections are found
+			self.this_injection_segments = get_segments(connection, xmldoc, self.table_name, live_time_program, veto_segments_name, data_segments_name = data_segments_name)
+			self.this_injection_instruments = []
+			distinct_instruments = connection.cursor().execute('SELECT DISTINCT(instruments) FROM coinc_event WHERE instruments!=""').fetchall()
+			for instruments, in distinct_instruments:
+				instruments_set = frozenset(lsctables.instrument_set_from_ifos(instruments))
+				self.this_injection_instruments.append(instruments_set)
+				segments_to_consider_for_these_injections = self.this_injection_segments.intersection(instruments_set) - self.this_injection_segments.union(set(self.this_injection_segments.keys()) - instruments_set)
+				found, total, missed = get_min_far_inspiral_injections(connection, segments = segments_to_consider_for_these_injections, table_name = self.table_name)
+				if verbose:
+					print >> sys.stderr, "%s total injections: %d; Found injections %d: Missed injections %d" % (instruments, len(total), len(found), len(missed))
+				self.found_injections_by_instrument_set.setdefault(instruments_set, []).extend(found)
+				self.total_injections_by_instrument_set.setdefault(instruments_set, []).extend(total)
+				self.missed_injections_by_instrument_set.setdefault(instruments_set, []).extend(missed)
+
+		# All done
+		connection.close()
+		dbtables.discard_connection_filename(f, working_filename, verbose = verbose)
+
+	def __iadd__(self, other):
+		"""
+		Merge the summary other into self.  Merging is associative, so
+		summaries of single databases can be combined in any grouping.
+		"""
+		# the table type of the first database wins
+		if self.table_name is None:
+			self.table_name = other.table_name
+		self.segments += other.segments
+		self.instruments |= other.instruments
+		self.distinct_numslides |= other.distinct_numslides
+		self._update_numslides()
+		for name in ("found_injections_by_instrument_set", "missed_injections_by_instrument_set", "total_injections_by_instrument_set", "zerolag_fars_by_instrument_set", "ts_fars_by_instrument_set"):
+			mine = getattr(self, name)
+			for instruments_set, values in getattr(other, name).items():
+				mine.setdefault(instruments_set, []).extend(values)
+		return self
+
+	def _update_numslides(self):
+		"""
+		Set self.numslides from self.distinct_numslides, raising
+		ValueError if the databases have different numbers of slides.
+		"""
+		if len(self.distinct_numslides) > 1:
+			raise ValueError('number of slides differs between input files: %s' % ", ".join(map(str, sorted(self.distinct_numslides))))
+		elif self.distinct_numslides:
+			self.numslides = min(self.distinct_numslides)
 		else:
 			self.numslides = 0
 
-		# FIXME
-		# Things left to do
-		# 1) summarize the far threshold over the entire dataset
+
+def database_summary_cache_key(f, *args):
+	"""
+	Return a hash of the contents of the database f and of args, the
+	options it is summarized with, to key cached summaries by.
+	"""
+	h = hashlib.sha1()
+	fileobj = open(f, "rb")
+	try:
+		for block in iter(lambda: fileobj.read(1 << 20), ""):
+			h.update(block)
+	finally:
+		fileobj.close()
+	h.update(repr(args))
+	return h.hexdigest()
+
+
+def summarize_database(f, live_time_program = None, veto_segments_name = None, data_segments_name = "datasegments", tmp_path = None, verbose = False, cache_dir = None):
+	"""
+	Return a DataBaseSummary of the single database f, to be merged with
+	others.  If cache_dir is given, the summary is read from there if the
+	same database was summarized with the same options before, and
+	written there otherwise.
+	"""
+	if cache_dir is not None:
+		cache_filename = os.path.join(cache_dir, "%s.pickle" % database_summary_cache_key(f, live_time_program, veto_segments_name, data_segments_name))
+		if os.path.exists(cache_filename):
+			if verbose:
+				print >> sys.stderr, "Using cached stats for: %s...." % (f,)
+			fileobj = open(cache_filename, "rb")
+			try:
+				return pickle.load(fileobj)
+			finally:
+				fileobj.close()
+
+	summary = DataBaseSummary([])
+	summary.add_database(f, live_time_program, veto_segments_name, data_segments_name, tmp_path = tmp_path, verbose = verbose)
+
+	if cache_dir is not None:
+		# write to a temporary file first so that concurrent jobs
+		# never see a partial file, and remove it if that fails
+		fd, tmp_filename = tempfile.mkstemp(dir = cache_dir)
+		try:
+			fileobj = os.fdopen(fd, "wb")
+			try:
+				pickle.dump(summary, fileobj, pickle.HIGHEST_PROTOCOL)
+			finally:
+				fileobj.close()
+			os.rename(tmp_filename, cache_filename)
+		except:
+			os.remove(tmp_filename)
+			raise
+	return summary
+
+
+def _summarize_database(args):
+	# for Pool.imap(), which passes a single argument
+	return summarize_database(*args)
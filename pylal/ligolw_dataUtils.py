@@ -378,6 +378,18 @@ class CompareDataRows:
 
         return self._compare( dataA, dataB )
         
+    def get_neededColumns( self, match_criteria, columns ):
+        """
+        Returns the columns, out of the given list of columns, that are needed
+        to evaluate match_criteria on a row.
+        """
+        if match_criteria == 'startTime':
+            return [col for col in columns if re.search('ifo|start_time', col) is not None]
+        elif match_criteria == 'endTime':
+            return [col for col in columns if re.search('ifo|end_time', col) is not None]
+        else:
+            return [col for col in columns if re.search(match_criteria, col) is not None]
+        
     def create_dbCompF( self, connection, diffFunc, compFuncName, window, classAcolumns = None, classBcolumns = None ):
         """
         Creates a function in the given connection to a database that allows
@@ -409,21 +421,8 @@ class CompareDataRows:
             self.set_neededColumnsB(classBcolumns)
         else:
             # figure out what columns are needed
-            if self.matchCriteriaA == 'startTime':
-                neededColumnsA = [col for col in classAcolumns if re.search('ifo|start_time', col) is not None]
-            elif self.matchCriteriaA == 'endTime':
-                neededColumnsA = [col for col in classAcolumns if re.search('ifo|end_time', col) is not None]
-            else:
-                neededColumnsA = [col for col in classAcolumns if re.search(self.matchCriteriaA, col) is not None]
-            self.set_neededColumnsA(neededColumnsA)
-
-            if self.matchCriteriaB == 'startTime':
-                neededColumnsB = [col for col in classBcolumns if re.search('ifo|start_time', col) is not None]
-            elif self.matchCriteriaB == 'endTime':
-                neededColumnsB = [col for col in classBcolumns if re.search('ifo|end_time', col) is not None]
-            else:
-                neededColumnsB = [col for col in classBcolumns if re.search(self.matchCriteriaB, col) is not None]
-            self.set_neededColumnsB(neededColumnsB)
+            self.set_neededColumnsA(self.get_neededColumns(self.matchCriteriaA, classAcolumns))
+            self.set_neededColumnsB(self.get_neededColumns(self.matchCriteriaB, classBcolumns))
 
         connection.create_function(compFuncName, len(self.neededColumnsA)+len(self.neededColumnsB), self.dbWrapper)
 
@@ -1,5 +1,7 @@
 import sys
 
+import numpy
+
 from glue.ligolw import lsctables
 from glue.ligolw import ilwd
 
@@ -27,8 +29,229 @@ def make_rec_sngls_table( connection, recovery_table ):
     connection.cursor().execute(sqlquery)
 
 
+#
+#   Columnar matching
+#
+
+# the maximum number of candidate pairs to test at once
+_batch_size = 1000000
+
+def load_columns( connection, table_name, columns ):
+    """
+    Returns a dictionary mapping the rowid and each of the given columns of
+    the given table to a list of the column's values, in rowid order.
+    """
+    columns = ['rowid'] + sorted(set(columns) - set(['rowid']))
+    sqlquery = 'SELECT %s FROM %s ORDER BY rowid' %( ', '.join(columns), table_name )
+    rows = connection.cursor().execute( sqlquery ).fetchall()
+    if rows == []:
+        return dict([ [col, []] for col in columns ])
+    return dict(zip( columns, map(list, zip(*rows)) ))
+
+def group_indices( keys ):
+    """
+    Returns a dictionary mapping each distinct value in keys to an array of
+    the indices at which it occurs. None (i.e., NULL) is not grouped, as it
+    is never equal to anything in the database.
+    """
+    groups = {}
+    for n, key in enumerate(keys):
+        if key is not None:
+            groups.setdefault( key, [] ).append( n )
+    return dict([ [key, numpy.array(idx, dtype = int)] for key, idx in groups.items() ])
+
+
+class RowValues:
+    """
+    Evaluates a match criterion on the rows of a table loaded by load_columns.
+    The criterion is evaluated at most once per row, no matter how many
+    candidate pairs the row is in. If the criterion is 'startTime' or
+    'endTime' and site_dependent is True, the table is taken to be a
+    simulation table and the {site}_(start|end)_time(_ns) columns are used,
+    as in CompareDataRows.diffSimSngl.
+    """
+    def __init__( self, data, RowClass, match_criteria, columns, site_dependent = False ):
+        self.data = data
+        self.RowClass = RowClass
+        self.matchCriteria = match_criteria
+        self.neededColumns = columns
+        self.siteDependent = site_dependent
+        self._values = {}
+        self._known = {}
+
+    def _evaluate( self, idx, site ):
+        if site not in self._values:
+            nrows = len(self.data['rowid'])
+            if self.matchCriteria in ('startTime', 'endTime'):
+                col = '%s_time' % self.matchCriteria[:-len('Time')]
+                if site is not None:
+                    col = '%s_%s' %( site, col )
+                self._values[site] = numpy.array( self.data[col], dtype = float ) + 1e-9*numpy.array( self.data[col+'_ns'], dtype = float )
+                self._known[site] = None
+            else:
+                self._values[site] = numpy.zeros( nrows ) + numpy.nan
+                self._known[site] = numpy.zeros( nrows, dtype = bool )
+        values = self._values[site]
+        known = self._known[site]
+        if known is not None:
+            for n in numpy.unique( idx[~known[idx]] ):
+                row = self.RowClass()
+                row.store([ (col, self.data[col][n]) for col in self.neededColumns ])
+                value = row.get_value( self.matchCriteria )
+                # a NULL value never matches anything
+                if value is not None:
+                    values[n] = value
+            known[idx] = True
+        return values[idx]
+
+    def get_values( self, idx, sites = None ):
+        """
+        Returns an array of the values of the match criterion for the rows at
+        idx. If self.siteDependent, sites must be an array giving the site to
+        use for each element in idx.
+        """
+        if not self.siteDependent:
+            return self._evaluate( idx, None )
+        values = numpy.zeros( len(idx) ) + numpy.nan
+        for site in set(sites):
+            if site:
+                sel = sites == site
+                values[sel] = self._evaluate( idx[sel], site )
+        return values
+
+
+class RowData(dict):
+    """
+    Fetches, on demand, complete rows of a table by rowid and stores them as
+    lists of (column_name, value) tuples, as CompareDataRows expects.
+    """
+    def __init__( self, connection, table_name, columns ):
+        self.connection = connection
+        self.tableName = table_name
+        self.columns = columns
+
+    def fetch( self, rowids ):
+        missing = [rowid for rowid in set(rowids) if rowid not in self]
+        # stay under sqlite's limit on the number of host parameters
+        for n in range(0, len(missing), 500):
+            chunk = missing[n:n+500]
+            sqlquery = 'SELECT rowid, %s FROM %s WHERE rowid IN (%s)' %( ', '.join(self.columns), self.tableName, ', '.join('?'*len(chunk)) )
+            for row in self.connection.cursor().execute( sqlquery, chunk ):
+                self[row[0]] = zip( self.columns, row[1:] )
+
+
+def diff_test( valuesA, valuesB, window, sitesB = None ):
+    """
+    Returns a function that takes arrays of indices ia, ib into two tables
+    and returns whether abs(a - b) <= window for each pair, where a and b are
+    the values given by the RowValues valuesA and valuesB. If valuesA is site
+    dependent, sitesB must be an array giving the site of every row in the
+    second table. NULL values are NaN, and never match.
+    """
+    def test( ia, ib ):
+        if valuesA.siteDependent:
+            a = valuesA.get_values( ia, sitesB[ib] )
+        else:
+            a = valuesA.get_values( ia )
+        with numpy.errstate( invalid = 'ignore' ):
+            return abs( a - valuesB.get_values( ib ) ) <= window
+    return test
+
+def compare_test( compF, rowDataA, rowDataB, rowidsA, rowidsB ):
+    """
+    Returns a function that takes arrays of indices ia, ib into two tables and
+    returns compF._compare for each pair, using the complete rows in the
+    RowData rowDataA and rowDataB. This is for criteria, like eThinca, that
+    cannot be split into a value for each row.
+    """
+    def test( ia, ib ):
+        pairs = zip( rowidsA[ia].tolist(), rowidsB[ib].tolist() )
+        rowDataA.fetch([ a for a, b in pairs ])
+        rowDataB.fetch([ b for a, b in pairs ])
+        return numpy.array([ compF._compare( rowDataA[a], rowDataB[b] ) for a, b in pairs ], dtype = bool)
+    return test
+
+def interval_join( groups, window, exact = True ):
+    """
+    Yields arrays of indices ia, ib of candidate pairs of rows from two
+    tables, in batches of about _batch_size pairs. groups is a list of
+    (idxA, keysA, idxB, keysB); within each group, every pair with
+    keysA - window <= keysB <= keysA + window is yielded. keysB is sorted, so
+    the cost goes as the number of candidates rather than the number of
+    pairs. If keysA and keysB are None, every pair in the group is yielded.
+    If exact is False, the window is widened slightly so that no pair passing
+    abs(keysA - keysB) <= window, which rounds differently, is missed.
+    """
+    for idxA, keysA, idxB, keysB in groups:
+        if not len(idxA) or not len(idxB):
+            continue
+        if keysA is None:
+            lo = numpy.zeros( len(idxA), dtype = int )
+            hi = lo + len(idxB)
+            sortedB = idxB
+        else:
+            order = numpy.argsort( keysB, kind = 'mergesort' )
+            sortedKeys = keysB[order]
+            sortedB = idxB[order]
+            win = window
+            if not exact:
+                win = window + (abs(keysA) + window) * 1e-12
+            lo = numpy.searchsorted( sortedKeys, keysA - win, side = 'left' )
+            hi = numpy.searchsorted( sortedKeys, keysA + win, side = 'right' )
+            # NaNs sort to the end; a NaN key never matches
+            nans = numpy.isnan( keysA )
+            hi[nans] = lo[nans]
+        counts = hi - lo
+        ends = numpy.cumsum( counts )
+        start = 0
+        while start < len(idxA):
+            stop = numpy.searchsorted( ends, ends[start] - counts[start] + _batch_size, side = 'right' )
+            stop = max( stop, start+1 )
+            thisCounts = counts[start:stop]
+            ia = numpy.repeat( idxA[start:stop], thisCounts )
+            offsets = numpy.arange( len(ia) ) - numpy.repeat( numpy.cumsum(thisCounts) - thisCounts, thisCounts )
+            ib = sortedB[numpy.repeat( lo[start:stop], thisCounts ) + offsets]
+            if len(ia):
+                yield ia, ib
+            start = stop
+
+def find_matches( groups, window, exact, tests ):
+    """
+    Returns arrays of indices ia, ib of all the candidate pairs yielded by
+    interval_join( groups, window, exact ) that pass every one of the given
+    tests (see diff_test and compare_test). The pairs are sorted by ia, then
+    by ib.
+    """
+    matchesA = [numpy.zeros( 0, dtype = int )]
+    matchesB = [numpy.zeros( 0, dtype = int )]
+    for ia, ib in interval_join( groups, window, exact ):
+        for test in tests:
+            keep = test( ia, ib )
+            ia = ia[keep]
+            ib = ib[keep]
+            if not len(ia):
+                break
+        matchesA.append( ia )
+        matchesB.append( ib )
+    ia = numpy.concatenate( matchesA )
+    ib = numpy.concatenate( matchesB )
+    order = numpy.lexsort( (ib, ia) )
+    return ia[order], ib[order]
+
+
 def dbinjfind( connection, simulation_table, recovery_table, match_criteria, rough_match = None, rejection_criteria = [], rough_rejection = None, verbose = False ):
+    """
+    Finds the events in recovery_table that match injections in
+    simulation_table and stores the (sim_id, event_id) pairs in the
+    temporary table found_inj.
 
+    Rather than testing every injection-event pair in the database, the
+    needed columns are loaded and candidate pairs are found by an interval
+    join on the rough match or, failing that, on the first match criterion
+    that is not eThinca. Each match criterion is evaluated once per row, and
+    the candidates are tested in bulk. The rejection criteria are applied in
+    the same way.
+    """
     # validate simulation_table and recovery_table
     simulation_table = sqlutils.validate_option( simulation_table )
     recovery_table = sqlutils.validate_option( recovery_table )
@@ -36,7 +259,7 @@ def dbinjfind( connection, simulation_table, recovery_table, match_criteria, rou
     # create DataRow classes to store data for each table
     simColumns = sqlutils.get_column_names_from_table( connection, simulation_table )
     recColumns = sqlutils.get_column_names_from_table( connection, recovery_table )
-    
+
     SimDataRow = dataUtils.createDataRowClass( simulation_table, columns = simColumns )
     RecDataRow = dataUtils.createDataRowClass( recovery_table, columns = recColumns )
 
@@ -45,16 +268,10 @@ def dbinjfind( connection, simulation_table, recovery_table, match_criteria, rou
         print >> sys.stdout, "Getting eligible events..."
     make_rec_sngls_table( connection, recovery_table )
 
-    # if using rough match, create an index for it
-    rough_match_test = ''
     if rough_match is not None:
         simRough, recRough, winRough = rough_match
         simRough = sqlutils.validate_option( simRough )
         recRough = sqlutils.validate_option( recRough )
-        sqlquery = "CREATE INDEX rs_rmtch_idx ON rec_sngls (%s)" % recRough
-        connection.cursor().execute( sqlquery )
-        rough_match_test = "rec_sngls.%s >= sim.%s - %f AND rec_sngls.%s <= sim.%s + %f AND\n" %( recRough, simRough, winRough, recRough, simRough, winRough ) 
-
 
     #
     # Remove triggers that match all_data triggers
@@ -75,68 +292,137 @@ def dbinjfind( connection, simulation_table, recovery_table, match_criteria, rou
                     experiment_summary.datatype == "all_data"''' ])
         connection.cursor().execute(sqlquery)
 
-        rough_test = ''
+        # load the columns needed for the rejection criteria
+        compF = dataUtils.CompareDataRows(RecDataRow, RecDataRow)
+        neededColumns = []
+        for thisFunc, window in rejection_criteria:
+            if thisFunc != 'eThinca':
+                neededColumns.extend( compF.get_neededColumns( thisFunc, recColumns ) )
         if rough_rejection is not None:
             rejRough, rejRoughWin = rough_rejection
             rejRough = sqlutils.validate_option( rejRough )
-            sqlquery = "CREATE INDEX ads_rmtch_idx ON all_data_sngls (%s)" % rejRough
-            connection.cursor().execute( sqlquery )
-            rough_test = "all_data_sngls.%s >= rec_sngls.%s - %f AND all_data_sngls.%s <= rec_sngls.%s + %f AND\n" % ( rejRough, rejRough, rejRoughWin, rejRough, rejRough, rejRoughWin )
+            neededColumns.append( rejRough )
+        recData = load_columns( connection, 'rec_sngls', neededColumns )
+        allData = load_columns( connection, 'all_data_sngls', neededColumns )
+        recRowids = numpy.array( recData['rowid'], dtype = int )
+        allRowids = numpy.array( allData['rowid'], dtype = int )
+        recRows = RowData( connection, 'rec_sngls', recColumns )
+        allRows = RowData( connection, 'all_data_sngls', recColumns )
 
-        # cycle over the rejection criteria, creating a function in the database for each
+        # cycle over the rejection criteria, creating a test for each
         rejection_tests = []
-        for n,(thisFunc, window) in enumerate(rejection_criteria):
+        rejection_values = []
+        for thisFunc, window in rejection_criteria:
             compF = dataUtils.CompareDataRows(RecDataRow, RecDataRow)
-            funcName = 'matches_all_data%i' % n
             if thisFunc == 'eThinca':
-                compF.create_dbCompF( connection, compF.eThincaSngl, funcName, window, recColumns, recColumns )
+                compF.set_diffFunc( compF.eThincaSngl )
+                compF.set_window( window )
+                rejection_tests.append( compare_test( compF, recRows, allRows, recRowids, allRowids ) )
             else:
-                compF.set_matchCriteriaA( thisFunc )
-                compF.set_matchCriteriaB( thisFunc )
-                compF.create_dbCompF( connection, compF.diffRowARowB, funcName, window, recColumns, recColumns )
-            simSnglCols = ','.join(['rec_sngls.%s' %(col) for col in compF.neededColumnsA])
-            allSnglCols = ','.join(['all_data_sngls.%s' %(col) for col in compF.neededColumnsB])
-            rejection_tests.append( '%s(%s, %s)' %(funcName, simSnglCols, allSnglCols) ) 
+                columns = compF.get_neededColumns( thisFunc, recColumns )
+                rejection_values.append(( RowValues( recData, RecDataRow, thisFunc, columns ), RowValues( allData, RecDataRow, thisFunc, columns ), window ))
+                rejection_tests.append( diff_test( *rejection_values[-1] ) )
+
+        # join on the rough test if there is one
+        recIdx = numpy.arange( len(recRowids) )
+        allIdx = numpy.arange( len(allRowids) )
+        if rough_rejection is not None:
+            groups = [( recIdx, numpy.array( recData[rejRough], dtype = float ), allIdx, numpy.array( allData[rejRough], dtype = float ) )]
+            # the window is written to the database as %f
+            exact, window = True, float( '%f' % rejRoughWin )
+        elif rejection_values != []:
+            recValues, allValues, window = rejection_values[0]
+            groups = [( recIdx, recValues.get_values( recIdx ), allIdx, allValues.get_values( allIdx ) )]
+            exact = False
+        else:
+            groups = [( recIdx, None, allIdx, None )]
+            exact, window = True, None
+        ia, ib = find_matches( groups, window, exact, rejection_tests )
 
         # now remove triggers
-        sqlquery = ''.join([ '''
-            DELETE FROM
-                rec_sngls
-            WHERE EXISTS (
-                SELECT
-                    *
-                FROM
-                    all_data_sngls
-                WHERE
-                    ''', rough_test, '\nAND '.join( rejection_tests ), ')' ])
-        connection.cursor().execute(sqlquery)
+        sqlquery = 'DELETE FROM rec_sngls WHERE rowid == ?'
+        connection.cursor().executemany( sqlquery, [(rowid,) for rowid in numpy.unique( recRowids[ia] ).tolist()] )
         connection.commit()
 
     #
     #   Determine Sim-Sngl matches
     #
-    
+
     if verbose:
         print >> sys.stdout, "Applying match criteria to find sim-sngl maps..."
-    # cycle over the match criteria, creating a function in the database for each
+    # load the columns needed for the match criteria
+    compF = dataUtils.CompareDataRows(SimDataRow, RecDataRow)
+    simNeeded = ['simulation_id', 'process_id']
+    recNeeded = ['event_id', 'sim_proc_id']
+    for simFunc, snglFunc, window in match_criteria:
+        if simFunc != 'eThinca':
+            simNeeded.extend( compF.get_neededColumns( simFunc, simColumns ) )
+            recNeeded.extend( compF.get_neededColumns( snglFunc, recColumns ) )
+            if simFunc in ('startTime', 'endTime'):
+                recNeeded.append( 'ifo' )
+    if rough_match is not None:
+        simNeeded.append( simRough )
+        recNeeded.append( recRough )
+    simData = load_columns( connection, simulation_table, simNeeded )
+    recData = load_columns( connection, 'rec_sngls', recNeeded )
+    simRowids = numpy.array( simData['rowid'], dtype = int )
+    recRowids = numpy.array( recData['rowid'], dtype = int )
+    recSites = None
+    if 'ifo' in recData:
+        recSites = numpy.array([ ifo is not None and ifo.lower()[0] or '' for ifo in recData['ifo'] ])
+    simRows = RowData( connection, simulation_table, simColumns )
+    recRows = RowData( connection, 'rec_sngls', recColumns )
+
+    # cycle over the match criteria, creating a test for each
     match_tests = []
-    for n,(simFunc, snglFunc, window) in enumerate(match_criteria):
+    match_values = []
+    for simFunc, snglFunc, window in match_criteria:
         compF = dataUtils.CompareDataRows(SimDataRow, RecDataRow)
-        # set the name of the compare function to use in the database
-        funcName = 'are_match%i' % n
-        # set the functions that get the match criteria from the tables
-        # and create the compare function in the database
         if simFunc == 'eThinca':
-            compF.create_dbCompF( connection, compF.eThincaSim, funcName, window, simColumns, recColumns )
+            compF.set_diffFunc( compF.eThincaSim )
+            compF.set_window( window )
+            match_tests.append( compare_test( compF, simRows, recRows, simRowids, recRowids ) )
         else:
-            compF.set_matchCriteriaA( simFunc )
-            compF.set_matchCriteriaB( snglFunc )
-            compF.create_dbCompF( connection, compF.diffSimSngl, funcName, window, simColumns, recColumns )
-        simCols = ','.join(['sim.%s'%(col) for col in compF.neededColumnsA])
-        snglCols = ','.join(['rec_sngls.%s'%(col) for col in compF.neededColumnsB])
-        match_tests.append( '%s(%s, %s)' %(funcName, simCols, snglCols) )
-
-    # determine matches
+            simValues = RowValues( simData, SimDataRow, simFunc, compF.get_neededColumns( simFunc, simColumns ), site_dependent = simFunc in ('startTime', 'endTime') )
+            recValues = RowValues( recData, RecDataRow, snglFunc, compF.get_neededColumns( snglFunc, recColumns ) )
+            match_values.append(( simValues, recValues, window ))
+            match_tests.append( diff_test( simValues, recValues, window, recSites ) )
+
+    # injections can only be matched to events from the same injection job;
+    # within each job, join on the rough match if there is one
+    simGroups = group_indices( simData['process_id'] )
+    recGroups = group_indices( recData['sim_proc_id'] )
+    procIds = sorted( set(simGroups) & set(recGroups) )
+    groups = []
+    if rough_match is not None:
+        simKeys = numpy.array( simData[simRough], dtype = float )
+        recKeys = numpy.array( recData[recRough], dtype = float )
+        # the window is written to the database as %f
+        exact, window = True, float( '%f' % winRough )
+        for procId in procIds:
+            simIdx, recIdx = simGroups[procId], recGroups[procId]
+            groups.append(( simIdx, simKeys[simIdx], recIdx, recKeys[recIdx] ))
+    elif match_values != []:
+        simValues, recValues, window = match_values[0]
+        exact = False
+        for procId in procIds:
+            simIdx, recIdx = simGroups[procId], recGroups[procId]
+            recKeys = recValues.get_values( recIdx )
+            if simValues.siteDependent:
+                # which of the injection's times to use depends on the event's site
+                for site in sorted(set( recSites[recIdx] )):
+                    sel = recSites[recIdx] == site
+                    simKeys = simValues.get_values( simIdx, numpy.array( [site]*len(simIdx) ) )
+                    groups.append(( simIdx, simKeys, recIdx[sel], recKeys[sel] ))
+            else:
+                groups.append(( simIdx, simValues.get_values( simIdx ), recIdx, recKeys ))
+    else:
+        exact, window = True, None
+        for procId in procIds:
+            groups.append(( simGroups[procId], None, recGroups[procId], None ))
+    ia, ib = find_matches( groups, window, exact, match_tests )
+
+    # write the matches
     sqlquery = ''.join(["""
     CREATE TEMP TABLE found_inj AS
     SELECT
@@ -144,10 +430,10 @@ def dbinjfind( connection, simulation_table, recovery_table, match_criteria, rou
         rec_sngls.event_id AS event_id
     FROM
         """, simulation_table, """ AS sim, rec_sngls
-    WHERE
-        sim.process_id == rec_sngls.sim_proc_id AND
-        """, rough_match_test, '\n\t\tAND'.join( match_tests ) ])
+    LIMIT 0""" ])
     connection.cursor().execute(sqlquery)
+    sqlquery = 'INSERT INTO found_inj (sim_id, event_id) VALUES (?, ?)'
+    connection.cursor().executemany( sqlquery, [(simData['simulation_id'][a], recData['event_id'][b]) for a, b in zip( ia.tolist(), ib.tolist() )] )
     connection.commit()
 
 def strlst_is_subset(stringA, stringB):
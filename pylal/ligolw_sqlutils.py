@@ -19,6 +19,8 @@ import bisect
 import copy
 import time
 import pdb
+import numpy
+from collections import deque
 
 from glue.ligolw import dbtables
 from glue.ligolw import lsctables
@@ -616,6 +618,30 @@ def increment_id( last_id, nsteps = 1 ):
 def end_time_in_ns( end_time, end_time_ns ):
     return end_time*1e9 + end_time_ns
 
+def update_column_by_id( connection, table_name, column_name, id_column, values ):
+    """
+    Sets column_name in table_name for many rows with a single executemany.
+    values is an iterable of (value, id) tuples; the row(s) whose id_column
+    equals id are given value. An index on id_column is created for the
+    duration of the update so that each row is found in O(log n) time; if
+    the index already exists it is used and left in place.
+    Use this to write back quantities computed in bulk instead of updating
+    rows one at a time through a SQLite user-defined function.
+    """
+    table_name = validate_option( table_name )
+    column_name = validate_option( column_name )
+    id_column = validate_option( id_column )
+    index_name = '_'.join([ table_name, id_column, 'update_idx' ])
+    cursor = connection.cursor()
+    create_index = cursor.execute( "SELECT COUNT(*) FROM sqlite_master WHERE type == 'index' AND name == ?", (index_name,) ).fetchone()[0] == 0
+    if create_index:
+        cursor.execute( 'CREATE INDEX %s ON %s (%s)' % (index_name, table_name, id_column) )
+    try:
+        cursor.executemany( 'UPDATE %s SET %s = ? WHERE %s == ?' % (table_name, column_name, id_column), values )
+    finally:
+        if create_index:
+            cursor.execute( 'DROP INDEX %s' % index_name )
+
 class Summaries:
     """
     This class stores information about the foreground and background in a 
@@ -664,6 +690,16 @@ class Summaries:
 
     zero_lag_ids stores the esid of all zero-lag "slides" of an experiment.
         zero_lag_ids[ experiment_id ] = [experiment_summ_id1, experiment_summ_id2, etc.]
+
+    bkg_stats, sngl_slide_stats and max_bkg_fars are filled as lists. 
+    sort_bkg_stats and sort_max_bkg_fars sort the lists and also store them 
+    as numpy arrays in sorted_bkg_stats, sorted_sngl_slide_stats and 
+    sorted_max_bkg_fars, so that the fars of many triggers can be found with 
+    a single numpy.searchsorted (see calc_ufars and calc_cfars). 
+    sort_max_bkg_fars also stores the cumulative sums of the sorted 
+    max_bkg_fars in max_bkg_far_sums, so that calc_cfar does not have to 
+    re-add them for every trigger. They must be called again after more 
+    stats or max_bkg_fars are added.
     """
     def __init__(self):
         self.bkg_stats = {}
@@ -672,6 +708,10 @@ class Summaries:
         self.frg_durs = {}
         self.bkg_durs = {}
         self.max_bkg_fars = {}
+        self.sorted_bkg_stats = {}
+        self.sorted_sngl_slide_stats = {}
+        self.sorted_max_bkg_fars = {}
+        self.max_bkg_far_sums = {}
         self.zero_lag_ids = {}
 
     def add_to_bkg_stats(self, experiment_id, experiment_summ_id, ifos, param_group, stat):
@@ -691,12 +731,14 @@ class Summaries:
 
     def sort_bkg_stats(self):
         """
-        Sorts each list in bkg_stats and sngl_slide_stats from smallest to largest value.
+        Sorts each list in bkg_stats and sngl_slide_stats from smallest to largest value,
+        and stores them as numpy arrays in sorted_bkg_stats and sorted_sngl_slide_stats.
         """
-        for thislist in self.bkg_stats.values():
-            thislist.sort()
-        for thislist in self.sngl_slide_stats.values():
-            thislist.sort()
+        for stats_dict, sorted_dict in ((self.bkg_stats, self.sorted_bkg_stats), (self.sngl_slide_stats, self.sorted_sngl_slide_stats)):
+            sorted_dict.clear()
+            for key, thislist in stats_dict.items():
+                thislist.sort()
+                sorted_dict[key] = numpy.array(thislist)
 
     def store_datatypes(self, experiment_id, experiment_summ_id, datatype):
         """
@@ -762,10 +804,17 @@ class Summaries:
 
     def sort_max_bkg_fars(self):
         """
-        Sorts the max_bkg_fars lists from smallest to highest values.
+        Sorts the max_bkg_fars lists from smallest to highest values, stores 
+        them as numpy arrays in sorted_max_bkg_fars, and stores their 
+        cumulative sums in max_bkg_far_sums. max_bkg_far_sums[key][ii] is the 
+        sum of the ii smallest max_bkg_fars[key].
         """
-        for thislist in self.max_bkg_fars.values():
+        self.sorted_max_bkg_fars.clear()
+        self.max_bkg_far_sums.clear()
+        for key, thislist in self.max_bkg_fars.items():
             thislist.sort()
+            self.sorted_max_bkg_fars[key] = numpy.array(thislist)
+            self.max_bkg_far_sums[key] = numpy.concatenate(( [0.], numpy.cumsum(self.sorted_max_bkg_fars[key]) ))
 
     def calc_ufar_by_max(self, eid, esid, ifos, param_group, stat):
         """
@@ -821,9 +870,72 @@ class Summaries:
         inactive. If the given ufar is less than some max_bkg_far, then 
         the category is considered active.
         """
-        return \
-            (len( self.max_bkg_fars[(esid, ifo_group)] ) - bisect.bisect_left( self.max_bkg_fars[(esid,ifo_group)], ufar ))*ufar \
-            + sum([self.max_bkg_fars[(esid,ifo_group)][ii] for ii in range(bisect.bisect_left( self.max_bkg_fars[(esid,ifo_group)], ufar))])
+        fars = self.max_bkg_fars[(esid, ifo_group)]
+        n_inactive = bisect.bisect_left( fars, ufar )
+        try:
+            inactive_sum = self.max_bkg_far_sums[(esid, ifo_group)][n_inactive]
+        except KeyError:
+            # sort_max_bkg_fars has not been called
+            inactive_sum = sum([fars[ii] for ii in range(n_inactive)])
+        return (len( fars ) - n_inactive)*ufar + inactive_sum
+
+    def calc_ufars(self, rows, rank_by = 'MAX'):
+        """
+        Vectorized version of calc_ufar_by_max (rank_by = 'MAX') and 
+        calc_ufar_by_min (rank_by = 'MIN'). rows is an iterable of 
+        (id, eid, esid, ifos, param_group, stat) tuples, for example the 
+        result of a SELECT. The triggers are grouped by category and slide, and 
+        the uncombined fars of each group are found with a single 
+        numpy.searchsorted pass over sorted_bkg_stats and 
+        sorted_sngl_slide_stats. Returns a list of (ufar, id) tuples, in the 
+        order needed by update_column_by_id. sort_bkg_stats must be called 
+        first.
+        """
+        if rank_by not in ('MAX', 'MIN'):
+            raise ValueError("rank_by must be 'MAX' or 'MIN'")
+        groups = {}
+        for row in rows:
+            groups.setdefault( row[1:5], [] ).append( (row[0], row[5]) )
+        results = []
+        for (eid, esid, ifos, param_group), group in groups.items():
+            ids, stats = zip(*group)
+            stats = numpy.array( stats )
+            bkg_stats = self.sorted_bkg_stats[(eid, ifos, param_group)]
+            slide_stats = self.sorted_sngl_slide_stats[(eid, esid, ifos, param_group)]
+            if rank_by == 'MAX':
+                counts = ( len(bkg_stats) - numpy.searchsorted(bkg_stats, stats, side = 'left') ) \
+                    - ( len(slide_stats) - numpy.searchsorted(slide_stats, stats, side = 'left') )
+            else:
+                counts = numpy.searchsorted(bkg_stats, stats, side = 'right') \
+                    - numpy.searchsorted(slide_stats, stats, side = 'right')
+            ufars = [count / self.bkg_durs[esid] for count in counts.tolist()]
+            if rank_by == 'MIN':
+                # see calc_ufar_by_min
+                ufars = [stat if stat == 0. else ufar for stat, ufar in zip(stats.tolist(), ufars)]
+            results.extend( zip(ufars, ids) )
+        return results
+
+    def calc_cfars(self, rows):
+        """
+        Vectorized version of calc_cfar. rows is an iterable of 
+        (id, esid, ifo_group, ufar) tuples. The combined fars of all the 
+        triggers sharing an esid and ifo_group are found with a single 
+        numpy.searchsorted pass over sorted_max_bkg_fars and their 
+        cumulative sums. Returns a list of (cfar, id) tuples, in the order 
+        needed by update_column_by_id. sort_max_bkg_fars must be called first.
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault( row[1:3], [] ).append( (row[0], row[3]) )
+        results = []
+        for key, group in groups.items():
+            ids, ufars = zip(*group)
+            ufars = numpy.array( ufars )
+            fars = self.sorted_max_bkg_fars[key]
+            n_inactive = numpy.searchsorted( fars, ufars, side = 'left' )
+            cfars = (len(fars) - n_inactive)*ufars + self.max_bkg_far_sums[key][n_inactive]
+            results.extend( zip(cfars.tolist(), ids) )
+        return results
 
 class rank_stats:
     """
@@ -1736,6 +1848,81 @@ def simplify_exprsumm_tbl(connection, verbose=False, debug=False):
             print >> sys.stdout, "The database is lacks the experiment_map &/or experiment_summary table(s)."
 
 
+def cluster_losers( rows, window, rank_by ):
+    """
+    Returns the set of ids of the triggers that are clustered away.
+
+    @rows: a sequence of (id, esid, ifos, param_grouping, gps_time,
+     ranking_stat) tuples
+    @window: the cluster window, in the same units as gps_time
+    @rank_by: ">" if larger ranking_stats are better, "<" if smaller
+
+    A trigger loses if another trigger with the same esid, ifos and
+    param_grouping has a better ranking_stat and a gps_time in
+    (gps_time - window, gps_time + window]. Triggers are compared to all
+    other triggers, not just to the surviving ones. As in SQL, a trigger
+    with a NULL (None) in any of the columns neither loses nor causes
+    other triggers to lose. A trigger whose id appears in several rows
+    loses if any of them does.
+
+    The triggers are sorted by group and time, the window boundaries of
+    each trigger are found with searchsorted, and the best ranking_stat
+    in each window is found with a monotone deque, so the cost is
+    O(n log n) rather than the O(n^2) of a correlated subquery.
+    """
+    rows = [row for row in rows if None not in row]
+    if not rows or window <= 0:
+        return set()
+    ids, esids, ifos, param_groupings, gps_times, ranking_stats = zip(*rows)
+    group_ids = {}
+    groups = numpy.array([group_ids.setdefault(key, len(group_ids)) for key in zip(esids, ifos, param_groupings)])
+    gps_times = numpy.array(gps_times, dtype = "double")
+    ranking_stats = numpy.array(ranking_stats, dtype = "double")
+    if rank_by == "<":
+        ranking_stats = -ranking_stats
+
+    # sort by group, then by time
+    order = numpy.lexsort((gps_times, groups))
+    groups = groups[order]
+    gps_times = gps_times[order]
+    ranking_stats = ranking_stats[order].tolist()
+
+    # find the [lo, hi) range of triggers within the window of each
+    # trigger. the arithmetic is done in double precision, as SQLite
+    # does it
+    starts = numpy.flatnonzero(numpy.concatenate(([True], groups[1:] != groups[:-1])))
+    ends = numpy.concatenate((starts[1:], [len(groups)]))
+    lo = numpy.empty(len(groups), dtype = int)
+    hi = numpy.empty(len(groups), dtype = int)
+    for start, end in zip(starts, ends):
+        t = gps_times[start:end]
+        lo[start:end] = start + numpy.searchsorted(t, t - window, side = "right")
+        hi[start:end] = start + numpy.searchsorted(t, t + window, side = "right")
+    lo = lo.tolist()
+    hi = hi.tolist()
+
+    # sliding window maximum. the deque holds the indexes of the
+    # triggers in the window whose ranking_stats are not exceeded by a
+    # later trigger in the window, so their ranking_stats are in
+    # decreasing order and the first is the window's maximum
+    losers = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        window_triggers = deque()
+        j = start
+        for i in xrange(start, end):
+            while j < hi[i]:
+                while window_triggers and ranking_stats[window_triggers[-1]] <= ranking_stats[j]:
+                    window_triggers.pop()
+                window_triggers.append(j)
+                j += 1
+            while window_triggers[0] < lo[i]:
+                window_triggers.popleft()
+            if ranking_stats[window_triggers[0]] > ranking_stats[i]:
+                losers.append(i)
+
+    return set(ids[k] for k in order[losers].tolist())
+
+
 # =============================================================================
 #
 #                          ExperimentSummary Utilities
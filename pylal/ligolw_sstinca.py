@@ -26,6 +26,7 @@
 
 import bisect
 import math
+import numpy
 import sys
 
 
@@ -234,6 +235,7 @@ class InspiralCoincTables(snglcoinc.CoincTables):
 		self.seglists = ligolw_search_summary.segmentlistdict_fromsearchsummary(xmldoc, program = program).coalesce()
 		if vetoes is not None:
 			self.seglists -= vetoes
+		self.seglists_index = snglcoinc.SegmentIndex(self.seglists)
 
 	def append_coinc(self, process_id, time_slide_id, coinc_def_id, events, magic_number):
 		#
@@ -278,7 +280,7 @@ class InspiralCoincTables(snglcoinc.CoincTables):
 
 		tstart = coinc_inspiral.get_end()
 		instruments = set([event.ifo for event in events])
-		instruments |= set([instrument for instrument, segs in self.seglists.items() if tstart - self.time_slide_index[time_slide_id][instrument] in segs])
+		instruments |= self.seglists_index.instruments_on(tstart.ns(), self.time_slide_index[time_slide_id])
 		coinc.set_instruments(instruments)
 
 		#
@@ -341,6 +343,9 @@ class InspiralEventList(snglcoinc.EventList):
 		LIGOTimeGPS.
 		"""
 		self.sort(lambda a, b: cmp(a.end_time, b.end_time) or cmp(a.end_time_ns, b.end_time_ns))
+		# integer nanosecond end times for the array-based pair
+		# search engine and segment membership tests
+		self.end_ns = numpy.fromiter((event.end_time * 1000000000 + event.end_time_ns for event in self), dtype = "int64", count = len(self))
 
 	def set_dt(self, dt):
 		"""
@@ -352,6 +357,12 @@ class InspiralEventList(snglcoinc.EventList):
 		# avoid doing type conversion in loops
 		self.dt = LIGOTimeGPS(dt * 1.01)
 
+	def get_times_ns(self):
+		return self.end_ns
+
+	def get_window_ns(self, light_travel_time, threshold):
+		return self.dt.ns()
+
 	def get_coincs(self, event_a, offset_a, light_travel_time, threshold, comparefunc):
 		"""
 		The parameter 'threshold' holds the ethinca parameter (for metric-based coincidence tests)
@@ -582,8 +593,7 @@ def ligolw_thinca(
 
 	eventlists = snglcoinc.make_eventlists(xmldoc, InspiralEventList, lsctables.SnglInspiralTable.tableName)
 	if veto_segments is not None:
-		for eventlist in eventlists.values():
-			iterutils.inplace_filter((lambda event: event.ifo not in veto_segments or event.get_end() not in veto_segments[event.ifo]), eventlist)
+		snglcoinc.apply_vetoes(eventlists, veto_segments)
 
 	#
 	# set the \Delta t parameter on all the event lists
@@ -26,6 +26,7 @@
 
 import bisect
 import math
+import numpy
 import sys
 
 
@@ -166,6 +167,7 @@ class InspiralCoincTables(snglcoinc.CoincTables):
 		self.seglists = ligolw_search_summary.segmentlistdict_fromsearchsummary(xmldoc, program = program).coalesce()
 		if vetoes is not None:
 			self.seglists -= vetoes
+		self.seglists_index = snglcoinc.SegmentIndex(self.seglists)
 
 	def append_coinc(self, process_id, time_slide_id, coinc_def_id, events, effective_snr_factor):
 		#
@@ -211,7 +213,7 @@ class InspiralCoincTables(snglcoinc.CoincTables):
 
 		tstart = coinc_inspiral.end
 		instruments = set(event.ifo for event in events)
-		instruments |= set(instrument for instrument, segs in self.seglists.items() if tstart - offsetvector[instrument] in segs)
+		instruments |= self.seglists_index.instruments_on(tstart.ns(), offsetvector)
 		coinc.set_instruments(instruments)
 
 		#
@@ -274,6 +276,61 @@ class InspiralEventList(snglcoinc.EventList):
 		LIGOTimeGPS.
 		"""
 		self.sort(lambda a, b: cmp(a.end_time, b.end_time) or cmp(a.end_time_ns, b.end_time_ns))
+		# integer nanosecond end times for the array-based pair
+		# search engine, and the columns needed by the batch
+		# comparison functions
+		for name, column in self._index_columns(self).items():
+			setattr(self, name, column)
+
+	@staticmethod
+	def _index_columns(events):
+		return {
+			"end_ns": numpy.fromiter((event.end_time * 1000000000 + event.end_time_ns for event in events), dtype = "int64", count = len(events)),
+			"tau0": numpy.fromiter((event.tau0 for event in events), dtype = "double", count = len(events)),
+			"tau3": numpy.fromiter((event.tau3 for event in events), dtype = "double", count = len(events)),
+			"mass1": numpy.fromiter((event.mass1 for event in events), dtype = "double", count = len(events)),
+			"mass2": numpy.fromiter((event.mass2 for event in events), dtype = "double", count = len(events)),
+			"Gamma": numpy.array([(event.Gamma0, event.Gamma1, event.Gamma2, event.Gamma3, event.Gamma4, event.Gamma5, event.Gamma6, event.Gamma7, event.Gamma8, event.Gamma9) for event in events], dtype = "double").reshape((len(events), 10))
+		}
+
+	def merge(self, events):
+		"""
+		Add events to a list that has been indexed with
+		make_index(), keeping it sorted and its index current.  Only
+		the new events are sorted;  they are then merged into the
+		list, so the cost is proportional to the number of new events
+		when they all follow the events already in the list.
+		"""
+		events = sorted(events, lambda a, b: cmp(a.end_time, b.end_time) or cmp(a.end_time_ns, b.end_time_ns))
+		if not events:
+			return
+		columns = self._index_columns(events)
+		positions = numpy.searchsorted(self.end_ns, columns["end_ns"], side = "right")
+		if positions[0] == len(self):
+			# the common case:  new events follow the old
+			self.extend(events)
+			for name, column in columns.items():
+				setattr(self, name, numpy.concatenate((getattr(self, name), column)))
+		else:
+			merged = []
+			last = 0
+			for position, event in zip(positions, events):
+				merged.extend(self[last:position])
+				merged.append(event)
+				last = position
+			merged.extend(self[last:])
+			self[:] = merged
+			for name, column in columns.items():
+				setattr(self, name, numpy.insert(getattr(self, name), positions, column, axis = 0))
+
+	def remove_oldest(self, n):
+		"""
+		Remove the n earliest events from a list that has been
+		indexed with make_index(), keeping its index current.
+		"""
+		del self[:n]
+		for name in ("end_ns", "tau0", "tau3", "mass1", "mass2", "Gamma"):
+			setattr(self, name, getattr(self, name)[n:])
 
 	def set_dt(self, dt):
 		"""
@@ -285,6 +342,12 @@ class InspiralEventList(snglcoinc.EventList):
 		# avoid doing type conversion in loops
 		self.dt = LIGOTimeGPS(dt * 1.01)
 
+	def get_times_ns(self):
+		return self.end_ns
+
+	def get_window_ns(self, light_travel_time, e_thinca_parameter):
+		return self.dt.ns()
+
 	def get_coincs(self, event_a, offset_a, light_travel_time, e_thinca_parameter, comparefunc):
 		#
 		# event_a's end time, with time shift applied
@@ -350,6 +413,37 @@ def inspiral_coinc_compare_exact(a, offseta, b, offsetb, light_travel_time, e_th
 	return (a.mass1 != b.mass1) or (a.mass2 != b.mass2) or inspiral_coinc_compare(a, offseta, b, offsetb, light_travel_time, e_thinca_parameter)
 
 
+def inspiral_coinc_compare_batch(eventlista, indexesa, offseta, eventlistb, indexesb, offsetb, light_travel_time, e_thinca_parameter):
+	"""
+	Batch version of inspiral_coinc_compare() for use with
+	snglcoinc.get_doubles_array().  Applies the ellipsoidal thinca
+	test to all candidate pairs (eventlista[indexesa[i]],
+	eventlistb[indexesb[i]]) in a single call into the C extension.
+	The time offsets are applied to copies of the end times so the
+	events themselves are not modified.  Returns a boolean array that
+	is False where the pair is coincident.
+	"""
+	return ~xlaltools.XLALCalculateEThincaParameterBatch(
+		eventlista.instrument, eventlista.end_ns[indexesa], eventlista.tau0[indexesa], eventlista.tau3[indexesa], eventlista.Gamma[indexesa], offseta.ns(),
+		eventlistb.instrument, eventlistb.end_ns[indexesb], eventlistb.tau0[indexesb], eventlistb.tau3[indexesb], eventlistb.Gamma[indexesb], offsetb.ns(),
+		e_thinca_parameter
+	)
+
+
+def inspiral_coinc_compare_exact_batch(eventlista, indexesa, offseta, eventlistb, indexesb, offsetb, light_travel_time, e_thinca_parameter):
+	"""
+	Batch version of inspiral_coinc_compare_exact() for use with
+	snglcoinc.get_doubles_array().  Returns a boolean array that is
+	False where the pair passes the ellipsoidal thinca test and the
+	test masses are equal.
+	"""
+	result = (eventlista.mass1[indexesa] != eventlistb.mass1[indexesb]) | (eventlista.mass2[indexesa] != eventlistb.mass2[indexesb])
+	# only pairs with equal masses need the e-thinca test
+	same = ~result
+	result[same] = inspiral_coinc_compare_batch(eventlista, indexesa[same], offseta, eventlistb, indexesb[same], offsetb, light_travel_time, e_thinca_parameter)
+	return result
+
+
 #
 # =============================================================================
 #
@@ -406,8 +500,24 @@ def ligolw_thinca(
 	likelihood_func = None,
 	likelihood_params_func = None,
 	verbose = False,
-	max_dt = None
+	max_dt = None,
+	event_batch_comparefunc = None,
+	nproc = 1
 ):
+	"""
+	Construct sngl_inspiral<-->sngl_inspiral coincidences in xmldoc.
+
+	If event_batch_comparefunc is not None the double coincidences
+	are found with the array-based pair search engine,
+	snglcoinc.get_doubles_array(), using event_batch_comparefunc as
+	the batch comparison function in place of event_comparefunc.  Use
+	snglcoinc.batched_comparefunc() to adapt a scalar comparison
+	function.
+
+	If nproc is greater than 1, the nodes of the time slide graph are
+	constructed using a pool of nproc worker processes.  See
+	snglcoinc.TimeSlideGraph.populate_parallel() for more information.
+	"""
 	#
 	# prepare the coincidence table interface.
 	#
@@ -426,8 +536,7 @@ def ligolw_thinca(
 
 	eventlists = snglcoinc.make_eventlists(xmldoc, InspiralEventList, lsctables.SnglInspiralTable.tableName)
 	if veto_segments is not None:
-		for eventlist in eventlists.values():
-			iterutils.inplace_filter((lambda event: event.ifo not in veto_segments or event.get_end() not in veto_segments[event.ifo]), eventlist)
+		snglcoinc.apply_vetoes(eventlists, veto_segments)
 
 	#
 	# set the \Delta t parameter on all the event lists
@@ -458,7 +567,13 @@ def ligolw_thinca(
 	# and record the survivors
 	#
 
-	for node, coinc in time_slide_graph.get_coincs(eventlists, event_comparefunc, thresholds, verbose = verbose):
+	if event_batch_comparefunc is not None:
+		event_comparefunc, doubles_func = event_batch_comparefunc, snglcoinc.get_doubles_array
+	else:
+		doubles_func = snglcoinc.get_doubles
+	# the graph is not used again, so let it free intermediate results
+	# as it goes
+	for node, coinc in time_slide_graph.get_coincs(eventlists, event_comparefunc, thresholds, verbose = verbose, doubles_func = doubles_func, nproc = nproc, stream = True):
 		coinc = tuple(sngl_index[event_id] for event_id in coinc)
 		if not ntuple_comparefunc(coinc, node.offset_vector):
 			coinc_tables.append_coinc(process_id, node.time_slide_id, coinc_def_id, coinc, effective_snr_factor)
@@ -476,6 +591,197 @@ def ligolw_thinca(
 	return xmldoc
 
 
+class StreamThinca(object):
+	"""
+	Incremental sngl_inspiral<-->sngl_inspiral coincidence engine for
+	use with streams of triggers.  Where ligolw_thinca() processes a
+	complete document in one pass, an instance of this class accepts
+	sngl_inspiral rows in chunks, keeps per-instrument sorted buffers
+	of the events that can still participate in coincidences, and
+	records in xmldoc only the coincs that have become final.  The
+	events within a chunk need not be sorted.
+
+	A coinc is final when no event that has yet to arrive can
+	participate in it or in any larger coinc that would use it, that
+	is once the earliest of its events is more than the coincidence
+	window (max_dt plus the largest spread of offsets in any offset
+	vector) behind the time up to which the input is complete.  Events
+	are retired from the buffers once they are more than a further
+	coincidence window behind that time.  With this scheme the coincs
+	recorded are the same as those ligolw_thinca() would construct
+	from the complete set of events, but the cost of each chunk is
+	proportional to the size of the chunk, not the history.
+
+	Because the full event history is not available, max_dt must be
+	provided (see inspiral_max_dt()).  The other arguments have the
+	same meaning as for ligolw_thinca().  xmldoc must contain the
+	time_slide table, and the sngl_inspiral rows passed to .add_events()
+	must be added to the document by the calling code.
+
+	Example:
+
+	>>> stream = StreamThinca(xmldoc, process_id, InspiralCoincDef, inspiral_coinc_compare, 0.5, max_dt)
+	>>> for events in chunks:
+	...	new_coincs = stream.add_events(events)
+	...
+	>>> new_coincs = stream.flush()
+	"""
+	def __init__(
+		self,
+		xmldoc,
+		process_id,
+		coinc_definer_row,
+		event_comparefunc,
+		thresholds,
+		max_dt,
+		ntuple_comparefunc = default_ntuple_comparefunc,
+		effective_snr_factor = 250.0,
+		veto_segments = None,
+		trigger_program = u"inspiral",
+		likelihood_func = None,
+		likelihood_params_func = None,
+		event_batch_comparefunc = None,
+		verbose = False
+	):
+		self.process_id = process_id
+		self.event_comparefunc = event_comparefunc
+		self.event_batch_comparefunc = event_batch_comparefunc
+		self.thresholds = thresholds
+		self.max_dt = max_dt
+		self.ntuple_comparefunc = ntuple_comparefunc
+		self.effective_snr_factor = effective_snr_factor
+		self.veto_index = snglcoinc.SegmentIndex(veto_segments) if veto_segments is not None else None
+		self.verbose = verbose
+
+		self.coinc_tables = InspiralCoincTables(xmldoc, vetoes = veto_segments, program = trigger_program, likelihood_func = likelihood_func, likelihood_params_func = likelihood_params_func)
+		self.coinc_def_id = ligolw_coincs.get_coinc_def_id(xmldoc, coinc_definer_row.search, coinc_definer_row.search_coinc_type, create_new = True, description = coinc_definer_row.description)
+
+		#
+		# the coincidence window in integer nanoseconds.  must
+		# match the padding applied by InspiralEventList.set_dt()
+		#
+
+		if not self.coinc_tables.time_slide_index:
+			raise ValueError("xmldoc's time_slide table is empty:  there are no offset vectors for which to construct coincs")
+		spread = max(max(offset_vector.values()) - min(offset_vector.values()) for offset_vector in self.coinc_tables.time_slide_index.values())
+		self.window = LIGOTimeGPS(max_dt * 1.01).ns() + LIGOTimeGPS(spread).ns() + 1
+
+		#
+		# the event buffers, and the time before which all coincs
+		# have been recorded (None = no coincs have been recorded)
+		#
+
+		self.eventlists = snglcoinc.EventListDict(InspiralEventList, [])
+		self.sngl_index = {}
+		self.boundary = None
+
+	def add_events(self, events, t_complete = None):
+		"""
+		Add a chunk of sngl_inspiral events to the buffers, record
+		the coincs that have become final, and retire events that
+		can no longer participate in a coinc.  t_complete is the
+		time up to which the input is complete for all instruments;
+		if None, the latest end time in the chunk is used, which
+		requires the chunks to be time-ordered across instruments.
+		Returns a list of the coinc_event rows that were added to
+		the document.
+		"""
+		events = list(events)
+		if self.veto_index is not None:
+			# test the whole chunk against each instrument's
+			# vetoes at once
+			end_ns = numpy.fromiter((event.end_time * 1000000000 + event.end_time_ns for event in events), dtype = "int64", count = len(events))
+			vetoed = numpy.zeros(len(events), dtype = "bool")
+			for instrument in set(event.ifo for event in events):
+				selected = numpy.fromiter((event.ifo == instrument for event in events), dtype = "bool", count = len(events))
+				vetoed[selected] = self.veto_index.contains(instrument, end_ns[selected])
+			events = [event for event, v in zip(events, vetoed) if not v]
+		new_events = {}
+		latest = None
+		for event in events:
+			new_events.setdefault(event.ifo, []).append(event)
+			self.sngl_index[event.event_id] = event
+			if latest is None or event.get_end() > latest:
+				latest = event.get_end()
+		for instrument, instrument_events in new_events.items():
+			if instrument not in self.eventlists:
+				self.eventlists[instrument] = InspiralEventList(instrument)
+				self.eventlists[instrument].set_dt(self.max_dt)
+				self.eventlists[instrument].make_index()
+			# only the new events need sorting
+			self.eventlists[instrument].merge(instrument_events)
+		if t_complete is None:
+			t_complete = latest
+			if t_complete is None:
+				return []
+		return self._run(LIGOTimeGPS(t_complete).ns() - self.window)
+
+	def flush(self):
+		"""
+		Record all remaining coincs and empty the buffers.  Call
+		this when the end of the stream has been reached.  Returns
+		a list of the coinc_event rows that were added to the
+		document.
+		"""
+		return self._run(None)
+
+	def _run(self, boundary):
+		"""
+		Record the coincs whose earliest event's end time, in
+		integer nanoseconds, is at or after the current boundary
+		and before the new one (None = +infinity), then advance
+		the boundary and retire old events.
+		"""
+		if boundary is not None and self.boundary is not None and boundary <= self.boundary:
+			return []
+
+		#
+		# construct the coincs from the buffered events.  the graph
+		# caches its results so a new one is required each time
+		#
+
+		new_coincs = []
+		if self.eventlists:
+			thresholds = replicate_threshold(self.thresholds, set(self.eventlists))
+			time_slide_graph = snglcoinc.TimeSlideGraph(self.coinc_tables.time_slide_index)
+			if self.event_batch_comparefunc is not None:
+				event_comparefunc, doubles_func = self.event_batch_comparefunc, snglcoinc.get_doubles_array
+			else:
+				event_comparefunc, doubles_func = self.event_comparefunc, snglcoinc.get_doubles
+			for node, coinc in time_slide_graph.get_coincs(self.eventlists, event_comparefunc, thresholds, doubles_func = doubles_func, stream = True):
+				coinc = tuple(self.sngl_index[event_id] for event_id in coinc)
+				t = min(event.end_time * 1000000000 + event.end_time_ns for event in coinc)
+				if (self.boundary is not None and t < self.boundary) or (boundary is not None and t >= boundary):
+					# recorded already or not yet final
+					continue
+				if not self.ntuple_comparefunc(coinc, node.offset_vector):
+					new_coincs.append(self.coinc_tables.append_coinc(self.process_id, node.time_slide_id, self.coinc_def_id, coinc, self.effective_snr_factor))
+			del self.eventlists.offsetvector
+
+		#
+		# advance the boundary and retire events that cannot
+		# participate in any coinc that has not been recorded, or
+		# in any larger coinc that might use one
+		#
+
+		self.boundary = boundary
+		for instrument, eventlist in self.eventlists.items():
+			if boundary is None:
+				n = len(eventlist)
+			else:
+				n = numpy.searchsorted(eventlist.end_ns, boundary - self.window)
+			if n:
+				for event in eventlist[:n]:
+					del self.sngl_index[event.event_id]
+				eventlist.remove_oldest(n)
+			if not eventlist:
+				del self.eventlists[instrument]
+		if self.verbose:
+			print >>sys.stderr, "recorded %d coincs, %d events buffered" % (len(new_coincs), len(self.sngl_index))
+
+		return new_coincs
+
+
 #
 # =============================================================================
 #
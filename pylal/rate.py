@@ -36,6 +36,8 @@ smoothing contour plots.
 
 
 from bisect import bisect_right
+import collections
+import cPickle as pickle
 try:
 	from fpconst import PosInf, NegInf
 except ImportError:
@@ -43,11 +45,15 @@ except ImportError:
 	# be available
 	PosInf = float("+inf")
 	NegInf = float("-inf")
+import hashlib
 import itertools
 import math
 import numpy
 import random
 import scipy
+import struct
+import threading
+import zipfile
 numpyver = numpy.__version__.strip().split(".")[:3]
 scipyver = scipy.__version__.strip().split(".")[:3]
 __numpy__version__ = tuple(map(int, numpyver))
@@ -85,6 +91,73 @@ __date__ = git_version.date
 #
 
 
+def _get_rng(rng):
+	"""
+	Convert the rng argument of the .randcoord_block() methods into a
+	numpy random number generator.  None means the generator backing
+	the numpy.random module-level functions, an integer is used to
+	seed a new generator (a numpy.random.Generator if this version of
+	numpy provides one, otherwise a numpy.random.RandomState), and
+	anything else is assumed to be a generator object and is returned
+	as-is.  Only the .uniform() method is used, which both generator
+	types provide.
+	"""
+	if rng is None:
+		return numpy.random.mtrand._rand
+	if isinstance(rng, (int, long, numpy.integer)):
+		try:
+			return numpy.random.default_rng(rng)
+		except AttributeError:
+			# numpy < 1.17
+			return numpy.random.RandomState(rng)
+	return rng
+
+
+def _randindex_block(lo, hi, n, size, rng):
+	"""
+	Vectorized version of glue.iterutils.randindex().  Returns a
+	two-element tuple of arrays of length size, the first containing
+	integers drawn from [lo, hi) from the distribution whose CDF goes
+	as [integer]^{n}, the second the natural logarithms of the
+	probabilities with which those integers were chosen.  rng is a
+	numpy random number generator.
+	"""
+	if not 0 <= lo < hi:
+		raise ValueError("require 0 <= lo < hi: lo = %d, hi = %d" % (lo, hi))
+	if n <= 0.:
+		raise ValueError("n <= 0: %g" % n)
+	elif n == 1.:
+		# special case for uniform distribution
+		try:
+			lnP = math.log(1. / (hi - lo))
+		except ValueError:
+			raise ValueError("[lo, hi) domain error")
+		index = numpy.floor(rng.uniform(lo, hi, size)).astype("intp")
+		# guard against round-off putting a sample on hi
+		numpy.clip(index, lo, hi - 1, out = index)
+		return index, numpy.repeat(lnP, size)
+
+	# CDF evaluated at index boundaries
+	lnP = numpy.arange(lo, hi + 1, dtype = "double")**n
+	lnP -= lnP[0]
+	lnP /= lnP[-1]
+	# differences give probabilities
+	lnP = numpy.log(lnP[1:] - lnP[:-1])
+	if numpy.isinf(lnP).any():
+		raise ValueError("[lo, hi) domain error")
+
+	beta = lo**n / (hi**n - lo**n)
+	n = 1. / n
+	alpha = hi / (1. + beta)**n
+	index = numpy.floor(alpha * (rng.uniform(0., 1., size) + beta)**n).astype("intp")
+	# randindex() asserts index >= lo and relies on the tuple
+	# look-up to catch index >= hi.  here we clip instead, which
+	# can only move samples that are at the edges of the range
+	# because of round-off
+	numpy.clip(index, lo, hi - 1, out = index)
+	return index, lnP[index - lo]
+
+
 class Bins(object):
 	"""
 	Parent class for 1-dimensional binnings.  This class is not
@@ -135,6 +208,12 @@ class Bins(object):
 		falls, and whose upper bound is 1 greater than the index of
 		the bin in which the slice's upper bound falls.  Steps are
 		not supported in slices.
+
+		The co-ordinate can also be a numpy array of values, in
+		which case an array of bin indexes of the same shape is
+		returned.  The rules are the same as for single values, in
+		particular IndexError is raised if any of the values is
+		outside the binning.
 		"""
 		if isinstance(x, slice):
 			if x.step is not None:
@@ -142,6 +221,26 @@ class Bins(object):
 			return slice(self[x.start] if x.start is not None else 0, self[x.stop] + 1 if x.stop is not None else len(self))
 		raise NotImplementedError
 
+	@staticmethod
+	def _check_array(x, valid):
+		"""
+		Raise IndexError reporting the first element of the array x
+		for which the boolean array valid is False.  Used by the
+		array code paths of the subclasses' .__getitem__() methods.
+		"""
+		if not valid.all():
+			raise IndexError(x[~valid].flat[0])
+
+	def _valid(self, x):
+		"""
+		Return a boolean array that is True where the elements of
+		the array x lie inside the binning, i.e. where the array
+		code path of .__getitem__() would not raise IndexError.
+		NaN is never inside the binning.
+		"""
+		with numpy.errstate(invalid = "ignore"):
+			return (self.min <= x) & (x <= self.max)
+
 	def __iter__(self):
 		"""
 		If __iter__ does not exist, Python uses __getitem__ with
@@ -221,13 +320,34 @@ class Bins(object):
 			...
 		NotImplementedError: step not supported: slice(None, None, 2)
 		"""
+		# avoid symbol look-ups in the sampling loop
+		uniform = random.uniform
+		l, u, ln_dx, lo, hi = self._randcoord_bounds(domain)
+		# converting everything to tuples makes the sampling loop
+		# faster
+		l = tuple(l)
+		u = tuple(u)
+		ln_dx = tuple(ln_dx)
+		# generate samples
+		for i, ln_Pi in iterutils.randindex(lo, hi, n = n):
+			yield uniform(l[i], u[i]), ln_Pi - ln_dx[i]
+
+	def _randcoord_bounds(self, domain):
+		"""
+		Compute the bin boundaries and the range of bin indexes
+		from which .randcoord() and .randcoord_block() draw values,
+		after applying the domain clipping rules described in
+		.randcoord().  Returns the tuple (l, u, ln_dx, lo, hi) where
+		l and u are arrays of the (adjusted) lower and upper bin
+		boundaries, ln_dx is an array of the natural logarithms of
+		the (adjusted) bin sizes, and bins are to be drawn from the
+		index range [lo, hi).
+		"""
 		if len(self) < 1:
 			raise ValueError("empty binning")
 		if domain.step is not None:
 			raise NotImplementedError("step not supported: %s" % repr(domain))
-		# avoid symbol look-ups in the sampling loop
 		isinf = math.isinf
-		uniform = random.uniform
 		# determine boundaries and index range
 		l = self.lower()
 		u = self.upper()
@@ -245,17 +365,46 @@ class Bins(object):
 		if not lo < hi:
 			raise ValueError("slice too small")
 		# log() implicitly checks that the boundary adjustments
-		# above haven't made any bins <= 0 in size.  converting
-		# everything to tuples makes the sampling loop faster
-		ln_dx = tuple(numpy.log(u - l))
-		l = tuple(l)
-		u = tuple(u)
+		# above haven't made any bins <= 0 in size
+		ln_dx = numpy.log(u - l)
 		# one last safety check
-		if any(map(isinf, ln_dx[lo:hi])):
+		if numpy.isinf(ln_dx[lo:hi]).any():
 			raise ValueError("unavoidable infinite bin detected")
-		# generate samples
-		for i, ln_Pi in iterutils.randindex(lo, hi, n = n):
-			yield uniform(l[i], u[i]), ln_Pi - ln_dx[i]
+		return l, u, ln_dx, lo, hi
+
+	def randcoord_block(self, size, n = 1., domain = slice(None, None), rng = None):
+		"""
+		Draw size random co-ordinates at once.  Returns a
+		two-element tuple of arrays, the first containing the
+		co-ordinates and the second the natural logarithm of the
+		PDF from which they have been drawn evaluated at each of
+		them.  The co-ordinates are drawn from the same
+		distribution as those yielded by .randcoord(), with the
+		same meanings for n and domain, but the bin indexes and
+		co-ordinates are generated with vectorized numpy
+		operations.  rng is None to use the generator backing the
+		numpy.random module-level functions, an integer with which
+		to seed a new numpy generator, or a numpy.random.Generator
+		or numpy.random.RandomState instance.
+
+		Example:
+
+		>>> x, lnP = LinearBins(0, 10, 5).randcoord_block(4, rng = 1)
+		>>> len(x), ((0. <= x) & (x <= 10.)).all()
+		(4, True)
+		>>> numpy.allclose(lnP, math.log(1./10))
+		True
+		>>> # same domain as in the .randcoord() example
+		>>> x, lnP = ATanBins(-1, +1, 4).randcoord_block(1000, domain = slice(0.5, None), rng = 1)
+		>>> ((0.5 <= x) & (x <= 0.6366)).all()
+		True
+		>>> print "%.15g" % lnP[0]
+		1.99055359585182
+		"""
+		rng = _get_rng(rng)
+		l, u, ln_dx, lo, hi = self._randcoord_bounds(domain)
+		index, lnP = _randindex_block(lo, hi, n, size, rng)
+		return rng.uniform(l[index], u[index]), lnP - ln_dx[index]
 
 
 class IrregularBins(Bins):
@@ -317,6 +466,9 @@ class IrregularBins(Bins):
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(IrregularBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			self._check_array(x, self._valid(x))
+			return numpy.minimum(numpy.searchsorted(self.boundaries, x, side = "right") - 1, len(self.boundaries) - 2)
 		if self.min <= x < self.max:
 			return bisect_right(self.boundaries, x) - 1
 		# special measure-zero edge case
@@ -379,6 +531,9 @@ class LinearBins(Bins):
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(LinearBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			self._check_array(x, self._valid(x))
+			return numpy.where(x < self.max, numpy.floor((x - self.min) / self.delta), len(self) - 1).astype(int)
 		if self.min <= x < self.max:
 			return int(math.floor((x - self.min) / self.delta))
 		if x == self.max:
@@ -440,9 +595,17 @@ class LinearPlusOverflowBins(Bins):
 		super(LinearPlusOverflowBins, self).__init__(min, max, n)
 		self.delta = float(max - min) / (n - 2)
 
+	def _valid(self, x):
+		# NaNs are the only values that fall outside the binning
+		return x == x
+
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(LinearPlusOverflowBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			self._check_array(x, self._valid(x))
+			with numpy.errstate(invalid = "ignore"):
+				return numpy.where(x < self.min, 0, numpy.where(x >= self.max, len(self) - 1, numpy.floor((x - self.min) / self.delta) + 1)).astype(int)
 		if self.min <= x < self.max:
 			return int(math.floor((x - self.min) / self.delta)) + 1
 		if x >= self.max:
@@ -487,6 +650,9 @@ class LogarithmicBins(Bins):
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(LogarithmicBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			self._check_array(x, self._valid(x))
+			return numpy.where(x < self.max, numpy.floor((numpy.log(x) - math.log(self.min)) / self.delta), len(self) - 1).astype(int)
 		if self.min <= x < self.max:
 			return int(math.floor((math.log(x) - math.log(self.min)) / self.delta))
 		if x == self.max:
@@ -542,9 +708,17 @@ class LogarithmicPlusOverflowBins(Bins):
 		super(LogarithmicPlusOverflowBins, self).__init__(min, max, n)
 		self.delta = (math.log(max) - math.log(min)) / (n - 2)
 
+	def _valid(self, x):
+		# NaNs are the only values that fall outside the binning
+		return x == x
+
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(LogarithmicPlusOverflowBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			self._check_array(x, self._valid(x))
+			with numpy.errstate(divide = "ignore", invalid = "ignore"):
+				return numpy.where(x < self.min, 0, numpy.where(x >= self.max, len(self) - 1, numpy.floor((numpy.log(x) - math.log(self.min)) / self.delta) + 1)).astype(int)
 		if self.min <= x < self.max:
 			return 1 + int(math.floor((math.log(x) - math.log(self.min)) / self.delta))
 		if x >= self.max:
@@ -595,9 +769,16 @@ class ATanBins(Bins):
 		self.scale = math.pi / float(max - min)
 		self.delta = 1.0 / n
 
+	def _valid(self, x):
+		# every value, even NaN, is mapped to a bin
+		return numpy.ones(x.shape, dtype = bool)
+
 	def __getitem__(self, x):
 		if isinstance(x, slice):
 			return super(ATanBins, self).__getitem__(x)
+		if isinstance(x, numpy.ndarray):
+			x = numpy.arctan((x - self.mid) * self.scale) / math.pi + 0.5
+			return numpy.where(x < 1., numpy.floor(x / self.delta), len(self) - 1).astype(int)
 		# map to the domain [0, 1]
 		x = math.atan(float(x - self.mid) * self.scale) / math.pi + 0.5
 		if x < 1.:
@@ -742,13 +923,19 @@ class Categories(Bins):
 		"""
 		Return i if value is contained in i-th container. If value
 		is not contained in any of the containers, raise an
-		IndexError.
+		IndexError.  If value is a numpy array, an array of the
+		indexes of its elements is returned.
 		"""
+		if isinstance(value, numpy.ndarray):
+			return numpy.array([self[v] for v in value.flat], dtype = int).reshape(value.shape)
 		for i, s in enumerate(self.containers):
 			if value in s:
 				return i
 		raise IndexError(value)
 
+	def _valid(self, value):
+		return numpy.array([any(v in s for s in self.containers) for v in value.flat], dtype = bool).reshape(value.shape)
+
 	def __cmp__(self, other):
 		if not isinstance(other, type(self)):
 			return -1
@@ -818,6 +1005,16 @@ class NDBins(tuple):
 		will accept.  Note that the co-ordinates to be converted
 		must be a tuple, even if it is only a 1-dimensional
 		co-ordinate.
+
+		In particular, each co-ordinate can be an array, in which
+		case the result is a tuple of index arrays suitable for
+		indexing an array with the shape of the binning.
+
+		>>> i = x[numpy.array([1., 10., 25.]), numpy.array([1., 5., 5.])]
+		>>> [a.tolist() for a in i]
+		[[0, 1, 2], [0, 1, 1]]
+		>>> numpy.arange(9).reshape(x.shape)[i].tolist()
+		[0, 4, 7]
 		"""
 		if isinstance(coords, tuple):
 			if len(coords) != len(self):
@@ -909,6 +1106,51 @@ class NDBins(tuple):
 			seq = sum((coordgen() for coordgen in coordgens), ())
 			yield seq[0::2], sum(seq[1::2])
 
+	def randcoord_block(self, size, ns = None, domain = None, rng = None):
+		"""
+		Draw size random co-ordinates at once.  Returns a
+		two-element tuple, the first element of which is a tuple of
+		arrays, one for each dimension, containing the
+		co-ordinates, and the second of which is an array of the
+		natural logarithms of the PDF from which they have been
+		drawn evaluated at each co-ordinate.  The co-ordinates are
+		drawn from the same distribution as those yielded by
+		.randcoord(), with the same meanings for ns and domain.
+		The co-ordinate arrays are in the form accepted by
+		.__getitem__() and BinnedArray.fill().  For the meaning of
+		rng, see Bins.randcoord_block().
+
+		Example:
+
+		>>> binning = NDBins((LinearBins(0, 10, 5), LinearBins(0, 10, 5)))
+		>>> coords, lnP = binning.randcoord_block(3, rng = 1)
+		>>> len(coords), len(coords[0]), numpy.allclose(lnP, -4.6051701859880909)
+		(2, 3, True)
+		>>> len(binning[coords][0])
+		3
+		"""
+		if ns is None:
+			ns = (1.,) * len(self)
+		if domain is None:
+			domain = (slice(None, None),) * len(self)
+		rng = _get_rng(rng)
+		coords, lnPs = zip(*(binning.randcoord_block(size, n = n, domain = d, rng = rng) for binning, n, d in zip(self, ns, domain)))
+		return coords, sum(lnPs)
+
+	#
+	# names used for the binnings in serializations
+	#
+
+	bins_type_names = {
+		LinearBins: "lin",
+		LinearPlusOverflowBins: "linplusoverflow",
+		LogarithmicBins: "log",
+		ATanBins: "atan",
+		ATanLogarithmicBins: "atanlog",
+		LogarithmicPlusOverflowBins: "logplusoverflow"
+	}
+	bins_types = dict((name, bins_type) for bins_type, name in bins_type_names.items())
+
 	class BinsTable(ligolw_table.Table):
 		"""
 		LIGO Light Weight XML table defining a binning.
@@ -931,14 +1173,7 @@ class NDBins(tuple):
 		for order, binning in enumerate(self):
 			row = xml.RowType()
 			row.order = order
-			row.type = {
-				LinearBins: "lin",
-				LinearPlusOverflowBins: "linplusoverflow",
-				LogarithmicBins: "log",
-				ATanBins: "atan",
-				ATanLogarithmicBins: "atanlog",
-				LogarithmicPlusOverflowBins: "logplusoverflow"
-			}[type(binning)]
+			row.type = self.bins_type_names[type(binning)]
 			if isinstance(binning, ATanLogarithmicBins):
 				row.min = binning._real_min
 				row.max = binning._real_max
@@ -962,18 +1197,61 @@ class NDBins(tuple):
 		for row in xml:
 			if binnings[row.order] is not None:
 				raise ValueError("duplicate binning for dimension %d" % row.order)
-			binnings[row.order] = {
-				"lin": LinearBins,
-				"linplusoverflow": LinearPlusOverflowBins,
-				"log": LogarithmicBins,
-				"atan": ATanBins,
-				"atanlog": ATanLogarithmicBins,
-				"logplusoverflow": LogarithmicPlusOverflowBins
-			}[row.type](row.min, row.max, row.n)
+			binnings[row.order] = cls.bins_types[row.type](row.min, row.max, row.n)
 		if None in binnings:
 			raise ValueError("no binning for dimension %d" % binnings.find(None))
 		return cls(binnings)
 
+	def to_arrays(self, prefix):
+		"""
+		Construct a dictionary of arrays describing the NDBins
+		instance, suitable for save_arrays().  The names of the
+		arrays all begin with prefix.  In addition to the binnings
+		that can be described by .to_xml(), IrregularBins and
+		Categories are supported.  The containers defining the
+		categories of a Categories binning are pickled, so they
+		must be picklable.
+		"""
+		arrays = {u"%s/n" % prefix: numpy.array(len(self))}
+		for order, binning in enumerate(self):
+			key = u"%s/%d" % (prefix, order)
+			if type(binning) is IrregularBins:
+				arrays[u"%s/type" % key] = numpy.array(u"irregular")
+				arrays[u"%s/boundaries" % key] = binning.boundaries
+			elif type(binning) is Categories:
+				arrays[u"%s/type" % key] = numpy.array(u"categories")
+				arrays[u"%s/containers" % key] = numpy.frombuffer(pickle.dumps(binning.containers, pickle.HIGHEST_PROTOCOL), dtype = numpy.uint8)
+			else:
+				arrays[u"%s/type" % key] = numpy.array(unicode(self.bins_type_names[type(binning)]))
+				if isinstance(binning, ATanLogarithmicBins):
+					arrays[u"%s/params" % key] = numpy.array((binning._real_min, binning._real_max, binning._real_n), dtype = "double")
+				else:
+					arrays[u"%s/params" % key] = numpy.array((binning.min, binning.max, len(binning)), dtype = "double")
+		return arrays
+
+	@classmethod
+	def from_arrays(cls, arrays, prefix):
+		"""
+		Construct and return a rate.NDBins object from the arrays
+		whose names begin with prefix in the dictionary arrays (see
+		.to_arrays()).
+
+		NOTE:  Categories binnings are unpickled.  Only load data
+		from trusted sources.
+		"""
+		binnings = []
+		for order in range(int(arrays[u"%s/n" % prefix])):
+			key = u"%s/%d" % (prefix, order)
+			binning_type = unicode(arrays[u"%s/type" % key][()])
+			if binning_type == u"irregular":
+				binnings.append(IrregularBins(numpy.array(arrays[u"%s/boundaries" % key])))
+			elif binning_type == u"categories":
+				binnings.append(Categories(pickle.loads(numpy.array(arrays[u"%s/containers" % key]).tostring())))
+			else:
+				bmin, bmax, n = arrays[u"%s/params" % key]
+				binnings.append(cls.bins_types[str(binning_type)](bmin, bmax, int(n)))
+		return cls(binnings)
+
 
 #
 # =============================================================================
@@ -1011,17 +1289,72 @@ def bins_spanned(bins, seglist, dtype = "double"):
 	        0.   ,  0.   ,  0.   ,  0.   ,  0.   ,  0.   ,  0.   ,  0.   ,
 	        0.   ,  0.   ,  0.   ,  0.   ])
 	"""
-	lower = bins.lower()
-	upper = bins.upper()
-	# make an intersection of the segment list with the extend of the bins
-	# need to use lower/upper instead of min/max because the latter sometimes
-	# merely correspond to low and high parameters used to construct the binning
-	# (see, for example, the atan binning)
-	seglist = seglist & segments.segmentlist([segments.segment(lower[0], upper[-1])])
-	array = numpy.zeros((len(bins),), dtype = dtype)
-	for i, (a, b) in enumerate(zip(lower, upper)):
-		array[i] = abs(seglist & segments.segmentlist([segments.segment(a, b)]))
-	return array
+	return bins_spanned_batch((bins,), seglist, dtype = dtype)[0]
+
+
+def bins_spanned_batch(binnings, seglist, dtype = "double"):
+	"""
+	Input is a sequence of Bins subclass instances and a
+	glue.segments.segmentlist instance.  The output is a list of
+	arrays, one for each binning, as would be returned by
+	bins_spanned() for that binning.  The segment list is sorted and
+	summed only once, so this is faster than calling bins_spanned()
+	repeatedly when several binnings are to be filled from the same
+	segments.
+
+	Example:
+
+	>>> from glue.segments import *
+	>>> s = segmentlist([segment(1.5, 10.333), segment(15.8, 24)])
+	>>> a, b = bins_spanned_batch((LinearBins(0, 30, 3), IrregularBins([0, 2, 16, 30])), s)
+	>>> numpy.around(a, 6).tolist()
+	[8.5, 4.533, 4.0]
+	>>> numpy.around(b, 6).tolist()
+	[0.5, 8.533, 8.0]
+	"""
+	lowers = [binning.lower() for binning in binnings]
+	uppers = [binning.upper() for binning in binnings]
+
+	# make an intersection of the segment list with the extent of the
+	# bins.  need to use lower/upper instead of min/max because the
+	# latter sometimes merely correspond to low and high parameters
+	# used to construct the binning (see, for example, the atan
+	# binning)
+	lo = min(lower[0] for lower in lowers)
+	hi = max(upper[-1] for upper in uppers)
+	seglist = (seglist & segments.segmentlist([segments.segment(lo, hi)])).coalesce()
+
+	if not seglist:
+		return [numpy.zeros((len(binning),), dtype = dtype) for binning in binnings]
+
+	# the livetime up to time t is the sum of the durations of the
+	# segments that start before t minus the part of the last of them
+	# that extends beyond t.  the livetime in a bin is then the
+	# difference of this function at the bin's upper and lower
+	# boundaries.  infinite segment boundaries are clipped to finite
+	# values below and above everything else so that the cumulative
+	# sum remains finite, and are restored at the end.
+	starts = numpy.array([float(seg[0]) for seg in seglist])
+	stops = numpy.array([float(seg[1]) for seg in seglist])
+	finite = numpy.concatenate([starts, stops] + lowers + uppers)
+	finite = finite[numpy.isfinite(finite)]
+	t_lo, t_hi = finite.min() - 1., finite.max() + 1.
+	neg_inf, pos_inf = math.isinf(starts[0]), math.isinf(stops[-1])
+	starts[0] = max(starts[0], t_lo)
+	stops[-1] = min(stops[-1], t_hi)
+	cumlive = numpy.concatenate(([0.], numpy.cumsum(stops - starts)))
+	stops = numpy.concatenate(([NegInf], stops))
+	def livetime(t):
+		live = numpy.clip(t, t_lo, t_hi)
+		n = numpy.searchsorted(starts, live, side = "right")
+		live = numpy.where(n > 0, cumlive[n] - numpy.clip(stops[n] - live, 0., PosInf), 0.)
+		if neg_inf:
+			live[t == NegInf] = NegInf
+		if pos_inf:
+			live[t == PosInf] = PosInf
+		return live
+
+	return [numpy.clip(livetime(upper) - livetime(lower), 0., PosInf).astype(dtype) for lower, upper in zip(lowers, uppers)]
 
 
 #
@@ -1033,6 +1366,31 @@ def bins_spanned(bins, seglist, dtype = "double"):
 #
 
 
+def _fill_index(bins, coords, weights, skip_out_of_range):
+	"""
+	Compute the flattened array indexes of the bins in the NDBins
+	object bins containing the co-ordinates in coords, for the
+	.fill() methods of BinnedArray and SparseBinnedArray.  Returns the
+	array of indexes and the array of weights, from which the weights
+	of out-of-range points have been removed if skip_out_of_range is
+	True.  For internal use.
+	"""
+	if len(coords) != len(bins):
+		raise ValueError("dimension mismatch")
+	coords = tuple(numpy.asarray(c) for c in coords)
+	if weights is not None:
+		weights = numpy.asarray(weights, dtype = "double")
+	if skip_out_of_range:
+		keep = numpy.ones(len(coords[0]), dtype = bool)
+		for binning, c in zip(bins, coords):
+			keep &= binning._valid(c)
+		if not keep.all():
+			coords = tuple(c[keep] for c in coords)
+			if weights is not None:
+				weights = weights[keep]
+	return numpy.ravel_multi_index(bins[coords], bins.shape), weights
+
+
 class BinnedArray(object):
 	"""
 	A convenience wrapper, using the NDBins class to provide access to
@@ -1098,6 +1456,40 @@ class BinnedArray(object):
 	def __len__(self):
 		return len(self.array)
 
+	def fill(self, coords, weights = None, skip_out_of_range = False):
+		"""
+		Add weights to the bins containing the co-ordinates in
+		coords.  coords is a sequence of arrays, one for each
+		dimension, giving the co-ordinates of a set of points.
+		weights is an array of the weights to add for each point,
+		or None (the default) to add 1 for each point.  The result
+		is the same as incrementing the bins one at a time, but the
+		work is done with a single vectorized bin look-up and
+		numpy.bincount().
+
+		If skip_out_of_range is False (the default), IndexError is
+		raised if any of the co-ordinates is outside the binning,
+		and no bins are modified.  If it is True, those points are
+		ignored.
+
+		Example:
+
+		>>> x = BinnedArray(NDBins((LinearBins(0, 10, 5),)))
+		>>> x.fill((numpy.array([0., 0.5, 3., 10.]),))
+		>>> x.array.tolist()
+		[2.0, 1.0, 0.0, 0.0, 1.0]
+		>>> x.fill((numpy.array([1., 20.]),), weights = numpy.array([0.5, 3.]), skip_out_of_range = True)
+		>>> x.array.tolist()
+		[2.5, 1.0, 0.0, 0.0, 1.0]
+		>>> x.fill((numpy.array([float("nan"), -1., 9.]),), skip_out_of_range = True)
+		>>> x.array.tolist()
+		[2.5, 1.0, 0.0, 0.0, 2.0]
+		"""
+		index, weights = _fill_index(self.bins, coords, weights, skip_out_of_range)
+		if not len(index):
+			return
+		self.array += numpy.bincount(index, weights = weights, minlength = self.array.size).reshape(self.array.shape)
+
 	def __iadd__(self, other):
 		"""
 		Add the contents of another BinnedArray object to this one.
@@ -1203,13 +1595,327 @@ class BinnedArray(object):
 		self.array = ligolw_array.get_array(xml, u"array").array
 		return self
 
+	def to_arrays(self, name):
+		"""
+		Return a dictionary of arrays describing a
+		rate.BinnedArray object, suitable for save_arrays().  This
+		is the binary counterpart of .to_xml().
+		"""
+		prefix = u"%s:pylal_rate_binnedarray" % name
+		arrays = self.bins.to_arrays(u"%s/bins" % prefix)
+		arrays[u"%s/array" % prefix] = self.array
+		return arrays
+
+	@classmethod
+	def from_arrays(cls, arrays, name):
+		"""
+		Construct and return a new rate.BinnedArray object from the
+		arrays describing the BinnedArray named "name" in the
+		dictionary arrays, as returned by load_arrays().  This is
+		the binary counterpart of .from_xml().
+
+		NOTE:  the .array attribute is the array from the
+		dictionary.  If the dictionary was loaded with mmap = True
+		it is a copy-on-write memory map of the file, and is only
+		read from disk as it is used.
+
+		Example:
+
+		>>> import tempfile
+		>>> x = BinnedArray(NDBins((IrregularBins([0., 1., 10.]), Categories([set(("H1",)), set(("L1",))]))))
+		>>> x[5., "L1"] = 3.
+		>>> f = tempfile.NamedTemporaryFile(suffix = ".npz")
+		>>> save_arrays(f, x.to_arrays(u"x"))
+		>>> f.flush()
+		>>> y = BinnedArray.from_arrays(load_arrays(f.name, mmap = True), u"x")
+		>>> y.bins == x.bins, y.array.tolist()
+		(True, [[0.0, 0.0], [0.0, 3.0]])
+		"""
+		prefix = u"%s:pylal_rate_binnedarray" % name
+		# see .from_xml() for why an empty binning is used
+		self = cls(NDBins())
+		self.bins = NDBins.from_arrays(arrays, u"%s/bins" % prefix)
+		self.array = arrays[u"%s/array" % prefix]
+		return self
+
+
+def _coalesce(indices, values):
+	"""
+	Sort the flattened array indexes, summing the values of duplicate
+	indexes and discarding zeros.  Returns the new arrays of indexes
+	and values.  For internal use by SparseBinnedArray.
+	"""
+	indices, inverse = numpy.unique(indices, return_inverse = True)
+	values = numpy.bincount(inverse, weights = values, minlength = len(indices))
+	keep = values != 0.
+	return indices[keep], values[keep]
+
+
+class SparseBinnedArray(object):
+	"""
+	A BinnedArray whose contents are stored sparsely, for
+	high-dimensional binnings most of whose bins are empty.  Only the
+	non-zero bins are stored, as a sorted array of their flattened
+	(C-order) indexes, the .indices attribute, and a corresponding
+	array of their values, the .values attribute.  No array with the
+	full shape of the binning is ever allocated, except by
+	.to_dense().
+
+	Example:
+
+	>>> x = SparseBinnedArray(NDBins((LinearBins(0, 10, 5), LinearBins(0, 10, 5))))
+	>>> x[1, 1] += 1
+	>>> x[9, 1] = 2
+	>>> x.fill((numpy.array([1., 9.]), numpy.array([1., 9.])))
+	>>> x.indices.tolist(), x.values.tolist()
+	([0, 20, 24], [2.0, 2.0, 1.0])
+	>>> x[1, 1], x[1, 9]
+	(2.0, 0.0)
+	>>> x.to_dense().array.sum()
+	5.0
+
+	Slices, filtering, marginalization and addition give the same
+	results as for the dense array:
+
+	>>> bins = NDBins((LinearBins(0, 10, 40), LinearBins(0, 10, 30)))
+	>>> dense = BinnedArray(bins)
+	>>> dense.array[3, 4] = 2.
+	>>> dense.array[30, 20] = 1.
+	>>> dense.array[31, 29] = 5.
+	>>> sparse = SparseBinnedArray.from_dense(dense)
+	>>> (sparse[1., :] == dense[1., :]).all(), sparse[:, 7.].shape, (sparse[2.:8., :5.] == dense[2.:8., :5.]).all()
+	(True, (40,), True)
+	>>> window = gaussian_window(2, 3, sigma = 3)
+	>>> numpy.allclose(filter_array(sparse.copy(), window).to_dense().array, filter_array(dense.array.copy(), window))
+	True
+	>>> numpy.allclose(marginalize(sparse, 1).to_dense().array, marginalize(dense, 1).array)
+	True
+	>>> numpy.allclose(marginalize(marginalize(sparse, 1), 0).to_dense().array, marginalize(marginalize(dense, 1), 0).array)
+	True
+	>>> other = BinnedArray(bins)
+	>>> other.array[3, 4] = 1.
+	>>> other.array[10, 10] = 7.
+	>>> sparse += SparseBinnedArray.from_dense(other)
+	>>> dense += other
+	>>> (sparse.to_dense().array == dense.array).all()
+	True
+	>>> coarse = SparseBinnedArray(NDBins((LinearBins(0, 10, 20), LinearBins(0, 10, 15))))
+	>>> coarse_dense = coarse.to_dense()
+	>>> coarse += sparse
+	>>> coarse_dense += dense
+	>>> (coarse.to_dense().array == coarse_dense.array).all()
+	True
+	"""
+	def __init__(self, bins, dtype = "double"):
+		self.bins = bins
+		self.indices = numpy.zeros((0,), dtype = "intp")
+		self.values = numpy.zeros((0,), dtype = dtype)
+
+	@property
+	def shape(self):
+		return self.bins.shape
+
+	def __len__(self):
+		return self.shape[0]
+
+	def _find(self, index):
+		"""
+		Return the positions in .indices at which the flattened
+		indexes index are or would be, and a boolean array
+		indicating which are present.  For internal use.
+		"""
+		pos = numpy.searchsorted(self.indices, index)
+		present = pos < len(self.indices)
+		present[present] = self.indices[pos[present]] == numpy.asarray(index)[present]
+		return pos, present
+
+	def _get(self, index):
+		"""
+		Return an array of the values of the bins whose flattened
+		indexes are in the array index.  For internal use.
+		"""
+		pos, present = self._find(numpy.atleast_1d(index).ravel())
+		result = numpy.zeros(pos.shape, dtype = self.values.dtype)
+		result[present] = self.values[pos[present]]
+		return result.reshape(numpy.shape(index))
+
+	def __getitem__(self, coords):
+		index = self.bins[coords]
+		if any(isinstance(i, slice) for i in index):
+			# a region of the array.  as for numpy arrays, a
+			# dense array is returned, without the dimensions
+			# given by single co-ordinates
+			ranges = tuple(numpy.arange(*i.indices(n)) if isinstance(i, slice) else numpy.array([i]) for i, n in zip(index, self.shape))
+			shape = tuple(len(r) for r, i in zip(ranges, index) if isinstance(i, slice))
+			return self._get(numpy.ravel_multi_index(numpy.ix_(*ranges), self.shape)).reshape(shape)
+		index = numpy.ravel_multi_index(index, self.shape)
+		if numpy.ndim(index) == 0:
+			return self._get(index)[()]
+		return self._get(index)
+
+	def __setitem__(self, coords, val):
+		index = numpy.atleast_1d(numpy.ravel_multi_index(self.bins[coords], self.shape)).ravel()
+		val = numpy.broadcast_to(numpy.asarray(val, dtype = self.values.dtype), index.shape)
+		# as for numpy arrays, the last assignment to a bin wins
+		index, last = numpy.unique(index[::-1], return_index = True)
+		val = val[::-1][last]
+		keep = ~numpy.in1d(self.indices, index)
+		self.indices, self.values = _coalesce(numpy.concatenate((self.indices[keep], index)), numpy.concatenate((self.values[keep], val)))
+
+	def fill(self, coords, weights = None, skip_out_of_range = False):
+		"""
+		Add weights to the bins containing the co-ordinates in
+		coords.  See BinnedArray.fill() for more information.
+		"""
+		index, weights = _fill_index(self.bins, coords, weights, skip_out_of_range)
+		if weights is None:
+			weights = numpy.ones(len(index), dtype = self.values.dtype)
+		self.indices, self.values = _coalesce(numpy.concatenate((self.indices, index)), numpy.concatenate((self.values, weights)))
+
+	def __iadd__(self, other):
+		"""
+		Add the contents of another SparseBinnedArray or
+		BinnedArray object to this one.  As for BinnedArray, the
+		binnings need not be identical, but an integer number of
+		the bins in other must fit into each bin in self.
+		"""
+		if isinstance(other, BinnedArray):
+			other = type(self).from_dense(other)
+		# identical binning? (fast path)
+		if not cmp(self.bins, other.bins):
+			index = other.indices
+		else:
+			# can other's bins be put into ours?
+			if self.bins.min != other.bins.min or self.bins.max != other.bins.max or False in map(lambda a, b: (b % a) == 0, self.bins.shape, other.bins.shape):
+				raise TypeError("incompatible binning: %s" % repr(other))
+			coords = tuple(centres[i] for centres, i in zip(other.bins.centres(), numpy.unravel_index(other.indices, other.shape)))
+			index = numpy.ravel_multi_index(self.bins[coords], self.shape)
+		self.indices, self.values = _coalesce(numpy.concatenate((self.indices, index)), numpy.concatenate((self.values, other.values)))
+		return self
+
+	def copy(self):
+		"""
+		Return a copy of the SparseBinnedArray.  The .bins
+		attribute is shared with the original.
+		"""
+		new = type(self)(self.bins)
+		new.indices = self.indices.copy()
+		new.values = self.values.copy()
+		return new
+
+	def centres(self):
+		"""
+		Return a tuple of arrays containing the bin centres for
+		each dimension.
+		"""
+		return self.bins.centres()
+
+	def volumes(self):
+		"""
+		Return an array of the volumes of the non-zero bins, in the
+		same order as .values.
+		"""
+		result = numpy.ones(len(self.indices), dtype = "double")
+		for binning, index in zip(self.bins, numpy.unravel_index(self.indices, self.shape)):
+			result *= (binning.upper() - binning.lower())[index]
+		return result
+
+	def to_density(self):
+		"""
+		Divide each bin's value by the volume of the bin.
+		"""
+		self.values /= self.volumes()
+
+	def to_pdf(self):
+		"""
+		Convert into a probability density.
+		"""
+		self.values /= self.values.sum()	# make sum = 1
+		self.to_density()	# make integral = 1
+
+	def to_dense(self):
+		"""
+		Return a BinnedArray containing the same data.  The .bins
+		attribute is shared with the original.
+		"""
+		new = BinnedArray(self.bins, dtype = self.values.dtype)
+		new.array.flat[self.indices] = self.values
+		return new
+
+	@classmethod
+	def from_dense(cls, binnedarray):
+		"""
+		Construct and return a SparseBinnedArray containing the
+		same data as the BinnedArray binnedarray.  The .bins
+		attribute is shared with the original.
+		"""
+		self = cls(binnedarray.bins, dtype = binnedarray.array.dtype)
+		self.indices = numpy.flatnonzero(binnedarray.array)
+		self.values = binnedarray.array.flat[self.indices]
+		return self
+
+	def to_xml(self, name):
+		"""
+		Return an XML document tree describing a
+		rate.SparseBinnedArray object.
+		"""
+		xml = ligolw.LIGO_LW({u"Name": u"%s:pylal_rate_sparsebinnedarray" % name})
+		xml.appendChild(self.bins.to_xml())
+		xml.appendChild(ligolw_array.from_array(u"indices", self.indices.astype("int64")))
+		xml.appendChild(ligolw_array.from_array(u"values", self.values))
+		return xml
+
+	@classmethod
+	def from_xml(cls, xml, name):
+		"""
+		Search for the description of a rate.SparseBinnedArray
+		object named "name" in the XML document tree rooted at xml,
+		and construct and return a new rate.SparseBinnedArray
+		object from the data contained therein.
+		"""
+		xml = [elem for elem in xml.getElementsByTagName(ligolw.LIGO_LW.tagName) if elem.hasAttribute(u"Name") and elem.Name == u"%s:pylal_rate_sparsebinnedarray" % name]
+		try:
+			xml, = xml
+		except ValueError:
+			raise ValueError("document must contain exactly 1 SparseBinnedArray named '%s'" % name)
+		self = cls(NDBins.from_xml(xml))
+		self.indices = ligolw_array.get_array(xml, u"indices").array.astype("intp")
+		self.values = ligolw_array.get_array(xml, u"values").array
+		return self
+
+	def to_arrays(self, name):
+		"""
+		Return a dictionary of arrays describing a
+		rate.SparseBinnedArray object, suitable for save_arrays().
+		"""
+		prefix = u"%s:pylal_rate_sparsebinnedarray" % name
+		arrays = self.bins.to_arrays(u"%s/bins" % prefix)
+		arrays[u"%s/indices" % prefix] = self.indices
+		arrays[u"%s/values" % prefix] = self.values
+		return arrays
+
+	@classmethod
+	def from_arrays(cls, arrays, name):
+		"""
+		Construct and return a new rate.SparseBinnedArray object
+		from the arrays describing the SparseBinnedArray named
+		"name" in the dictionary arrays, as returned by
+		load_arrays().
+		"""
+		prefix = u"%s:pylal_rate_sparsebinnedarray" % name
+		self = cls(NDBins.from_arrays(arrays, u"%s/bins" % prefix))
+		self.indices = numpy.asarray(arrays[u"%s/indices" % prefix], dtype = "intp")
+		self.values = arrays[u"%s/values" % prefix]
+		return self
+
 
 class BinnedRatios(object):
 	"""
 	Like BinnedArray, but provides a numerator array and a denominator
 	array.  The incnumerator() method increments a bin in the numerator
 	by the given weight, and the incdenominator() method increments a
-	bin in the denominator by the given weight.  There are no methods
+	bin in the denominator by the given weight.  fillnumerator() and
+	filldenominator() do the same for arrays of co-ordinates.  There are no methods
 	provided for setting or decrementing either, but the they are
 	accessible as the numerator and denominator attributes, which are
 	both BinnedArray objects.
@@ -1252,6 +1958,22 @@ class BinnedRatios(object):
 		"""
 		self.denominator[coords] += weight
 
+	def fillnumerator(self, coords, weights = None):
+		"""
+		Add weights to the numerator bins at the co-ordinates in
+		coords, a sequence of arrays, one for each dimension.  See
+		BinnedArray.fill() for more information.
+		"""
+		self.numerator.fill(coords, weights = weights)
+
+	def filldenominator(self, coords, weights = None):
+		"""
+		Add weights to the denominator bins at the co-ordinates in
+		coords, a sequence of arrays, one for each dimension.  See
+		BinnedArray.fill() for more information.
+		"""
+		self.denominator.fill(coords, weights = weights)
+
 	def ratio(self):
 		"""
 		Compute and return the array of ratios.
@@ -1326,6 +2048,75 @@ class BinnedRatios(object):
 		return self
 
 
+#
+# =============================================================================
+#
+#                                  Binary I/O
+#
+# =============================================================================
+#
+
+
+def save_arrays(fileobj, arrays, compress = False):
+	"""
+	Write the dictionary of arrays to fileobj (a file name or file
+	object) in numpy's .npz format.  The dictionaries returned by the
+	.to_arrays() methods of the classes in this module can be combined
+	and written to a single file.  If compress is True the arrays are
+	compressed, otherwise they are stored uncompressed, which allows
+	load_arrays() to memory-map them.
+	"""
+	if compress:
+		numpy.savez_compressed(fileobj, **arrays)
+	else:
+		numpy.savez(fileobj, **arrays)
+
+
+def load_arrays(filename, mmap = False):
+	"""
+	Load the dictionary of arrays from the .npz file named filename.
+	If mmap is False, the return value is a numpy NpzFile object,
+	which reads each array from the file when it is first requested.
+	If mmap is True, the return value is a dictionary in which every
+	array stored uncompressed is a copy-on-write numpy.memmap of the
+	file, so its contents are only read from disk as they are used and
+	modifying it does not modify the file.  Compressed and
+	zero-dimensional arrays are read in full.
+	"""
+	npz = numpy.load(filename)
+	if not mmap:
+		return npz
+	arrays = {}
+	try:
+		f = open(filename, "rb")
+		try:
+			for info in zipfile.ZipFile(f).infolist():
+				name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+				if info.compress_type != zipfile.ZIP_STORED:
+					arrays[name] = npz[name]
+					continue
+				# skip the zip member's local header.  the
+				# lengths of the file name and extra fields
+				# are at byte 26
+				f.seek(info.header_offset + 26)
+				n, m = struct.unpack("<HH", f.read(4))
+				f.seek(info.header_offset + 30 + n + m)
+				version = numpy.lib.format.read_magic(f)
+				if version == (1, 0):
+					shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+				else:
+					shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+				if not shape or not numpy.prod(shape) or dtype.hasobject:
+					arrays[name] = npz[name]
+					continue
+				arrays[name] = numpy.memmap(filename, dtype = dtype, mode = "c", offset = f.tell(), shape = shape, order = "F" if fortran_order else "C")
+		finally:
+			f.close()
+	finally:
+		npz.close()
+	return arrays
+
+
 #
 # =============================================================================
 #
@@ -1335,13 +2126,89 @@ class BinnedRatios(object):
 #
 
 
+def _multilinear_interpolator(coords, z, fill_value):
+	"""
+	Return a function that performs multi-linear interpolation of the
+	array z sampled on the rectilinear grid whose co-ordinates along
+	each dimension are given by the arrays in coords, returning
+	fill_value outside the grid.  The function accepts scalars or
+	arrays of co-ordinates.  For internal use.
+	"""
+	coords = tuple(numpy.asarray(c, dtype = "double") for c in coords)
+	dcoords = tuple(c[1:] - c[:-1] for c in coords)
+	corners = tuple(itertools.product((0, 1), repeat = len(coords)))
+
+	# for single points the set-up cost of the array code dominates, so
+	# they are done in pure Python with bisection searches of the
+	# co-ordinate lists and look-ups in the flattened array.  corner
+	# offsets are pre-computed for each corner of a grid cell
+	coord_lists = tuple(c.tolist() for c in coords)
+	z_list = numpy.asarray(z, dtype = "double").ravel().tolist()
+	strides = tuple(int(numpy.prod(z.shape[i + 1:])) for i in range(len(coords)))
+	corner_offsets = tuple(sum(bit * stride for bit, stride in zip(corner, strides)) for corner in corners)
+	fill_value_float = float(fill_value)
+	def interp_scalar(x):
+		offset = 0
+		fracs = []
+		for c, stride, xi in zip(coord_lists, strides, x):
+			if not c[0] <= xi <= c[-1]:
+				# outside the grid, or NaN
+				return fill_value_float
+			i = min(max(bisect_right(c, xi) - 1, 0), len(c) - 2)
+			offset += i * stride
+			fracs.append((xi - c[i]) / (c[i + 1] - c[i]))
+		result = 0.
+		for corner, corner_offset in zip(corners, corner_offsets):
+			weight = 1.
+			for f, bit in zip(fracs, corner):
+				weight *= f if bit else 1. - f
+			# don't let infinite values leak in from corners
+			# that carry no weight
+			if weight != 0.:
+				result += weight * z_list[offset + corner_offset]
+		return result
+
+	def interp(*x):
+		if len(x) != len(coords):
+			raise ValueError("dimension mismatch")
+		scalar = all(numpy.isscalar(xi) for xi in x)
+		if scalar:
+			return interp_scalar(tuple(float(xi) for xi in x))
+		x = numpy.broadcast_arrays(*(numpy.asarray(xi, dtype = "double") for xi in x))
+		shape = x[0].shape
+		inside = numpy.ones(x[0].size, dtype = bool)
+		indexes = []
+		fracs = []
+		for c, dc, xi in zip(coords, dcoords, x):
+			xi = xi.ravel()
+			inside &= (c[0] <= xi) & (xi <= c[-1])
+			i = numpy.clip(c.searchsorted(xi, side = "right") - 1, 0, len(c) - 2)
+			indexes.append(i)
+			fracs.append((xi - c[i]) / dc[i])
+		result = numpy.zeros(x[0].size, dtype = "double")
+		with numpy.errstate(invalid = "ignore"):
+			for corner in corners:
+				weight = reduce(numpy.multiply, (f if bit else 1. - f for f, bit in zip(fracs, corner)))
+				value = z[tuple(i + bit for i, bit in zip(indexes, corner))]
+				# don't let infinite values leak in from
+				# corners that carry no weight
+				result += numpy.where(weight != 0., weight * value, 0.)
+		result[~inside] = fill_value
+		return result.reshape(shape)
+	return interp
+
+
 def InterpBinnedArray(binnedarray, fill_value = 0.0):
 	"""
 	Wrapper constructing a scipy.interpolate interpolator from the
 	contents of a BinnedArray.  Only piecewise linear interpolators are
-	supported.  In 1 and 2 dimensions, scipy.interpolate.interp1d and
-	.interp2d is used, respectively.  In more than 2 dimensions
-	scipy.interpolate.LinearNDInterpolator is used.
+	supported.  In 1 dimension scipy.interpolate.interp1d is used.  In
+	2 and more dimensions multi-linear interpolation is done directly
+	on the grid of bin centres.
+
+	The interpolator can be called with scalar co-ordinates, in which
+	case it returns a float, or with arrays of co-ordinates, in which
+	case it returns an array of values, one for each point.
 
 	Example:
 
@@ -1401,6 +2268,22 @@ def InterpBinnedArray(binnedarray, fill_value = 0.0):
 	2.5
 	>>> y(1, 0.75)
 	3.5
+	>>> y(numpy.array([0.25, 0.75, 1.]), numpy.array([1., 1., 0.25])).tolist()
+	[1.75, 3.25, 2.5]
+
+	Three dimensions
+
+	>>> x = BinnedArray(NDBins((LinearBins(-0.5, 1.5, 2), LinearBins(-0.5, 1.5, 2), LinearBins(-0.5, 1.5, 2))))
+	>>> x.array[:] = numpy.arange(8.).reshape((2, 2, 2))
+	>>> y = InterpBinnedArray(x)
+	>>> y(0, 0, 0)
+	0.0
+	>>> y(1, 1, 1)
+	7.0
+	>>> y(0.5, 0.5, 0.5)
+	3.5
+	>>> y(numpy.array([0., 0.5, 5.]), numpy.array([1., 0., 0.]), numpy.array([0., 0., 0.])).tolist()
+	[2.0, 2.0, 0.0]
 
 	BUGS:  Due to bugs in some versions of scipy and numpy, if an old
 	version of scipy and/or numpy is detected this code falls back to
@@ -1470,7 +2353,11 @@ def InterpBinnedArray(binnedarray, fill_value = 0.0):
 				return z[i] + (x - coords0[i]) * dz_over_dcoords0[i]
 			return interp
 		interp = interp1d(coords[0], z, kind = "linear", copy = False, bounds_error = False, fill_value = fill_value)
-		return lambda *coords: float(interp(*coords))
+		def interp1(x):
+			if numpy.isscalar(x):
+				return float(interp(x))
+			return interp(x)
+		return interp1
 	elif len(coords) == 2:
 		try:
 			interp2d
@@ -1501,8 +2388,12 @@ def InterpBinnedArray(binnedarray, fill_value = 0.0):
 					return z[i + 1, j + 1]
 				return z[i + 1, j + 1] + (1. - dx) * -dz0[i, j + 1] + (1. - dy) * -dz1[i + 1, j]
 			return interp
-		interp = interp2d(coords[0], coords[1], z.T, kind = "linear", copy = False, bounds_error = False, fill_value = fill_value)
-		return lambda *coords: float(interp(*coords))
+		# interp2d() evaluates arrays of co-ordinates on the grid
+		# they define rather than point-by-point, and its spline
+		# fit is poisoned everywhere by a single infinite sample
+		# (as occurs when interpolating the logarithm of a PDF), so
+		# the bilinear interpolation is done directly on the grid
+		return _multilinear_interpolator(coords, z, fill_value)
 	else:
 		try:
 			LinearNDInterpolator
@@ -1514,8 +2405,11 @@ def InterpBinnedArray(binnedarray, fill_value = 0.0):
 				except IndexError:
 					return fill_value
 			return interp
-		interp = LinearNDInterpolator(list(itertools.product(*coords)), z.flat, fill_value = fill_value)
-		return lambda *coords: float(interp(*coords))
+		# the co-ordinates form a rectilinear grid, so the
+		# interpolation is done directly on the grid rather than
+		# by building a Delaunay triangulation of it with
+		# LinearNDInterpolator
+		return _multilinear_interpolator(coords, z, fill_value)
 
 
 #
@@ -1633,6 +2527,123 @@ def tophat_window2d(bins_x, bins_y):
 #
 
 
+#
+# the Fourier transforms of window functions are cached, keyed on the
+# window's contents and the padded shape of the transform.  the cache is
+# bounded, and the least-recently used transforms are discarded first.
+#
+
+
+_fft_kernel_cache = collections.OrderedDict()
+_fft_kernel_cache_size = 32
+_fft_kernel_cache_lock = threading.Lock()
+
+# number of dynamic range slices transformed together by filter_array()
+_filter_block_size = 8
+
+
+# the size, in each dimension, of the tiles into which the bins of a
+# SparseBinnedArray are grouped for filtering.  tiles are never smaller
+# than the window function
+_sparse_tile_size = 8
+
+
+try:
+	from scipy.fftpack import next_fast_len as _next_fast_len
+except ImportError:
+	# scipy < 0.18
+	_next_fast_len = lambda n: n
+
+
+def _fft_kernel(window, fshape):
+	"""
+	Return the real-input FFT of the window function zero-padded to
+	fshape, from the cache if possible.  For internal use.
+	"""
+	window = numpy.ascontiguousarray(window)
+	key = (hashlib.sha1(window.view(numpy.uint8)).hexdigest(), window.shape, window.dtype.str, fshape)
+	with _fft_kernel_cache_lock:
+		try:
+			kernel = _fft_kernel_cache.pop(key)
+		except KeyError:
+			kernel = None
+		else:
+			_fft_kernel_cache[key] = kernel
+	if kernel is None:
+		kernel = numpy.fft.rfftn(window, fshape)
+		with _fft_kernel_cache_lock:
+			_fft_kernel_cache[key] = kernel
+			while len(_fft_kernel_cache) > _fft_kernel_cache_size:
+				_fft_kernel_cache.popitem(last = False)
+	return kernel
+
+
+def _fft_kernel_cache_clear():
+	"""
+	Empty the cache of window function transforms.
+	"""
+	with _fft_kernel_cache_lock:
+		_fft_kernel_cache.clear()
+
+
+def _fftconvolve_same(stack, window):
+	"""
+	Convolve each of the arrays stacked along the first axis of stack
+	with window, returning the central part of each result with the
+	same shape as the input (like scipy.signal.fftconvolve() with
+	mode = "same").  The window must be no larger than the arrays in
+	any dimension.  For internal use.
+	"""
+	shape = numpy.array(stack.shape[1:])
+	full = shape + numpy.array(window.shape) - 1
+	fshape = tuple(_next_fast_len(int(n)) for n in full)
+	axes = tuple(range(1, stack.ndim))
+	if numpy.iscomplexobj(stack) or numpy.iscomplexobj(window):
+		result = numpy.fft.ifftn(numpy.fft.fftn(stack, fshape, axes = axes) * numpy.fft.fftn(window, fshape), axes = axes)
+	else:
+		result = numpy.fft.irfftn(numpy.fft.rfftn(stack, fshape, axes = axes) * _fft_kernel(window, fshape), fshape, axes = axes)
+	start = (full - shape) // 2
+	return result[(slice(None),) + tuple(slice(a, a + n) for a, n in zip(start, shape))]
+
+
+def _filter_sparse(a, window):
+	"""
+	Filter the SparseBinnedArray a in place.  The bins are grouped
+	into tiles, and only the occupied tiles are convolved with the
+	window function, each in a dense block large enough to hold its
+	contribution to the result.  Convolution is linear, so the sum of
+	the blocks is the filtered array.  For internal use by
+	filter_array().
+	"""
+	if not len(a.indices):
+		return
+	shape = numpy.array(a.shape)
+	wshape = numpy.array(window.shape)
+	halo = wshape // 2
+	tile = numpy.maximum(_sparse_tile_size, wshape)
+	ntiles = tuple(-(-shape // tile))
+	index = numpy.array(numpy.unravel_index(a.indices, a.shape))
+	tiles, inverse = numpy.unique(numpy.ravel_multi_index(tuple(index // tile[:, numpy.newaxis]), ntiles), return_inverse = True)
+	order = numpy.argsort(inverse, kind = "mergesort")
+	bounds = numpy.searchsorted(inverse[order], numpy.arange(len(tiles) + 1))
+	indices = []
+	values = []
+	for t, first, last in zip(tiles, bounds[:-1], bounds[1:]):
+		members = order[first:last]
+		start = numpy.array(numpy.unravel_index(t, ntiles)) * tile
+		# the block holds the tile and the halo around it, and
+		# is never smaller than the window function
+		lo = numpy.maximum(numpy.minimum(start - halo, shape - wshape), 0)
+		hi = numpy.minimum(numpy.maximum(start + tile + halo, wshape), shape)
+		block = numpy.zeros(hi - lo, dtype = a.values.dtype)
+		block[tuple(index[:, members] - lo[:, numpy.newaxis])] = a.values[members]
+		filter_array(block, window)
+		nonzero = numpy.nonzero(block)
+		indices.append(numpy.ravel_multi_index(tuple(i + l for i, l in zip(nonzero, lo)), a.shape))
+		values.append(block[nonzero])
+	a.indices, a.values = _coalesce(numpy.concatenate(indices), numpy.concatenate(values))
+
+
 def filter_array(a, window, cyclic = False):
 	"""
 	Filter an array using the window function.  The transformation is
@@ -1646,6 +2657,11 @@ def filter_array(a, window, cyclic = False):
 	This is done silently;  to determine if window function truncation
 	will occur, check for yourself that your window function is smaller
 	than your data in all dimensions.
+
+	a may also be a SparseBinnedArray, in which case only the regions
+	of the binning near non-zero bins are transformed.  The result
+	agrees with that obtained by filtering the dense array to within
+	the dynamic range of the FFT convolution.
 	"""
 	assert not cyclic	# no longer supported, maybe in future
 	# check that the window and the data have the same number of
@@ -1668,42 +2684,39 @@ def filter_array(a, window, cyclic = False):
 			window_slices.append(slice(0, window.shape[d]))
 	window = window[window_slices]
 
-	# this loop works around dynamic range limits in the FFT
-	# convolution code.  we move data 4 orders of magnitude at a time
-	# from the original array into a work space, convolve the work
-	# space with the filter, zero the workspace in any elements that
-	# are more than 14 orders of magnitude below the maximum value in
-	# the result, and add the result to the total.
+	if isinstance(a, SparseBinnedArray):
+		_filter_sparse(a, window)
+		return a
+
+	# this works around dynamic range limits in the FFT convolution
+	# code.  the input is split into slices, each containing the
+	# elements within 4 orders of magnitude of the smallest non-zero
+	# element not already assigned to a slice.  each slice is
+	# convolved with the filter, any elements of the result more than
+	# 14 orders of magnitude below its maximum value are zeroed, and
+	# the results are summed.  the slices do not depend on each other
+	# so they are stacked and transformed together, in blocks to
+	# bound the memory required.
+	slices = []
+	remaining = abs(a)
+	while remaining.any():
+		mask = remaining <= remaining[remaining > 0].min() * 1e4
+		mask &= remaining > 0
+		slices.append(mask)
+		remaining[mask] = 0.
+	del remaining
+
 	result = numpy.zeros_like(a)
-	while a.any():
-		# copy contents of input array to work space
-		workspace = numpy.copy(a)
-
-		# mask = indexes of elements of work space not more than 4
-		# orders of magnitude larger than the smallest non-zero
-		# element.  these are the elements to be processed in this
-		# iteration
-		abs_workspace = abs(workspace)
-		mask = abs_workspace <= abs_workspace[abs_workspace > 0].min() * 1e4
-		del abs_workspace
-
-		# zero the masked elements in the input array, zero
-		# everything except the masked elements in the work space
-		a[mask] = 0.
-		workspace[~mask] = 0.
-		del mask
-
-		# convolve the work space with the kernel
-		workspace = signaltools.fftconvolve(workspace, window, mode = "same")
-
-		# determine the largest value in the work space, and set to
-		# zero anything more than 14 orders of magnitude smaller
-		abs_workspace = abs(workspace)
-		workspace[abs_workspace < abs_workspace.max() * 1e-14] = 0.
-		del abs_workspace
-
-		# sum what remains into the result
-		result += workspace
+	for i in xrange(0, len(slices), _filter_block_size):
+		block = slices[i : i + _filter_block_size]
+		workspace = numpy.zeros((len(block),) + a.shape, dtype = a.dtype)
+		for workspace_slice, mask in zip(workspace, block):
+			workspace_slice[mask] = a[mask]
+		workspace = _fftconvolve_same(workspace, window)
+		for workspace_slice in workspace:
+			abs_workspace = abs(workspace_slice)
+			workspace_slice[abs_workspace < abs_workspace.max() * 1e-14] = 0.
+			result += workspace_slice
 		del workspace
 	# overwrite the input with the result
 	# FIXME:  in numpy >= 1.7.0 there is a copyto() function
@@ -1712,6 +2725,30 @@ def filter_array(a, window, cyclic = False):
 	return a
 
 
+def filter_arrays(arrays, window, cyclic = False, nthreads = 1):
+	"""
+	Filter each of a sequence of arrays in place with the same window
+	function.  See filter_array() for more information.  If nthreads
+	is greater than 1 the arrays are processed concurrently by a pool
+	of that many threads.  This only helps if the FFT library in use
+	releases the GIL, but the window's transform is computed only
+	once regardless.
+	"""
+	arrays = list(arrays)
+	if nthreads > 1 and len(arrays) > 1:
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(min(nthreads, len(arrays)))
+		try:
+			pool.map(lambda a: filter_array(a, window, cyclic = cyclic), arrays)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for a in arrays:
+			filter_array(a, window, cyclic = cyclic)
+	return arrays
+
+
 def filter_binned_ratios(ratios, window, cyclic = False):
 	"""
 	Convolve the numerator and denominator of a BinnedRatios instance
@@ -1745,8 +2782,7 @@ def filter_binned_ratios(ratios, window, cyclic = False):
 	Note, also, that you should apply this function *before* using
 	either of the regularize() methods of the BinnedRatios object.
 	"""
-	filter_array(ratios.numerator.array, window, cyclic = cyclic)
-	filter_array(ratios.denominator.array, window, cyclic = cyclic)
+	filter_arrays((ratios.numerator.array, ratios.denominator.array), window, cyclic = cyclic)
 
 
 #
@@ -1811,9 +2847,22 @@ def marginalize(pdf, dim):
 	From a BinnedArray object containing probability density data (bins
 	whose volume integral is 1), return a new BinnedArray object
 	containing the probability density marginalized over dimension
-	dim.
+	dim.  If pdf is a SparseBinnedArray, so is the result.
 	"""
 	dx = pdf.bins[dim].upper() - pdf.bins[dim].lower()
+
+	if isinstance(pdf, SparseBinnedArray):
+		result = SparseBinnedArray(NDBins(pdf.bins[:dim] + pdf.bins[dim+1:]))
+		index = numpy.unravel_index(pdf.indices, pdf.shape)
+		if result.shape:
+			result_index = numpy.ravel_multi_index(index[:dim] + index[dim+1:], result.shape)
+		else:
+			# marginalizing over the only dimension leaves a
+			# single value
+			result_index = numpy.zeros(len(pdf.indices), dtype = "intp")
+		result.indices, result.values = _coalesce(result_index, pdf.values * dx[index[dim]])
+		return result
+
 	dx_shape = [1] * len(pdf.bins)
 	dx_shape[dim] = len(dx)
 	dx.shape = dx_shape
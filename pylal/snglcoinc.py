@@ -39,8 +39,10 @@ except ImportError:
 	NaN = float("nan")
 	NegInf = float("-inf")
 	PosInf = float("+inf")
+import hashlib
 import itertools
 import math
+import multiprocessing
 import numpy
 import random
 from scipy.constants import c as speed_of_light
@@ -58,6 +60,7 @@ from glue.ligolw import array as ligolw_array
 from glue.ligolw import param as ligolw_param
 from glue.ligolw import table as ligolw_table
 from glue.ligolw import lsctables
+from glue.ligolw import types as ligolwtypes
 from glue.text_progress_bar import ProgressBar
 from pylal import git_version
 from pylal import inject
@@ -152,6 +155,36 @@ class EventList(list):
 		"""
 		raise NotImplementedError
 
+	def get_times_ns(self):
+		"""
+		Return a numpy int64 array of the times of the events in
+		this list in integer nanoseconds, in list order, with the
+		offset attribute *not* applied.  The array must be sorted
+		in ascending order, i.e., make_index() must leave the list
+		sorted by time.
+
+		This method is only required by the array-based pair
+		search engine, get_doubles_array().  Subclasses that wish
+		to support that engine should override this method and
+		the get_window_ns() method.  The array can be computed in
+		make_index() and cached, because make_index() is called
+		again whenever the list is modified.
+		"""
+		raise NotImplementedError
+
+	def get_window_ns(self, light_travel_time, threshold):
+		"""
+		Return, as an integer number of nanoseconds, the largest
+		time difference that can separate an event from another
+		list and an event in this list and the two still be
+		coincident.  light_travel_time and threshold have the same
+		meaning as for get_coincs().
+
+		This method is only required by the array-based pair
+		search engine, get_doubles_array().
+		"""
+		raise NotImplementedError
+
 
 class EventListDict(dict):
 	"""
@@ -220,6 +253,113 @@ def make_eventlists(xmldoc, EventListType, event_table_name, process_ids = None)
 	return EventListDict(EventListType, ligolw_table.get_table(xmldoc, event_table_name), process_ids = process_ids)
 
 
+#
+# =============================================================================
+#
+#                          Segment Membership Tests
+#
+# =============================================================================
+#
+
+
+def time_to_ns(t):
+	"""
+	Convert a segment boundary to an integer count of nanoseconds.
+	Infinite boundaries are mapped to the extremes of the int64 range.
+	"""
+	if hasattr(t, "ns"):
+		return t.ns()
+	if math.isinf(t):
+		return numpy.iinfo("int64").max if t > 0 else numpy.iinfo("int64").min
+	return lsctables.LIGOTimeGPS(t).ns()
+
+
+class SegmentIndex(object):
+	"""
+	Vectorized segment membership tests for a dictionary of segment
+	lists (e.g., a glue.segments.segmentlistdict), indexed by
+	instrument.  Each segment list is coalesced and converted, once,
+	to sorted arrays of int64 nanosecond start and stop times, and
+	membership is then tested for whole arrays of times with
+	numpy.searchsorted().  As with glue.segments, segments are
+	half-open:  a time is in a segment if start <= t < stop.
+
+	Example:
+
+	>>> from glue.segments import segment, segmentlist, segmentlistdict
+	>>> index = SegmentIndex(segmentlistdict({"H1": segmentlist([segment(0, 10), segment(20, 30)])}))
+	>>> index.contains("H1", numpy.array([0, 10, 25]) * 1000000000).tolist()
+	[True, False, True]
+	>>> index.contains("L1", numpy.array([0, 10, 25]) * 1000000000).tolist()
+	[False, False, False]
+	"""
+	def __init__(self, seglistdict):
+		self.starts = {}
+		self.stops = {}
+		for instrument, seglist in seglistdict.items():
+			seglist = segmentsUtils.segments.segmentlist(seglist).coalesce()
+			self.starts[instrument] = numpy.array([time_to_ns(seg[0]) for seg in seglist], dtype = "int64")
+			self.stops[instrument] = numpy.array([time_to_ns(seg[1]) for seg in seglist], dtype = "int64")
+		# plain lists of the same boundaries for scalar tests, where
+		# bisect is much cheaper than a numpy call
+		self.start_lists = dict((instrument, starts.tolist()) for instrument, starts in self.starts.items())
+		self.stop_lists = dict((instrument, stops.tolist()) for instrument, stops in self.stops.items())
+
+	def __contains__(self, instrument):
+		return instrument in self.starts
+
+	def contains(self, instrument, times):
+		"""
+		Return a boolean array that is True where the integer
+		nanosecond times lie in the instrument's segments.  If the
+		instrument has no segment list, the result is all False.
+		"""
+		times = numpy.asarray(times, dtype = "int64")
+		if instrument not in self.starts or not len(self.starts[instrument]):
+			return numpy.zeros(times.shape, dtype = "bool")
+		starts, stops = self.starts[instrument], self.stops[instrument]
+		# index of the first segment whose end is after each time.
+		# the time is in that segment if the segment starts at or
+		# before it
+		i = numpy.searchsorted(stops, times, side = "right")
+		return (i < len(stops)) & (starts[numpy.minimum(i, len(stops) - 1)] <= times)
+
+	def instruments_on(self, t, offset_vector):
+		"""
+		Return the set of instruments whose segments contain the
+		time t, an integer count of nanoseconds, after unsliding it
+		by the instrument's offset in offset_vector.  KeyError is
+		raised if offset_vector does not provide an offset for
+		every instrument in the index.
+		"""
+		instruments = set()
+		for instrument, stops in self.stop_lists.items():
+			t_unslid = t - time_to_ns(offset_vector[instrument])
+			i = bisect.bisect_right(stops, t_unslid)
+			if i < len(stops) and self.start_lists[instrument][i] <= t_unslid:
+				instruments.add(instrument)
+		return instruments
+
+
+def apply_vetoes(eventlists, vetoes):
+	"""
+	Remove from each event list in the EventListDict eventlists the
+	events whose times lie in the instrument's veto segments.  vetoes
+	is a SegmentIndex or a dictionary of segment lists indexed by
+	instrument.  The event lists must implement get_times_ns(), and
+	make_index() is called on each list that is modified.
+	"""
+	if not isinstance(vetoes, SegmentIndex):
+		vetoes = SegmentIndex(vetoes)
+	for instrument, eventlist in eventlists.items():
+		if instrument not in vetoes:
+			continue
+		vetoed = vetoes.contains(instrument, eventlist.get_times_ns())
+		if vetoed.any():
+			eventlist[:] = [eventlist[i] for i in numpy.flatnonzero(~vetoed)]
+			eventlist.make_index()
+
+
 #
 # =============================================================================
 #
@@ -316,6 +456,118 @@ def get_doubles(eventlists, comparefunc, instruments, thresholds, verbose = Fals
 	# done
 
 
+def batched_comparefunc(comparefunc):
+	"""
+	Wrap a scalar event comparison function of the kind accepted by
+	get_doubles() so that it can be used as the batch comparison
+	function of get_doubles_array().  The scalar function is still
+	called once for each candidate pair, so this provides only the
+	savings of the array-based candidate search, but it allows any
+	existing comparison function to be used with the array engine.
+
+	Example:
+
+	>>> get_doubles_array(eventlists, batched_comparefunc(comparefunc), ("H1", "L1"), thresholds)
+	"""
+	def batch_comparefunc(eventlista, indexesa, offseta, eventlistb, indexesb, offsetb, light_travel_time, threshold_data):
+		return numpy.fromiter((bool(comparefunc(eventlista[i], offseta, eventlistb[j], offsetb, light_travel_time, threshold_data)) for i, j in itertools.izip(indexesa, indexesb)), dtype = "bool", count = len(indexesa))
+	return batch_comparefunc
+
+
+def get_doubles_array(eventlists, batch_comparefunc, instruments, thresholds, blocksize = 16384, verbose = False):
+	"""
+	Array-based equivalent of get_doubles().  Generates the same
+	sequence of coincident event pairs, but instead of retrieving the
+	candidate partners of each event with a call to the event list's
+	get_coincs() method, the event times of both lists are held as
+	sorted int64 nanosecond arrays and the windows of candidate
+	partners for a whole block of events are found with two calls to
+	numpy.searchsorted().  The event lists must implement the
+	get_times_ns() and get_window_ns() methods.
+
+	The candidate pairs are then passed, a block at a time, to the
+	batch comparison function, whose signature should be
+
+	>>> batch_comparefunc(eventlista, indexesa, offseta, eventlistb, indexesb, offsetb, light_travel_time, threshold_data)
+
+	where indexesa and indexesb are equal-length integer arrays
+	identifying the candidate pairs (eventlista[indexesa[i]],
+	eventlistb[indexesb[i]]), offseta and offsetb are the time shifts
+	carried by the two event lists, and light_travel_time and
+	threshold_data have the same meaning as for get_doubles().  The
+	return value must be a boolean array with one element for each
+	candidate pair, False if the pair is coincident and True
+	otherwise (matching the sense of the return value of the scalar
+	comparison function).  batched_comparefunc() can be used to adapt
+	a scalar comparison function.
+
+	blocksize sets the number of events from the shorter list that
+	are processed together, and so bounds the memory required for the
+	candidate index arrays.
+
+	NOTE:  as for get_doubles(), the order of the events in each
+	tuple is arbitrary.
+	"""
+	# retrieve the event lists for the requested instrument combination
+
+	instruments = tuple(instruments)
+	assert len(instruments) == 2
+	for instrument in instruments:
+		assert eventlists[instrument].instrument == instrument
+	eventlista, eventlistb = [eventlists[instrument] for instrument in instruments]
+
+	# insure eventlist a is the shorter of the two event lists;  record
+	# the length of the shortest
+
+	if len(eventlista) > len(eventlistb):
+		eventlista, eventlistb = eventlistb, eventlista
+	length = len(eventlista)
+
+	# extract the thresholds and pre-compute the light travel time
+
+	try:
+		threshold_data = thresholds[(eventlista.instrument, eventlistb.instrument)]
+	except KeyError as e:
+		raise KeyError("no coincidence thresholds provided for instrument pair %s, %s" % e.args[0])
+	light_travel_time = inject.light_travel_time(eventlista.instrument, eventlistb.instrument)
+
+	# the times of the events in list a, moved into the time frame of
+	# list b, and the window of list b's times that can be coincident
+	# with each
+
+	timesa = eventlista.get_times_ns() + numpy.int64(eventlista.offset.ns() - eventlistb.offset.ns())
+	timesb = eventlistb.get_times_ns()
+	window = numpy.int64(eventlistb.get_window_ns(light_travel_time, threshold_data))
+
+	for start in xrange(0, length, blocksize):
+		if verbose:
+			print >>sys.stderr, "\t%.1f%%\r" % (100.0 * start / length),
+
+		# identify all candidate partners for this block of events
+		# with two bisection searches, then expand the index
+		# windows into explicit arrays of candidate pairs
+
+		block = timesa[start : start + blocksize]
+		lo = numpy.searchsorted(timesb, block - window, side = "left")
+		counts = numpy.searchsorted(timesb, block + window, side = "right") - lo
+		total = counts.sum()
+		if not total:
+			continue
+		indexesa = numpy.repeat(numpy.arange(start, start + len(block)), counts)
+		indexesb = numpy.arange(total) + numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+
+		# apply the comparison to all candidates at once, and
+		# return the pairs that pass
+
+		rejected = numpy.asarray(batch_comparefunc(eventlista, indexesa, eventlista.offset, eventlistb, indexesb, eventlistb.offset, light_travel_time, threshold_data), dtype = "bool")
+		for i, j in itertools.izip(indexesa[~rejected], indexesb[~rejected]):
+			yield (eventlista[i], eventlistb[j])
+	if verbose:
+		print >>sys.stderr, "\t100.0%"
+
+	# done
+
+
 #
 # =============================================================================
 #
@@ -325,6 +577,72 @@ def get_doubles(eventlists, comparefunc, instruments, thresholds, verbose = Fals
 #
 
 
+def coinc_keys(coincs):
+	"""
+	From a 2-D array of non-negative event indexes, return a 1-D array
+	of opaque keys, one for each row, such that comparing two keys is
+	equivalent to comparing the two rows lexicographically.  The keys
+	can be sorted, and searched with numpy.searchsorted() and
+	numpy.in1d().
+	"""
+	coincs = numpy.ascontiguousarray(coincs, dtype = ">u4")
+	return coincs.view("V%d" % (4 * coincs.shape[1])).reshape((len(coincs),))
+
+
+def sort_coincs(coincs):
+	"""
+	Return a copy of the 2-D array of event indexes with the rows
+	sorted lexicographically.
+	"""
+	return coincs[numpy.lexsort(coincs.T[::-1])]
+
+
+def count_coincs(node):
+	"""
+	Return the number of coincs, including unused coincs, retained by
+	a TimeSlideGraphNode.
+	"""
+	return len(node.coincs) + sum(len(coincs) for coincs in node.unused_coincs.values())
+
+
+#
+# Process pool support.  The graph and the arguments of the coincidence
+# search are recorded in a module global before the pool is started so
+# that the worker processes inherit them, read-only, from the parent via
+# fork() instead of having them pickled.
+#
+
+
+_pool_state = None
+
+
+def _pool_get_coincs(index):
+	"""
+	Worker function for TimeSlideGraph's process pool.  Constructs
+	the coincs for node number index of the generation being built and
+	returns the sorted array of event indexes and the dictionary of
+	unused coincs.
+	"""
+	graph, n, eventlists, event_comparefunc, thresholds, event_index, doubles_func = _pool_state
+	node = graph.generations[n][index]
+	return node.get_coincs(eventlists, event_comparefunc, thresholds, event_index, verbose = False, doubles_func = doubles_func), node.unused_coincs
+
+
+class RetentionCounter(object):
+	"""
+	Book-keeping for TimeSlideGraph's streaming mode.  Records the
+	number of coincs currently retained by the nodes of the
+	graph, and the peak of that number.
+	"""
+	def __init__(self):
+		self.retained = 0
+		self.peak = 0
+
+	def add(self, n):
+		self.retained += n
+		self.peak = max(self.peak, self.retained)
+
+
 class TimeSlideGraphNode(object):
 	def __init__(self, offset_vector, time_slide_id = None):
 		self.time_slide_id = time_slide_id
@@ -332,12 +650,55 @@ class TimeSlideGraphNode(object):
 		self.deltas = frozenset(offset_vector.deltas.items())
 		self.components = None
 		self.coincs = None
-		self.unused_coincs = set()
+		self.unused_coincs = {}
+		# the number of nodes that are constructed from this one
+		# and have not yet been built, and, in streaming mode, the
+		# RetentionCounter that tracks the graph's memory use
+		self.consumers = 0
+		self.retention = None
+		self.released = False
 
 	def name(self):
 		return self.offset_vector.__str__(compact = True)
 
-	def get_coincs(self, eventlists, event_comparefunc, thresholds, verbose = False):
+	def retain(self):
+		"""
+		In streaming mode, record that this node's coincs have been
+		constructed and are being retained.
+		"""
+		if self.retention is not None:
+			self.retention.add(count_coincs(self))
+
+	def consume(self):
+		"""
+		Record that one of the nodes constructed from this one has
+		been built.  In streaming mode, when the last of them has
+		been built this node's coincs are freed.
+		"""
+		self.consumers -= 1
+		if self.retention is not None and self.consumers <= 0:
+			self.retention.add(-count_coincs(self))
+			self.coincs = None
+			self.unused_coincs = None
+			self.released = True
+
+	def get_coincs(self, eventlists, event_comparefunc, thresholds, event_index, verbose = False, doubles_func = get_doubles, blocksize = 16384):
+		"""
+		Construct and return this node's coincs.  The coincs are
+		returned as a sorted 2-D array of int32 event indexes, one
+		row per coinc with the columns ordered alphabetically by
+		instrument name.  event_index is a dictionary mapping event
+		ID to the index used to represent the event.  The indexes
+		must be assigned in order of event ID.
+		"""
+		#
+		# has this node's memory been released?  if so there's a
+		# bug in the reference counting
+		#
+
+		if self.released:
+			raise ValueError("coincs for %s have already been released" % str(self.offset_vector))
+
 		#
 		# has this node already been visited?  if so, return the
 		# answer we already know
@@ -365,7 +726,8 @@ class TimeSlideGraphNode(object):
 			if not offset_instruments.issubset(avail_instruments):
 				if verbose:
 					print >>sys.stderr, "\twarning: do not have data for instrument(s) %s ... assuming 0 coincs" % ", ".join(offset_instruments - avail_instruments)
-				self.coincs = tuple()
+				self.coincs = numpy.zeros((0, 2), dtype = "int32")
+				self.retain()
 				return self.coincs
 
 			#
@@ -378,9 +740,9 @@ class TimeSlideGraphNode(object):
 
 			#
 			# search for and record coincidences.  coincs is a
-			# sorted tuple of event ID pairs, where each pair
-			# of IDs is, itself, ordered alphabetically by
-			# instrument name
+			# sorted array of event index pairs, where each
+			# pair of indexes is, itself, ordered
+			# alphabetically by instrument name
 			#
 
 			if verbose:
@@ -391,7 +753,9 @@ class TimeSlideGraphNode(object):
 			# tuple returned by get_doubles() is arbitrary so
 			# we need to sort each tuple by instrument name
 			# explicitly
-			self.coincs = tuple(sorted((a.event_id, b.event_id) if a.ifo <= b.ifo else (b.event_id, a.event_id) for (a, b) in get_doubles(eventlists, event_comparefunc, offset_instruments, thresholds, verbose = verbose)))
+			coincs = numpy.fromiter(itertools.chain.from_iterable((event_index[a.event_id], event_index[b.event_id]) if a.ifo <= b.ifo else (event_index[b.event_id], event_index[a.event_id]) for (a, b) in doubles_func(eventlists, event_comparefunc, offset_instruments, thresholds, verbose = verbose)), dtype = "int32")
+			self.coincs = sort_coincs(coincs.reshape((len(coincs) // 2, 2)))
+			self.retain()
 			return self.coincs
 
 		#
@@ -402,7 +766,7 @@ class TimeSlideGraphNode(object):
 		if len(self.components) == 1:
 			if verbose:
 				print >>sys.stderr, "\tgetting coincs from %s ..." % str(self.components[0].offset_vector)
-			self.coincs = self.components[0].get_coincs(eventlists, event_comparefunc, thresholds, verbose = verbose)
+			self.coincs = self.components[0].get_coincs(eventlists, event_comparefunc, thresholds, event_index, verbose = verbose, doubles_func = doubles_func)
 			self.unused_coincs = self.components[0].unused_coincs
 
 			#
@@ -424,101 +788,115 @@ class TimeSlideGraphNode(object):
 		# synthesis algorithm to populate its coincs
 		#
 
-		self.coincs = []
-
-		# all coincs with n-1 instruments from the component time
-		# slides are potentially unused.  they all go in, we'll
-		# remove things from this set as we use them
-		# NOTE:  this function call is the recursion into the
-		# components to ensure they are initialized, it must be
-		# executed before any of what follows
+		# NOTE:  this loop is the recursion into the components to
+		# ensure they are initialized, it must be executed before
+		# any of what follows
 		for component in self.components:
-			self.unused_coincs |= set(component.get_coincs(eventlists, event_comparefunc, thresholds, verbose = verbose))
-		# of the (< n-1)-instrument coincs that were not used in
-		# forming the (n-1)-instrument coincs, any that remained
-		# unused after forming two compontents cannot have been
-		# used by any other components, they definitely won't be
-		# used to construct our n-instrument coincs, and so they go
-		# into our unused pile
-		for componenta, componentb in iterutils.choices(self.components, 2):
-			self.unused_coincs |= componenta.unused_coincs & componentb.unused_coincs
+			component.get_coincs(eventlists, event_comparefunc, thresholds, event_index, verbose = verbose, doubles_func = doubles_func)
 
 		if verbose:
 			print >>sys.stderr, "\tassembling %s ..." % str(self.offset_vector)
 		# magic:  we can form all n-instrument coincs by knowing
 		# just three sets of the (n-1)-instrument coincs no matter
-		# what n is (n > 2).  note that we pass verbose=False
-		# because we've already called the .get_coincs() methods
-		# above, these are no-ops to retrieve the answers again
-		allcoincs0 = self.components[0].get_coincs(eventlists, event_comparefunc, thresholds, verbose = False)
-		allcoincs1 = self.components[1].get_coincs(eventlists, event_comparefunc, thresholds, verbose = False)
-		allcoincs2 = self.components[-1].get_coincs(eventlists, event_comparefunc, thresholds, verbose = False)
-		# for each coinc in list 0
+		# what n is (n > 2).  the components have been constructed
+		# above, so we can use their coincs directly
+		allcoincs0 = self.components[0].coincs
+		allcoincs1 = self.components[1].coincs
+		allcoincs2 = self.components[-1].coincs
+		# the coincs in lists 1 and 2 are sorted, so their keys
+		# are, too.  the keys for list 1 are made from the first
+		# (n-2) event indexes of each coinc
+		keys1 = coinc_keys(allcoincs1[:, :-1])
+		keys2 = coinc_keys(allcoincs2)
+		coincs = []
+		# for each block of coincs in list 0
 		length = len(allcoincs0)
-		for n, coinc0 in enumerate(allcoincs0):
-			if verbose and not (n % 200):
-				print >>sys.stderr, "\t%.1f%%\r" % (100.0 * n / length),
+		for start in xrange(0, length, blocksize):
+			if verbose:
+				print >>sys.stderr, "\t%.1f%%\r" % (100.0 * start / length),
+			coincs0 = allcoincs0[start : start + blocksize]
 			# find all the coincs in list 1 whose first (n-2)
-			# event IDs are the same as the first (n-2) event
-			# IDs in coinc0.  note that they are guaranteed to
-			# be arranged together in the list of coincs and
-			# can be identified with two bisection searches
-			# note:  cannot use bisect_right() because we're
-			# only comparing against the first (n-2) of (n-1)
-			# things in each tuple, we need to use bisect_left
-			# after incrementing the last of the (n-2) things
-			# by one to obtain the correct range of indexes
-			coincs1 = allcoincs1[bisect.bisect_left(allcoincs1, coinc0[:-1]):bisect.bisect_left(allcoincs1, coinc0[:-2] + (coinc0[-2] + 1,))]
-			# find all the coincs in list 2 whose first (n-2)
-			# event IDs are the same as the last (n-2) event
-			# IDs in coinc0.  note that they are guaranteed to
-			# be arranged together in the list and can be
-			# identified with two bisection searches
-			coincs2 = allcoincs2[bisect.bisect_left(allcoincs2, coinc0[1:]):bisect.bisect_left(allcoincs2, coinc0[1:-1] + (coinc0[-1] + 1,))]
-			# for each coinc extracted from list 1 above search
-			# for a coinc extracted from list 2 above whose
-			# first (n-2) event IDs are the last (n-2) event
-			# IDs in coinc 0 and whose last event ID is the
-			# last event ID in coinc 1.  when found, the first
-			# ID from coinc 0 prepended to the (n-1) coinc IDs
-			# from coinc 2 forms an n-instrument coinc.  how
-			# this works is as follows:  coinc 0 and coinc 1,
-			# both (n-1)-instrument coincs, together identify a
-			# unique potential n-instrument coinc.  coinc 2's
-			# role is to confirm the coincidence by showing
-			# that the event from the instrument in coinc 1
-			# that isn't found in coinc 0 is coincident with
-			# all the other events that are in coinc 1.  if the
-			# coincidence holds then that combination of event
-			# IDs must be found in the coincs2 list, because we
-			# assume the coincs2 list is complete  the
-			# bisection search above to extract the coincs2
-			# list could be skipped, but by starting with a
-			# shorter list the bisection searches inside the
-			# following loop are faster.
-			for coinc1 in coincs1:
-				i = bisect.bisect_left(coincs2, coinc0[1:] + coinc1[-1:])
-				if i < len(coincs2) and coincs2[i] == coinc0[1:] + coinc1[-1:]:
-					new_coinc = coinc0[:1] + coincs2[i]
-					# break the new coinc into
-					# (n-1)-instrument components and
-					# remove them from the unused list
-					# because we just used them, then
-					# record the coinc and move on
-					self.unused_coincs -= set(iterutils.choices(new_coinc, len(new_coinc) - 1))
-					self.coincs.append(new_coinc)
+			# event indexes are the same as the first (n-2)
+			# event indexes in each coinc0.  they are
+			# guaranteed to be arranged together in the list
+			# of coincs and can be identified with two
+			# bisection searches.  expand the ranges into
+			# explicit (coinc0, coinc1) pairs
+			lo = numpy.searchsorted(keys1, coinc_keys(coincs0[:, :-1]), side = "left")
+			counts = numpy.searchsorted(keys1, coinc_keys(coincs0[:, :-1]), side = "right") - lo
+			total = counts.sum()
+			if not total:
+				continue
+			index0 = numpy.repeat(numpy.arange(len(coincs0)), counts)
+			index1 = numpy.arange(total) + numpy.repeat(lo - (numpy.cumsum(counts) - counts), counts)
+			# coinc 0 and coinc 1, both (n-1)-instrument
+			# coincs, together identify a unique potential
+			# n-instrument coinc:  the first event index of
+			# coinc 0 followed by the last (n-2) event indexes
+			# of coinc 0 and the last event index of coinc 1.
+			# list 2's role is to confirm the coincidence by
+			# showing that the event from the instrument in
+			# coinc 1 that isn't found in coinc 0 is coincident
+			# with all the other events that are in coinc 1.
+			# if the coincidence holds then the last (n-1)
+			# event indexes of the candidate must be found in
+			# list 2, because we assume list 2 is complete
+			candidates = numpy.hstack((coincs0[index0], allcoincs1[index1, -1:]))
+			candidate_keys = coinc_keys(candidates[:, 1:])
+			i = numpy.searchsorted(keys2, candidate_keys)
+			found = i < len(keys2)
+			found[found] = keys2[i[found]] == candidate_keys[found]
+			coincs.append(candidates[found])
 		if verbose:
 			print >>sys.stderr, "\t100.0%"
 		# sort the coincs we just constructed by the component
-		# event IDs and convert to a tuple for speed
-		self.coincs.sort()
-		self.coincs = tuple(self.coincs)
+		# event indexes
+		if coincs:
+			self.coincs = sort_coincs(numpy.concatenate(coincs))
+		else:
+			self.coincs = numpy.zeros((0, len(self.offset_vector)), dtype = "int32")
+
+		#
+		# record the coincs that have not been used.  unused_coincs
+		# is a dictionary mapping the alphabetically-sorted tuple
+		# of instruments to a sorted array of coincs involving
+		# those instruments
+		#
+
+		instruments = tuple(sorted(self.offset_vector))
+		unused_coincs = {}
+		# all coincs with n-1 instruments from the component time
+		# slides are potentially unused.  any that appear as a
+		# (n-1)-instrument component of one of our n-instrument
+		# coincs have been used
+		for component in self.components:
+			dropped, = [n for n, instrument in enumerate(instruments) if instrument not in component.offset_vector]
+			used = numpy.in1d(coinc_keys(component.coincs), coinc_keys(numpy.delete(self.coincs, dropped, axis = 1)))
+			unused_coincs.setdefault(tuple(sorted(component.offset_vector)), []).append(component.coincs[~used])
+		# of the (< n-1)-instrument coincs that were not used in
+		# forming the (n-1)-instrument coincs, any that remained
+		# unused after forming two compontents cannot have been
+		# used by any other components, they definitely won't be
+		# used to construct our n-instrument coincs, and so they go
+		# into our unused pile
+		for componenta, componentb in iterutils.choices(self.components, 2):
+			for key in set(componenta.unused_coincs) & set(componentb.unused_coincs):
+				unuseda, unusedb = componenta.unused_coincs[key], componentb.unused_coincs[key]
+				unused_coincs.setdefault(key, []).append(unuseda[numpy.in1d(coinc_keys(unuseda), coinc_keys(unusedb))])
+		for key, arrays in unused_coincs.items():
+			unused = numpy.concatenate(arrays)
+			unused = unused[numpy.unique(coinc_keys(unused), return_index = True)[1]]
+			if len(unused):
+				self.unused_coincs[key] = unused
 
 		#
 		# done.  we won't be back here again so unlink the graph as
 		# we go to release memory
 		#
 
+		self.retain()
+		for component in self.components:
+			component.consume()
 		self.components = None
 		return self.coincs
 
@@ -591,6 +969,7 @@ class TimeSlideGraph(object):
 
 			node.components = tuple(sorted((component for component in self.generations[len(node.offset_vector)] if node.deltas == component.deltas), key = lambda x: sorted(x.offset_vector)))
 			assert len(node.components) == 1
+			node.components[0].consumers += 1
 
 		for n, nodes in self.generations.items():
 			assert n >= 2	# failure indicates bug in code that constructed generations
@@ -600,6 +979,15 @@ class TimeSlideGraph(object):
 			for node in nodes:
 				component_deltas = set(frozenset(offset_vector.deltas.items()) for offset_vector in offsetvector.component_offsetvectors([node.offset_vector], n - 1))
 				node.components = tuple(sorted((component for component in self.generations[n - 1] if component.deltas in component_deltas), key = lambda x: sorted(x.offset_vector)))
+				for component in node.components:
+					component.consumers += 1
+
+		#
+		# streaming mode book-keeping (see .get_coincs())
+		#
+
+		self.retention = None
+		self.peak_retained_coincs = None
 
 		#
 		# done
@@ -612,22 +1000,126 @@ class TimeSlideGraph(object):
 			print >>sys.stderr, "\t%d offset vectors total" % sum(len(self.generations[n]) for n in self.generations)
 
 
-	def get_coincs(self, eventlists, event_comparefunc, thresholds, include_small_coincs = True, verbose = False):
+	def populate_parallel(self, eventlists, event_comparefunc, thresholds, event_index, nproc, verbose = False, doubles_func = get_doubles):
+		"""
+		Construct the coincs for all nodes in the graph's
+		generations using a pool of nproc worker processes.  The
+		nodes of each generation are independent of one another,
+		so the generations are built in order, starting with the
+		2-instrument leaf nodes, with the nodes within each
+		generation distributed across the pool.  A new pool is
+		started for each generation so that the workers inherit
+		the event lists and the coincs of the previous generations
+		from the parent process via fork();  they are not copied
+		or modified.  The workers return the sorted arrays of event
+		indexes, which are recorded in the nodes exactly as if they had
+		been constructed serially.
+
+		NOTE:  this relies on the fork() semantics of the
+		multiprocessing module on POSIX systems.
+		"""
+		global _pool_state
+		for n in sorted(self.generations):
+			indexes = [index for index, node in enumerate(self.generations[n]) if node.coincs is None]
+			if not indexes:
+				continue
+			if verbose:
+				print >>sys.stderr, "constructing %d %d-instrument offset vectors using %d processes ..." % (len(indexes), n, nproc)
+			_pool_state = (self, n, eventlists, event_comparefunc, thresholds, event_index, doubles_func)
+			pool = multiprocessing.Pool(nproc)
+			try:
+				results = pool.map(_pool_get_coincs, indexes, chunksize = 1)
+				pool.close()
+			except:
+				pool.terminate()
+				raise
+			finally:
+				pool.join()
+				_pool_state = None
+			for index, (coincs, unused_coincs) in zip(indexes, results):
+				node = self.generations[n][index]
+				node.coincs = coincs
+				node.unused_coincs = unused_coincs
+				node.retain()
+				# unlink the graph as we go to release memory
+				for component in node.components or ():
+					component.consume()
+				node.components = None
+
+	def get_coincs(self, eventlists, event_comparefunc, thresholds, include_small_coincs = True, verbose = False, doubles_func = get_doubles, nproc = 1, stream = False):
+		"""
+		Generate (node, coinc) tuples for the target offset vectors.
+		doubles_func is the function used to construct the
+		2-instrument coincs at the leaves of the graph.  The default
+		is get_doubles(), in which case event_comparefunc is the
+		scalar event comparison function.  To use the array-based
+		pair search engine pass get_doubles_array, in which case
+		event_comparefunc must be a batch comparison function (see
+		get_doubles_array() for more information).
+
+		If nproc is greater than 1 the graph's nodes are first
+		constructed with a pool of nproc worker processes (see
+		populate_parallel()).  The result is the same.
+
+		If stream is True, the intermediate nodes of the graph are
+		reference counted, and each one's coincs are freed as soon
+		as all of the nodes constructed from it have been built,
+		and each head node's coincs are freed after they have been
+		yielded.  The graph cannot be used again afterwards.  The
+		peak number of coincs retained by the graph's nodes
+		is recorded in the peak_retained_coincs attribute (and
+		reported if verbose is True) once the generator has been
+		exhausted.
+
+		Internally, events are represented by dense integer indexes
+		assigned in order of event ID, and each node's coincs are
+		stored as a sorted 2-D array of indexes.  The coincs are
+		converted back to tuples of event IDs as they are yielded.
+		"""
+		# map event IDs to dense integer indexes.  the indexes are
+		# assigned in order of event ID so that sorting coincs by
+		# index is the same as sorting them by ID
+		event_ids = sorted(event.event_id for eventlist in eventlists.values() for event in eventlist)
+		event_index = dict((event_id, n) for n, event_id in enumerate(event_ids))
+
+		if stream:
+			self.retention = RetentionCounter()
+			for node in itertools.chain(*self.generations.values()):
+				node.retention = self.retention
+		if nproc > 1:
+			self.populate_parallel(eventlists, event_comparefunc, thresholds, event_index, nproc, verbose = verbose, doubles_func = doubles_func)
 		if verbose:
 			print >>sys.stderr, "constructing coincs for target offset vectors ..."
 		for n, node in enumerate(self.head, start = 1):
 			if verbose:
 				print >>sys.stderr, "%d/%d: %s" % (n, len(self.head), str(node.offset_vector))
+			# the head node unlinks itself from its component
+			# when it is built, so remember it
+			component, = node.components
 			if include_small_coincs:
 				# note that unused_coincs must be retrieved
 				# after the call to .get_coincs() because
 				# the former is computed as a side effect
 				# of the latter
-				iterator = itertools.chain(node.get_coincs(eventlists, event_comparefunc, thresholds, verbose), node.unused_coincs)
+				iterator = itertools.chain(node.get_coincs(eventlists, event_comparefunc, thresholds, event_index, verbose, doubles_func = doubles_func), *(node.unused_coincs[key] for key in sorted(node.unused_coincs)))
 			else:
-				iterator = node.get_coincs(eventlists, event_comparefunc, thresholds, verbose)
+				iterator = node.get_coincs(eventlists, event_comparefunc, thresholds, event_index, verbose, doubles_func = doubles_func)
 			for coinc in iterator:
-				yield node, coinc
+				yield node, tuple(event_ids[i] for i in coinc)
+			if stream:
+				# head nodes share their coincs with their
+				# component, so it's only when we are done
+				# with the head node that the memory can be
+				# released
+				del iterator
+				node.coincs = None
+				node.unused_coincs = None
+				node.released = True
+				component.consume()
+		if stream:
+			self.peak_retained_coincs = self.retention.peak
+			if verbose:
+				print >>sys.stderr, "peak number of coincs retained: %d" % self.peak_retained_coincs
 
 
 	def write(self, fileobj):
@@ -1578,6 +2070,22 @@ class CoincParamsDistributions(object):
 		self.background_lnpdf_interp = {}
 		self.injection_lnpdf_interp = {}
 		self.process_id = process_id
+		# results of .finish() for each histogram, indexed by
+		# content hash.  see .finish()
+		self._finish_cache = {}
+
+	@staticmethod
+	def _mkinterp(binnedarray):
+		"""
+		Construct an interpolator for the natural logarithm of the
+		PDF in binnedarray.  For internal use only.
+		"""
+		with numpy.errstate(invalid = "ignore"):
+			assert not (binnedarray.array < 0.).any()
+		binnedarray = binnedarray.copy()
+		with numpy.errstate(divide = "ignore"):
+			binnedarray.array = numpy.log(binnedarray.array)
+		return rate.InterpBinnedArray(binnedarray, fill_value = NegInf)
 
 	def _rebuild_interpolators(self):
 		"""
@@ -1587,13 +2095,7 @@ class CoincParamsDistributions(object):
 		self.zero_lag_lnpdf_interp.clear()
 		self.background_lnpdf_interp.clear()
 		self.injection_lnpdf_interp.clear()
-		def mkinterp(binnedarray):
-			with numpy.errstate(invalid = "ignore"):
-				assert not (binnedarray.array < 0.).any()
-			binnedarray = binnedarray.copy()
-			with numpy.errstate(divide = "ignore"):
-				binnedarray.array = numpy.log(binnedarray.array)
-			return rate.InterpBinnedArray(binnedarray, fill_value = NegInf)
+		mkinterp = self._mkinterp
 		for key, binnedarray in self.zero_lag_pdf.items():
 			self.zero_lag_lnpdf_interp[key] = mkinterp(binnedarray)
 		for key, binnedarray in self.background_pdf.items():
@@ -1695,6 +2197,40 @@ class CoincParamsDistributions(object):
 				# param value out of range
 				pass
 
+	@staticmethod
+	def _fill(rates_dict, params, weights):
+		"""
+		For internal use.
+		"""
+		for param, coords in params.items():
+			rates_dict[param].fill(coords, weights = weights, skip_out_of_range = True)
+
+	def fill_zero_lag(self, params, weights = None):
+		"""
+		Bulk version of .add_zero_lag().  params is a dictionary
+		mapping histogram name to a sequence of arrays, one for
+		each dimension of that histogram, giving the co-ordinates
+		of many events.  weights is an array of the events'
+		weights, or None to give each a weight of 1.  Events whose
+		co-ordinates are out of range are ignored.  The result is
+		the same as calling .add_zero_lag() for each event.
+		"""
+		self._fill(self.zero_lag_rates, params, weights)
+
+	def fill_background(self, params, weights = None):
+		"""
+		Bulk version of .add_background().  See .fill_zero_lag()
+		for more information.
+		"""
+		self._fill(self.background_rates, params, weights)
+
+	def fill_injection(self, params, weights = None):
+		"""
+		Bulk version of .add_injection().  See .fill_zero_lag() for
+		more information.
+		"""
+		self._fill(self.injection_rates, params, weights)
+
 	def default_pdf_from_rates(self, key, pdf_dict):
 		"""
 		For internal use by the CoincParamsDistributions class.
@@ -1704,7 +2240,53 @@ class CoincParamsDistributions(object):
 			rate.filter_array(binnedarray.array, self.filters[key])
 		binnedarray.to_pdf()
 
-	def finish(self, verbose = False):
+	def _pdf_from_rates_func(self, key):
+		"""
+		Return the function that converts the bin counts for key
+		into a PDF.  For internal use only.
+		"""
+		try:
+			return self.pdf_from_rates_func[key]
+		except KeyError:
+			return self.default_pdf_from_rates
+
+	def _finish_digest(self, msg, key, binnedarray):
+		"""
+		Compute the content hash used to index the .finish() cache,
+		or return None if the histogram's result cannot be cached.
+		Only the results of the default function and of None are
+		cached;  other functions can depend on anything, including
+		the other entries of the PDF dictionary, so they are run
+		every time.  The hash covers the category (zero lag,
+		background or injections), key, the bin counts, the
+		binning, the function and, if there is one, the smoothing
+		filter for key.  For internal use only.
+		"""
+		func = self._pdf_from_rates_func(key)
+		if func is not None and func != self.default_pdf_from_rates:
+			return None
+		h = hashlib.sha1()
+		h.update(repr((msg, key, func is None, binnedarray.array.shape, binnedarray.array.dtype.str, [(binning.lower().tolist(), binning.upper().tolist()) for binning in binnedarray.bins])))
+		h.update(numpy.ascontiguousarray(binnedarray.array).view(numpy.uint8))
+		if key in self.filters:
+			h.update(numpy.ascontiguousarray(self.filters[key]).view(numpy.uint8))
+		return h.hexdigest()
+
+	def _finish_one(self, job):
+		"""
+		Compute and return the PDF and ln PDF interpolator for one
+		histogram whose result can be cached.  job is a (msg, key,
+		binnedarray) tuple.  For internal use by .finish().
+		"""
+		msg, key, binnedarray = job
+		assert numpy.isfinite(binnedarray.array).all() and (binnedarray.array >= 0).all(), "%s %s counts are not valid" % (key, msg)
+		pdf_dict = {key: binnedarray.copy()}
+		pdf_from_rates_func = self._pdf_from_rates_func(key)
+		if pdf_from_rates_func is not None:
+			pdf_from_rates_func(key, pdf_dict)
+		return pdf_dict[key], self._mkinterp(pdf_dict[key])
+
+	def finish(self, verbose = False, nproc = 1):
 		"""
 		Populate the discrete PDF dictionaries from the contents of
 		the rates dictionaries, and then the PDF interpolator
@@ -1714,36 +2296,100 @@ class CoincParamsDistributions(object):
 		instance, and converted to normalized PDFs using the bin
 		volumes.  Finally the dictionary of PDF interpolators is
 		populated from the discretely sampled PDF data.
-		"""
-		#
-		# convert raw bin counts into normalized PDFs
-		#
 
+		The functions in the pdf_from_rates_func dictionary are
+		passed the key and the PDF dictionary (zero lag, background
+		or injections) in which the PDF for that key is to be
+		computed, which contains the PDFs computed before it.  They
+		are called one at a time, in the order of the rates
+		dictionary, whatever the value of nproc.  The histograms
+		converted with the default function, or with None, are
+		processed by a pool of nproc threads if nproc is greater
+		than 1.
+
+		The results of the default function and of None are
+		remembered, indexed by a hash of the bin counts, the
+		binning, and the smoothing filter.  When .finish() is
+		called again, for example after more counts have been
+		merged in with +=, those histograms whose contents have not
+		changed are not re-processed.
+		"""
 		self.zero_lag_pdf.clear()
 		self.background_pdf.clear()
 		self.injection_pdf.clear()
-		progressbar = ProgressBar(text = "Computing Parameter PDFs", max = len(self.zero_lag_rates) + len(self.background_rates) + len(self.injection_rates)) if verbose else None
-		for key, (msg, rates_dict, pdf_dict) in itertools.chain(
-				zip(self.zero_lag_rates, itertools.repeat(("zero lag", self.zero_lag_rates, self.zero_lag_pdf))),
-				zip(self.background_rates, itertools.repeat(("background", self.background_rates, self.background_pdf))),
-				zip(self.injection_rates, itertools.repeat(("injections", self.injection_rates, self.injection_pdf)))
-		):
-			assert numpy.isfinite(rates_dict[key].array).all() and (rates_dict[key].array >= 0).all(), "%s %s counts are not valid" % (key, msg)
-			pdf_dict[key] = rates_dict[key].copy()
+		self.zero_lag_lnpdf_interp.clear()
+		self.background_lnpdf_interp.clear()
+		self.injection_lnpdf_interp.clear()
+		categories = (
+			("zero lag", self.zero_lag_rates, self.zero_lag_pdf, self.zero_lag_lnpdf_interp),
+			("background", self.background_rates, self.background_pdf, self.background_lnpdf_interp),
+			("injections", self.injection_rates, self.injection_pdf, self.injection_lnpdf_interp)
+		)
+		progressbar = ProgressBar(text = "Computing Parameter PDFs", max = sum(len(rates_dict) for msg, rates_dict, pdf_dict, interp_dict in categories)) if verbose else None
+
+		#
+		# work out which of the histograms that can be cached need
+		# to be processed
+		#
+
+		jobs = []
+		results = []
+		for msg, rates_dict, pdf_dict, interp_dict in categories:
+			for key, binnedarray in rates_dict.items():
+				digest = self._finish_digest(msg, key, binnedarray)
+				results.append((msg, key, binnedarray, pdf_dict, interp_dict, digest))
+				if digest is not None and digest not in self._finish_cache:
+					jobs.append((digest, (msg, key, binnedarray)))
+		if progressbar is not None:
+			progressbar.increment(delta = len([digest for msg, key, binnedarray, pdf_dict, interp_dict, digest in results if digest is not None]) - len(jobs))
+
+		#
+		# convert their raw bin counts into normalized PDFs and
+		# build interpolators
+		#
+
+		cache = dict((digest, self._finish_cache[digest]) for msg, key, binnedarray, pdf_dict, interp_dict, digest in results if digest in self._finish_cache)
+		if nproc > 1 and len(jobs) > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(min(nproc, len(jobs)))
 			try:
-				pdf_from_rates_func = self.pdf_from_rates_func[key]
-			except KeyError:
-				pdf_from_rates_func = self.default_pdf_from_rates
-			if pdf_from_rates_func is not None:
-				pdf_from_rates_func(key, pdf_dict)
-			if progressbar is not None:
-				progressbar.increment()
+				for (digest, job), result in zip(jobs, pool.imap(self._finish_one, [job for digest, job in jobs])):
+					cache[digest] = result
+					if progressbar is not None:
+						progressbar.increment()
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			for digest, job in jobs:
+				cache[digest] = self._finish_one(job)
+				if progressbar is not None:
+					progressbar.increment()
 
 		#
-		# rebuild interpolators
+		# fill the PDF dictionaries in order, running the other
+		# functions as their keys come up so each sees the PDFs
+		# computed so far in its dictionary.  the cache retains
+		# only the histograms in use, and keeps private copies of
+		# the PDFs so the contents of the PDF dictionaries can be
+		# modified without corrupting it
 		#
 
-		self._rebuild_interpolators()
+		computed = []
+		for msg, key, binnedarray, pdf_dict, interp_dict, digest in results:
+			if digest is not None:
+				pdf, interp_dict[key] = cache[digest]
+				pdf_dict[key] = pdf.copy()
+				continue
+			assert numpy.isfinite(binnedarray.array).all() and (binnedarray.array >= 0).all(), "%s %s counts are not valid" % (key, msg)
+			pdf_dict[key] = binnedarray.copy()
+			self._pdf_from_rates_func(key)(key, pdf_dict)
+			computed.append((key, pdf_dict, interp_dict))
+			if progressbar is not None:
+				progressbar.increment()
+		for key, pdf_dict, interp_dict in computed:
+			interp_dict[key] = self._mkinterp(pdf_dict[key])
+		self._finish_cache = cache
 
 	def lnP_noise(self, params):
 		"""
@@ -1795,6 +2441,57 @@ class CoincParamsDistributions(object):
 		__getitem__ = self.injection_lnpdf_interp.__getitem__
 		return sum(__getitem__(name)(*value) for name, value in params.items())
 
+	def random_params(self):
+		"""
+		Generator that yields an unending sequence of 2-element
+		tuples.  Each tuple's first element is a dictionary mapping
+		each parameter name to a tuple of co-ordinates drawn at
+		random from that parameter's binning (see
+		rate.NDBins.randcoord()), and its second element is the
+		natural logarithm of the probability density from which
+		the parameters have been drawn evaluated at the
+		parameters.  The sequence is suitable for input to
+		LnLikelihoodRatio.samples().  Sub-classes that require a
+		different distribution can override this method (and
+		.random_params_block()).
+		"""
+		names = tuple(self.binnings)
+		coordgens = tuple(iter(self.binnings[name].randcoord()).next for name in names)
+		while 1:
+			seq = tuple(coordgen() for coordgen in coordgens)
+			yield dict(zip(names, (coords for coords, lnP in seq))), sum(lnP for coords, lnP in seq)
+
+	def random_params_block(self, n, rng = None):
+		"""
+		Draw n sets of parameters at once, from the same
+		distribution as .random_params().  Returns a 2-element
+		tuple whose first element is a dictionary mapping each
+		parameter name to a tuple of arrays, one for each
+		co-ordinate, and whose second element is an array of the
+		natural logarithms of the probability densities from which
+		the parameters have been drawn.  The co-ordinates are
+		generated with rate.NDBins.randcoord_block(), see that
+		method for the meaning of rng.  The parameter dictionary
+		is in the form accepted by LnLikelihoodRatio.batch().
+		"""
+		rng = rate._get_rng(rng)
+		params = {}
+		lnP = numpy.zeros(n, dtype = "double")
+		for name, binning in self.binnings.items():
+			params[name], lnP_name = binning.randcoord_block(n, rng = rng)
+			lnP += lnP_name
+		return params, lnP
+
+	def random_params_blocks(self, n, rng = None):
+		"""
+		Generator that yields an unending sequence of blocks of n
+		sets of parameters, as returned by .random_params_block(),
+		for input to LnLikelihoodRatio.samples_batch().
+		"""
+		rng = rate._get_rng(rng)
+		while 1:
+			yield self.random_params_block(n, rng = rng)
+
 	def get_xml_root(self, xml, name):
 		"""
 		Sub-classes can use this in their overrides of the
@@ -1871,6 +2568,72 @@ class CoincParamsDistributions(object):
 
 		return xml
 
+	@classmethod
+	def from_arrays(cls, arrays, name):
+		"""
+		Binary counterpart of .from_xml().  From the dictionary of
+		arrays, as returned by rate.load_arrays(), deserialize the
+		CoincParamsDistributions object named name and return it.
+		If the arrays were loaded with mmap = True the BinnedArray
+		objects' arrays are memory maps of the file.
+		"""
+		# create an instance
+		self = cls()
+
+		prefix = u"%s:%s" % (name, self.ligo_lw_name_suffix)
+		key = u"%s/process_id" % prefix
+		if key not in arrays:
+			raise ValueError("arrays must contain a CoincParamsDistributions object named %s" % name)
+
+		# retrieve the process ID
+		process_id = unicode(arrays[key][()])
+		self.process_id = ligolwtypes.ToPyType[u"ilwd:char"](process_id) if process_id else None
+
+		# reconstruct the BinnedArray objects
+		def reconstruct(group, target_dict):
+			group = u"%s/%s:" % (prefix, group)
+			suffix = u":pylal_rate_binnedarray/array"
+			for name in sorted(k[len(group):-len(suffix)] for k in arrays.keys() if k.startswith(group) and k.endswith(suffix)):
+				target_dict[str(name)] = rate.BinnedArray.from_arrays(arrays, u"%s%s" % (group, name))
+		reconstruct(u"zero_lag", self.zero_lag_rates)
+		reconstruct(u"zero_lag_pdf", self.zero_lag_pdf)
+		reconstruct(u"background", self.background_rates)
+		reconstruct(u"background_pdf", self.background_pdf)
+		reconstruct(u"injection", self.injection_rates)
+		reconstruct(u"injection_pdf", self.injection_pdf)
+
+		#
+		# rebuild interpolators
+		#
+
+		self._rebuild_interpolators()
+
+		#
+		# done
+		#
+
+		return self
+
+	def to_arrays(self, name):
+		"""
+		Binary counterpart of .to_xml().  Serialize this
+		CoincParamsDistributions object to a dictionary of arrays
+		suitable for rate.save_arrays(), giving it the name name.
+		"""
+		prefix = u"%s:%s" % (name, self.ligo_lw_name_suffix)
+		arrays = {u"%s/process_id" % prefix: numpy.array(unicode(self.process_id) if self.process_id is not None else u"")}
+		def store(group, source_dict):
+			for name, binnedarray in source_dict.items():
+				arrays.update(binnedarray.to_arrays(u"%s/%s:%s" % (prefix, group, name)))
+		store(u"zero_lag", self.zero_lag_rates)
+		store(u"zero_lag_pdf", self.zero_lag_pdf)
+		store(u"background", self.background_rates)
+		store(u"background_pdf", self.background_pdf)
+		store(u"injection", self.injection_rates)
+		store(u"injection_pdf", self.injection_pdf)
+
+		return arrays
+
 
 #
 # Likelihood Ratio
@@ -2005,3 +2768,85 @@ class LnLikelihoodRatio(object):
 				yield NegInf, lnP_signal - lnP_params, lnP_noise - lnP_params
 			else:
 				yield lnP_signal - lnP_noise, lnP_signal - lnP_params, lnP_noise - lnP_params
+
+	@staticmethod
+	def _lnL_from_arrays(lnP_noise, lnP_signal):
+		"""
+		Array version of the special-case handling in .__call__().
+		For internal use.
+		"""
+		with numpy.errstate(invalid = "ignore"):
+			lnL = lnP_signal - lnP_noise
+		# see .__call__() for description of special cases
+		lnL[numpy.isneginf(lnP_noise) & numpy.isneginf(lnP_signal)] = NegInf
+		if (numpy.isposinf(lnP_noise) & numpy.isposinf(lnP_signal)).any():
+			warnings.warn("inf/inf encountered")
+		return lnL
+
+	def batch(self, params, **kwargs):
+		"""
+		Compute the natural logarithms of the likelihood ratios for
+		many candidates at once.  params is a dictionary in the
+		format accepted by the .lnP_noise() and .lnP_signal()
+		methods, but with each parameter value replaced by a tuple
+		of arrays, one array for each co-ordinate, holding the
+		values for all the candidates (see random_params_blocks()).
+		The .lnP_noise() and .lnP_signal() methods must accept such
+		arrays;  the default implementations in
+		CoincParamsDistributions do.  The return value is an array
+		of ln likelihood ratios with the same special-case handling
+		as .__call__().
+		"""
+		lnP_noise = numpy.array(self.lnP_noise(params, **kwargs), dtype = "double", ndmin = 1)
+		lnP_signal = numpy.array(self.lnP_signal(params, **kwargs), dtype = "double", ndmin = 1)
+		return self._lnL_from_arrays(lnP_noise, lnP_signal)
+
+	def samples_batch(self, random_params_blocks, **kwargs):
+		"""
+		Block version of .samples().  random_params_blocks should
+		be a sequence (or generator) yielding 2-element tuples
+		whose first element is a dictionary of parameter arrays in
+		the format accepted by .batch() and whose second element is
+		an array of the natural logarithms of the probability
+		densities from which the parameters have been drawn, for
+		example the .random_params_blocks() generator of a
+		CoincParamsDistributions instance.  Yields an unending
+		sequence of 3-element tuples of arrays holding, for each
+		block, the same three quantities as .samples() yields for
+		each sample.
+		"""
+		for params, lnP_params in random_params_blocks:
+			lnP_noise = numpy.array(self.lnP_noise(params, **kwargs), dtype = "double", ndmin = 1)
+			lnP_signal = numpy.array(self.lnP_signal(params, **kwargs), dtype = "double", ndmin = 1)
+			yield self._lnL_from_arrays(lnP_noise, lnP_signal), lnP_signal - lnP_params, lnP_noise - lnP_params
+
+
+def random_params_blocks(random_params_seq, n):
+	"""
+	Group the 2-element (params, ln P(params)) tuples yielded by
+	random_params_seq into blocks of n, converting each block into the
+	columnar form used by LnLikelihoodRatio.batch() and
+	.samples_batch():  a dictionary mapping each parameter name to a
+	tuple of arrays, one per co-ordinate, and an array of the ln P
+	values.  Yields an unending sequence of blocks if
+	random_params_seq is unending.
+
+	This is for parameter generators that have no block form.  When
+	the parameters are drawn from the binnings of a
+	CoincParamsDistributions instance, its .random_params_blocks()
+	method generates the blocks directly and is much faster.
+
+	Example:
+
+	>>> seq = iter([({"snr": (4., 1.)}, -1.), ({"snr": (5., 2.)}, -2.)])
+	>>> params, lnP = next(random_params_blocks(seq, 2))
+	>>> [a.tolist() for a in params["snr"]], lnP.tolist()
+	([[4.0, 5.0], [1.0, 2.0]], [-1.0, -2.0])
+	"""
+	random_params_seq = iter(random_params_seq)
+	while True:
+		block = list(itertools.islice(random_params_seq, n))
+		if not block:
+			return
+		params, lnP = zip(*block)
+		yield dict((name, tuple(numpy.array(column) for column in zip(*(p[name] for p in params)))) for name in params[0]), numpy.array(lnP, dtype = "double")
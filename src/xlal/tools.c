@@ -29,6 +29,8 @@
 #include <Python.h>
 #include <structmember.h>
 #include <string.h>
+#include <numpy/arrayobject.h>
+#include <lal/Date.h>
 #include <lal/DetectorSite.h>
 #include <misc.h>
 #include <tools.h>
@@ -304,6 +306,116 @@ static PyObject *pylal_XLALCalculateEThincaParameter(PyObject *self, PyObject *a
 }
 
 
+/*
+ * Convert obj to a C-contiguous array of the given type with ndim
+ * dimensions, the first of which must have length n and, for
+ * 2-dimensional arrays, the second of which must have length m.  Returns
+ * a new reference or NULL on failure.
+ */
+
+
+static PyArrayObject *pylal_batch_array(PyObject *obj, int type, int ndim, npy_intp n, npy_intp m, const char *name)
+{
+	PyArrayObject *array = (PyArrayObject *) PyArray_FromAny(obj, PyArray_DescrFromType(type), ndim, ndim, NPY_CARRAY | NPY_FORCECAST, NULL);
+
+	if(!array)
+		return NULL;
+	if(PyArray_DIM(array, 0) != n || (ndim > 1 && PyArray_DIM(array, 1) != m)) {
+		PyErr_Format(PyExc_ValueError, "XLALCalculateEThincaParameterBatch() argument %s has the wrong shape", name);
+		Py_DECREF(array);
+		return NULL;
+	}
+
+	return array;
+}
+
+
+static PyObject *pylal_XLALCalculateEThincaParameterBatch(PyObject *self, PyObject *args)
+{
+	static InspiralAccuracyList accuracyparams;
+	static int accuracyparams_set = 0;
+	const char *ifo1, *ifo2;
+	PyObject *end1, *tau01, *tau31, *gamma1, *end2, *tau02, *tau32, *gamma2;
+	long long offset1, offset2;
+	double e_thinca_threshold;
+	PyArrayObject *arrays[8] = {NULL,};
+	PyArrayObject *result = NULL;
+	SnglInspiralTable row1, row2;
+	npy_intp n, i, k;
+	int j;
+
+	/* ifo, end_ns, tau0, tau3, Gamma, offset_ns (twice), threshold */
+	if(!PyArg_ParseTuple(args, "sOOOOLsOOOOLd:XLALCalculateEThincaParameterBatch", &ifo1, &end1, &tau01, &tau31, &gamma1, &offset1, &ifo2, &end2, &tau02, &tau32, &gamma2, &offset2, &e_thinca_threshold))
+		return NULL;
+
+	/* all arrays must have the length of the first */
+	arrays[0] = (PyArrayObject *) PyArray_FromAny(end1, PyArray_DescrFromType(NPY_INT64), 1, 1, NPY_CARRAY | NPY_FORCECAST, NULL);
+	if(!arrays[0])
+		goto done;
+	n = PyArray_DIM(arrays[0], 0);
+	if(!(arrays[1] = pylal_batch_array(tau01, NPY_FLOAT64, 1, n, 0, "tau0_1")))
+		goto done;
+	if(!(arrays[2] = pylal_batch_array(tau31, NPY_FLOAT64, 1, n, 0, "tau3_1")))
+		goto done;
+	if(!(arrays[3] = pylal_batch_array(gamma1, NPY_FLOAT64, 2, n, 10, "Gamma_1")))
+		goto done;
+	if(!(arrays[4] = pylal_batch_array(end2, NPY_INT64, 1, n, 0, "end_ns_2")))
+		goto done;
+	if(!(arrays[5] = pylal_batch_array(tau02, NPY_FLOAT64, 1, n, 0, "tau0_2")))
+		goto done;
+	if(!(arrays[6] = pylal_batch_array(tau32, NPY_FLOAT64, 1, n, 0, "tau3_2")))
+		goto done;
+	if(!(arrays[7] = pylal_batch_array(gamma2, NPY_FLOAT64, 2, n, 10, "Gamma_2")))
+		goto done;
+
+	result = (PyArrayObject *) PyArray_SimpleNew(1, &n, NPY_BOOL);
+	if(!result)
+		goto done;
+
+	if(!accuracyparams_set) {
+		memset(&accuracyparams, 0, sizeof(accuracyparams));
+		XLALPopulateAccuracyParams(&accuracyparams);
+		accuracyparams_set = 1;
+	}
+
+	/* scratch rows.  only the columns used by the e-thinca test are
+	 * populated */
+	memset(&row1, 0, sizeof(row1));
+	memset(&row2, 0, sizeof(row2));
+	strncpy(row1.ifo, ifo1, LIGOMETA_IFO_MAX - 1);
+	strncpy(row2.ifo, ifo2, LIGOMETA_IFO_MAX - 1);
+
+	for(i = 0; i < n; i++) {
+		double ethinca;
+
+		XLALINT8NSToGPS(&row1.end, ((npy_int64 *) PyArray_DATA(arrays[0]))[i] + offset1);
+		row1.tau0 = ((double *) PyArray_DATA(arrays[1]))[i];
+		row1.tau3 = ((double *) PyArray_DATA(arrays[2]))[i];
+		XLALINT8NSToGPS(&row2.end, ((npy_int64 *) PyArray_DATA(arrays[4]))[i] + offset2);
+		row2.tau0 = ((double *) PyArray_DATA(arrays[5]))[i];
+		row2.tau3 = ((double *) PyArray_DATA(arrays[6]))[i];
+		for(j = 0, k = 10 * i; j < 10; j++, k++) {
+			row1.Gamma[j] = ((double *) PyArray_DATA(arrays[3]))[k];
+			row2.Gamma[j] = ((double *) PyArray_DATA(arrays[7]))[k];
+		}
+
+		ethinca = XLALCalculateEThincaParameter(&row1, &row2, &accuracyparams);
+		if(XLAL_IS_REAL8_FAIL_NAN(ethinca)) {
+			/* failure to converge == not coincident */
+			XLALClearErrno();
+			((npy_bool *) PyArray_DATA(result))[i] = 0;
+		} else
+			((npy_bool *) PyArray_DATA(result))[i] = ethinca <= e_thinca_threshold;
+	}
+
+done:
+	for(j = 0; j < 8; j++)
+		Py_XDECREF(arrays[j]);
+
+	return (PyObject *) result;
+}
+
+
 /*
  * sngl_ringdown related coincidence stuff.
  */
@@ -360,6 +472,7 @@ static PyObject *pylal_XLAL3DRinca(PyObject *self, PyObject *args)
 static struct PyMethodDef methods[] = {
 	{"XLALSnglInspiralTimeError", pylal_XLALSnglInspiralTimeError, METH_VARARGS, "XLALSnglInspiralTimeError(row, threshold)\n\nFrom a sngl_inspiral event compute the \\Delta t interval corresponding to the given e-thinca threshold."},
 	{"XLALCalculateEThincaParameter", pylal_XLALCalculateEThincaParameter, METH_VARARGS, "XLALCalculateEThincaParameter(row1, row2)\n\nTakes two SnglInspiralTable objects and\ncalculates the overlap factor between them."},
+	{"XLALCalculateEThincaParameterBatch", pylal_XLALCalculateEThincaParameterBatch, METH_VARARGS, "XLALCalculateEThincaParameterBatch(ifo1, end_ns1, tau0_1, tau3_1, Gamma_1, offset_ns1, ifo2, end_ns2, tau0_2, tau3_2, Gamma_2, offset_ns2, threshold)\n\nApply the e-thinca test to many pairs of sngl_inspiral events in one call.\nEach end_ns is an array of integer nanosecond end times, each tau0 and\ntau3 an array of the same length, and each Gamma an (n, 10) array of\nmetric components.  The offsets, in integer nanoseconds, are added to\nthe end times.  Returns a boolean array that is True where the pair is\ncoincident."},
 	{"XLALRingdownTimeError", pylal_XLALRingdownTimeError, METH_VARARGS, "XLALRingdownTimeError(row, ds^2)\n\nFrom a sngl_ringdown event compute the \\Delta t interval corresponding to the given ds^2 threshold."},
 	{"XLAL3DRinca", pylal_XLAL3DRinca, METH_VARARGS, "XLAL3DRinca(row1, row)\n\nTakes two SnglRingdown objects and\ncalculates the distance, ds^2, between them."},
 	{NULL,}
@@ -372,6 +485,7 @@ PyMODINIT_FUNC inittools(void)
 	if(!module)
 		goto nomodule;
 
+	import_array();
 	pylal_snglinspiraltable_import();
 	pylal_snglringdowntable_import();
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from glue.ligolw import ilwd
+from glue.ligolw import ligolw
+from glue.ligolw import lsctables
+from glue.ligolw import utils
+from pylal import SnglInspiralUtils
+from pylal.xlal.datatypes.ligotimegps import LIGOTimeGPS
+
+
+def random_sngl_inspiral_table(n, rnd):
+    """
+    Return a sngl_inspiral table with every column set to random values
+    of the column's type.  The end times are spread over [1000, 1100).
+    """
+    sngls = lsctables.New(lsctables.SnglInspiralTable)
+    for i in range(n):
+        row = sngls.RowType()
+        for name, coltype in lsctables.SnglInspiralTable.validcolumns.items():
+            name = name.split(":")[-1]
+            if coltype == "int_4s":
+                value = rnd.randint(-1000, 1000)
+            elif coltype in ("real_4", "real_8"):
+                value = rnd.uniform(0., 20.)
+            elif coltype == "lstring":
+                value = rnd.choice([u"H1", u"L1", u"V1"])
+            else:
+                value = ilwd.ilwdchar(u"process:process_id:%d" % rnd.randint(0, 3))
+            setattr(row, name, value)
+        row.event_id = sngls.get_next_id()
+        row.end_time = rnd.randint(1000, 1099)
+        row.end_time_ns = rnd.choice([0, rnd.randint(0, 999999999)])
+        sngls.append(row)
+    return sngls
+
+
+def write_sngl_inspiral_file(filename, sngls):
+    xmldoc = ligolw.Document()
+    xmldoc.appendChild(ligolw.LIGO_LW()).appendChild(sngls)
+    utils.write_filename(xmldoc, filename, gz = filename.endswith(".gz"))
+    xmldoc.unlink()
+
+
+class SnglInspiralFilesTestCase(unittest.TestCase):
+    """
+    Writes a few sngl_inspiral files, one of them compressed and one of
+    them empty, for the tests to read back.
+    """
+    def setUp(self):
+        rnd = random.Random(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+        for i, n in enumerate((150, 0, 80, 200)):
+            filename = os.path.join(self.tmp_dir, "sngls%d.xml%s" % (i, i == 2 and ".gz" or ""))
+            write_sngl_inspiral_file(filename, random_sngl_inspiral_table(n, rnd))
+            self.files.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class test_columnar_loader(SnglInspiralFilesTestCase):
+    columns = ("ifo", "end_time", "end_time_ns", "snr", "chisq", "mass1", "event_id")
+
+    def assertSameTriggers(self, triggers, sngls, columns):
+        # the columnar loader keeps real_4 columns in single precision
+        self.assertEqual(len(triggers), len(sngls))
+        self.assertEqual(sorted(triggers.keys()), sorted(columns))
+        for name in columns:
+            self.assertEqual(triggers[name].tolist(), numpy.array([getattr(row, name) for row in sngls], dtype = triggers[name].dtype).tolist())
+
+    def test_matches_glue_reader(self):
+        """
+        the columnar loader must read the same triggers, in the same
+        order, as ReadSnglInspiralFromFiles() with the equivalent
+        filterFunc
+        """
+        for segment, snr_threshold in ((None, None), ((1020, 1080), None), (None, 10.), ((LIGOTimeGPS(1020, 500000000), None), 5.), ((None, 1050), 15.)):
+            def filterFunc(row):
+                if segment is not None:
+                    lo, hi = segment
+                    if lo is not None and row.get_end() < lo:
+                        return False
+                    if hi is not None and row.get_end() >= hi:
+                        return False
+                return snr_threshold is None or row.snr >= snr_threshold
+            sngls = SnglInspiralUtils.ReadSnglInspiralFromFiles(self.files, filterFunc = filterFunc)
+            self.assertTrue(0 < len(sngls) < 430 or (segment, snr_threshold) == (None, None))
+
+            triggers = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files, columns = self.columns, segment = segment, snr_threshold = snr_threshold)
+            self.assertSameTriggers(triggers, sngls, self.columns)
+
+            # the columns needed for the cuts need not be asked for
+            triggers = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files, columns = ("mass2",), segment = segment, snr_threshold = snr_threshold)
+            self.assertSameTriggers(triggers, sngls, ("mass2",))
+
+        # all columns
+        sngls = SnglInspiralUtils.ReadSnglInspiralFromFiles(self.files)
+        triggers = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files)
+        self.assertSameTriggers(triggers, sngls, [name.split(":")[-1] for name in lsctables.SnglInspiralTable.validcolumns])
+        # including the columns with upper case names
+        self.assertTrue("Gamma0" in triggers)
+        self.assertEqual(triggers.to_table()[0].Gamma0, numpy.float32(sngls[0].Gamma0))
+
+    def test_row_views(self):
+        """
+        the row views must give the values of the glue rows
+        """
+        sngls = SnglInspiralUtils.ReadSnglInspiralFromFiles(self.files)
+        triggers = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files, columns = self.columns)
+        self.assertEqual(len(list(triggers)), len(sngls))
+        for view, row in zip(triggers, sngls):
+            for name in self.columns:
+                self.assertEqual(getattr(view, name), triggers[name].dtype.type(getattr(row, name)))
+            self.assertEqual(view.get_end(), row.get_end())
+        self.assertEqual(triggers.row(-1).snr, numpy.float32(sngls[-1].snr))
+        self.assertRaises(IndexError, triggers.row, len(sngls))
+        self.assertRaises(AttributeError, getattr, triggers.row(0), "mass2")
+        self.assertEqual(triggers.get_end().tolist(), [float(row.get_end()) for row in sngls])
+
+        # to_table() builds rows with the loaded columns
+        table = triggers.to_table()
+        self.assertEqual(len(table), len(sngls))
+        for a, b in zip(table, sngls):
+            for name in self.columns:
+                self.assertEqual(getattr(a, name), triggers[name].dtype.type(getattr(b, name)))
+
+    def test_no_sngl_inspiral_table(self):
+        filename = os.path.join(self.tmp_dir, "empty.xml")
+        xmldoc = ligolw.Document()
+        xmldoc.appendChild(ligolw.LIGO_LW())
+        utils.write_filename(xmldoc, filename)
+        triggers = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles([filename] + self.files[:1], columns = self.columns)
+        self.assertEqual(len(triggers), 150)
+
+
+class test_nproc(SnglInspiralFilesTestCase):
+    def test_ReadSnglInspiralFromFiles(self):
+        """
+        reading with nproc > 1 must give the rows of nproc = 1, in the
+        same order, with filterFunc applied
+        """
+        names = [name.split(":")[-1] for name in lsctables.SnglInspiralTable.validcolumns]
+        # a lambda, which cannot be pickled
+        filterFunc = lambda row: 1020 <= row.end_time < 1080 and row.snr >= 5.
+        for kwargs in ({}, {"filterFunc": filterFunc}):
+            serial = SnglInspiralUtils.ReadSnglInspiralFromFiles(self.files, **kwargs)
+            self.assertTrue(len(serial) > 0)
+            for nproc in (2, 4):
+                concurrent = SnglInspiralUtils.ReadSnglInspiralFromFiles(self.files, nproc = nproc, **kwargs)
+                self.assertEqual([[getattr(row, name) for name in names] for row in concurrent], [[getattr(row, name) for name in names] for row in serial])
+        self.assertTrue(len(serial) < 430)
+        self.assertEqual(filter(filterFunc, serial), list(serial))
+
+    def test_ReadSnglInspiralColumnsFromFiles(self):
+        """
+        the columnar loader must also give the same triggers with
+        nproc > 1
+        """
+        for segment, snr_threshold in ((None, None), ((1020, 1080), 5.)):
+            serial = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files, segment = segment, snr_threshold = snr_threshold)
+            for nproc in (2, 4):
+                concurrent = SnglInspiralUtils.ReadSnglInspiralColumnsFromFiles(self.files, segment = segment, snr_threshold = snr_threshold, nproc = nproc)
+                self.assertEqual(sorted(concurrent.keys()), sorted(serial.keys()))
+                for name in serial.keys():
+                    self.assertEqual(concurrent[name].tolist(), serial[name].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import json
+import tempfile
+import time
+import unittest
+
+from glue.lal import Cache, CacheEntry
+from pylal.dq import dqTriggerUtils
+
+
+def write_kw_file(filename, n, rnd):
+    """
+    Write n random triggers in KW format, with peak times in [1000, 1100)
+    """
+    f = open(filename, "w")
+    f.write("# start stop peak freq energy amplitude n_pix significance\n")
+    for i in range(n):
+        peak = rnd.uniform(1000., 1100.)
+        duration = rnd.uniform(0.01, 1.)
+        n_pix = rnd.randint(1, 10)
+        f.write("%.6f %.6f %.6f %.3f %.3f %.3f %d %.3f\n" % (peak - duration / 2, peak + duration / 2, peak, rnd.uniform(30., 2000.), rnd.uniform(1., 100.), n_pix + rnd.uniform(0., 400.), n_pix, rnd.uniform(0., 50.)))
+    f.close()
+
+
+def rows(table):
+    return [[getattr(row, name, None) for name in row.__slots__] for row in table]
+
+
+class test_fromLALCache(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = Cache()
+        for i, n in enumerate((100, 0, 60, 150, 30)):
+            filename = os.path.join(self.tmp_dir, "H1-KW_TEST-%d-100.trg" % (1000 + i))
+            write_kw_file(filename, n, rnd)
+            self.cache.append(CacheEntry.from_T050017(filename))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_nproc(self):
+        """
+        reading the cache with nproc > 1 must give the rows of nproc = 1,
+        in the same order, with the time and SNR cuts applied
+        """
+        everything = dqTriggerUtils.fromLALCache(self.cache, "kw")
+        self.assertEqual(len(everything), 340)
+        for start, end, snr in ((None, None, False), (1020, 1080, False), (None, None, 10.), (1010, 1090, 12.)):
+            serial = dqTriggerUtils.fromLALCache(self.cache, "kw", start = start, end = end, snr = snr)
+            self.assertTrue(0 < len(serial) < len(everything) or (start, end, snr) == (None, None, False))
+            if start is not None:
+                self.assertTrue(min(float(row.get_peak()) for row in serial) >= start)
+            if end is not None:
+                self.assertTrue(max(float(row.get_peak()) for row in serial) <= end)
+            if snr:
+                self.assertTrue(min(row.snr for row in serial) > snr)
+            # with nproc > 1 the parent only rebuilds the rows the
+            # workers send back, so the cuts must have been made there
+            for nproc in (2, 4):
+                concurrent = dqTriggerUtils.fromLALCache(self.cache, "kw", start = start, end = end, snr = snr, nproc = nproc)
+                self.assertEqual(type(concurrent), type(serial))
+                self.assertEqual(rows(concurrent), rows(serial))
+
+
+class test_TriggerCache(unittest.TestCase):
+    # rows with duration set hold LIGOTimeGPS objects, which the cache
+    # does not store
+    columns = ("peak_time", "peak_time_ns", "start_time", "start_time_ns", "central_freq", "snr", "confidence")
+
+    def read(self, **kwargs):
+        return dqTriggerUtils.fromkwfile(self.filename, columns = list(self.columns), **kwargs)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "H1-KW_TEST-1000-100.trg")
+        write_kw_file(self.filename, 50, random.Random(0))
+        self.cache = dqTriggerUtils.TriggerCache(os.path.join(self.tmp_dir, "cache"))
+        self.table = self.read()
+
+    def tearDown(self):
+        dqTriggerUtils.set_trigger_cache(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key(self):
+        """
+        the key must change with the file's size and mtime, the reader
+        and its arguments
+        """
+        key = self.cache.key(self.filename, "fromkwfile", ((), []))
+        self.assertEqual(self.cache.key(self.filename, "fromkwfile", ((), [])), key)
+        self.assertNotEqual(self.cache.key(self.filename, "fromomegafile", ((), [])), key)
+        self.assertNotEqual(self.cache.key(self.filename, "fromkwfile", ((1020,), [])), key)
+        self.assertEqual(self.cache.key(os.path.join(self.tmp_dir, "missing"), "fromkwfile", ((), [])), None)
+
+        stat = os.stat(self.filename)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+        mtime_key = self.cache.key(self.filename, "fromkwfile", ((), []))
+        self.assertNotEqual(mtime_key, key)
+
+        # same mtime, different size
+        open(self.filename, "a").write("\n")
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEqual(self.cache.key(self.filename, "fromkwfile", ((), [])), mtime_key)
+
+    def test_round_trip(self):
+        """
+        get() must return the table that was put()
+        """
+        self.assertEqual(self.cache.get("a"), None)
+        self.cache.put("a", self.table)
+        out = self.cache.get("a")
+        self.assertEqual(type(out), type(self.table))
+        self.assertEqual(rows(out), rows(self.table))
+
+        empty = self.read(start = 1, end = 2)
+        self.assertEqual(len(empty), 0)
+        self.cache.put("b", empty)
+        self.assertEqual(len(self.cache.get("b")), 0)
+
+        # an entry for a table lsctables does not know is a miss
+        entry = json.load(open(os.path.join(self.cache.directory, "a.json")))
+        entry["table"] = "no_such_table"
+        json.dump(entry, open(os.path.join(self.cache.directory, "a.json"), "w"))
+        self.assertEqual(self.cache.get("a"), None)
+
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_reader(self):
+        """
+        the readers must use the cache, and re-read a changed file
+        """
+        dqTriggerUtils.set_trigger_cache(self.cache.directory)
+        first = self.read(start = 1020, end = 1080)
+        self.assertEqual(len([name for name in os.listdir(self.cache.directory) if name.endswith(".npy")]), 1)
+        self.assertEqual(rows(self.read(start = 1020, end = 1080)), rows(first))
+        self.assertEqual(len(os.listdir(self.cache.directory)), 2)
+
+        write_kw_file(self.filename, 20, random.Random(1))
+        stat = os.stat(self.filename)
+        os.utime(self.filename, (stat.st_atime, stat.st_mtime + 10))
+        dqTriggerUtils.set_trigger_cache(None)
+        expected = self.read(start = 1020, end = 1080)
+        dqTriggerUtils.set_trigger_cache(self.cache.directory)
+        self.assertEqual(rows(self.read(start = 1020, end = 1080)), rows(expected))
+        self.assertNotEqual(rows(expected), rows(first))
+
+    def test_eviction(self):
+        """
+        the least recently used entries must be removed to keep the
+        cache within maxsize
+        """
+        for key in "abc":
+            self.cache.put(key, self.table)
+        size = os.path.getsize(os.path.join(self.cache.directory, "a.npy"))
+        # make the order of last use a, b, c, then use a
+        for i, key in enumerate("abc"):
+            os.utime(os.path.join(self.cache.directory, key + ".npy"), (time.time(), 1000 + i))
+        self.assertNotEqual(self.cache.get("a"), None)
+
+        self.cache.maxsize = 2 * size
+        self.cache.put("d", self.table)
+        self.assertEqual(sorted(os.listdir(self.cache.directory)), ["a.json", "a.npy", "d.json", "d.npy"])
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(rows(self.cache.get("d")), rows(self.table))
+
+
+if __name__ == '__main__':
+    unittest.main()
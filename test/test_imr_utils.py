@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from glue import segments
+from glue.ligolw import lsctables
+from pylal import imr_utils
+
+
+#
+# DataBaseSummary.add_database() needs complete search databases, so the
+# tests replace it with this, which makes up a summary from the contents
+# of a small text file:  "<numslides> <n>" for a non-injection database,
+# "injections <n>" for an injection database.  As for real databases, the
+# summary depends only on the contents
+#
+
+
+def fake_add_database(self, f, live_time_program = None, veto_segments_name = None, data_segments_name = "datasegments", tmp_path = None, verbose = False):
+	fake_add_database.calls.append(f)
+	contents = open(f).read()
+	rnd = random.Random(contents)
+	instruments = frozenset(["H1", "L1"])
+	self.table_name = self.table_name or "coinc_inspiral"
+	if not contents.startswith("injections"):
+		self.distinct_numslides.add(int(contents.split()[0]))
+		self._update_numslides()
+		self.instruments.add(instruments)
+		t = rnd.randint(0, 1000)
+		self.segments += segments.segmentlistdict({"H1": segments.segmentlist([segments.segment(lsctables.LIGOTimeGPS(t), lsctables.LIGOTimeGPS(t + 100, 5))])})
+		self.zerolag_fars_by_instrument_set.setdefault(instruments, []).append(rnd.random())
+		self.ts_fars_by_instrument_set.setdefault(instruments, []).extend(rnd.random() for i in range(3))
+	else:
+		distances = [rnd.random() for i in range(4)]
+		self.found_injections_by_instrument_set.setdefault(instruments, []).extend((rnd.random(), distance) for distance in distances[:2])
+		self.total_injections_by_instrument_set.setdefault(instruments, []).extend(distances)
+		self.missed_injections_by_instrument_set.setdefault(instruments, []).extend(distances[2:])
+
+
+def summary_contents(summary):
+	return (summary.table_name, summary.numslides, summary.distinct_numslides, dict(summary.segments), summary.instruments, summary.found_injections_by_instrument_set, summary.total_injections_by_instrument_set, summary.missed_injections_by_instrument_set, summary.zerolag_fars_by_instrument_set, summary.ts_fars_by_instrument_set)
+
+
+class test_DataBaseSummary(unittest.TestCase):
+	def setUp(self):
+		self.add_database = imr_utils.DataBaseSummary.add_database
+		imr_utils.DataBaseSummary.add_database = fake_add_database
+		fake_add_database.calls = []
+		self.tmp_dir = tempfile.mkdtemp()
+		self.cache_dir = os.path.join(self.tmp_dir, "cache")
+		os.mkdir(self.cache_dir)
+		self.files = [self.database("%d.sqlite" % i, "%s %d" % (i % 3 and "50" or "injections", i)) for i in range(9)]
+
+	def tearDown(self):
+		imr_utils.DataBaseSummary.add_database = self.add_database
+		shutil.rmtree(self.tmp_dir)
+
+	def database(self, name, contents):
+		filename = os.path.join(self.tmp_dir, name)
+		open(filename, "w").write(contents)
+		return filename
+
+	def test_merge(self):
+		"""
+		merging the summaries of single databases in any grouping must
+		give the summary of them all
+		"""
+		expected = summary_contents(imr_utils.DataBaseSummary(self.files))
+		self.assertEqual(expected[1], 50)
+		self.assertEqual(expected[2], set([50]))
+
+		partials = [imr_utils.summarize_database(f) for f in self.files]
+		first = imr_utils.DataBaseSummary([])
+		for partial in partials[:4]:
+			first += partial
+		second = imr_utils.DataBaseSummary([])
+		for partial in partials[4:]:
+			second += partial
+		first += second
+		self.assertEqual(summary_contents(first), expected)
+
+		self.assertEqual(summary_contents(imr_utils.DataBaseSummary(self.files, nproc = 3)), expected)
+
+		# no non-injection databases
+		self.assertEqual(imr_utils.DataBaseSummary(self.files[::3]).numslides, 0)
+
+	def test_numslides_mismatch(self):
+		"""
+		databases with different numbers of slides must not be merged
+		"""
+		other = self.database("other.sqlite", "10 0")
+		self.assertRaises(ValueError, imr_utils.DataBaseSummary, self.files + [other])
+		summary = imr_utils.summarize_database(self.files[1])
+		self.assertRaises(ValueError, summary.__iadd__, imr_utils.summarize_database(other))
+
+	def test_cache(self):
+		"""
+		summaries read back from the cache must be those that were
+		written, and only new or changed databases are read again
+		"""
+		expected = summary_contents(imr_utils.DataBaseSummary(self.files))
+		fake_add_database.calls = []
+		self.assertEqual(summary_contents(imr_utils.DataBaseSummary(self.files, nproc = 3, cache_dir = self.cache_dir)), expected)
+		self.assertEqual(len(os.listdir(self.cache_dir)), len(self.files))
+
+		fake_add_database.calls = []
+		self.assertEqual(summary_contents(imr_utils.DataBaseSummary(self.files, cache_dir = self.cache_dir)), expected)
+		self.assertEqual(fake_add_database.calls, [])
+
+		open(self.files[1], "w").write("60 1")
+		new = self.database("new.sqlite", "injections 9")
+		self.assertRaises(ValueError, imr_utils.DataBaseSummary, self.files + [new], cache_dir = self.cache_dir)
+		self.assertEqual(fake_add_database.calls, [self.files[1]])
+		fake_add_database.calls = []
+		summary = imr_utils.DataBaseSummary(self.files[::3] + [self.files[1], new], cache_dir = self.cache_dir)
+		self.assertEqual(summary.numslides, 60)
+		self.assertEqual(fake_add_database.calls, [new])
+
+	def test_cache_write_failure(self):
+		"""
+		a summary that cannot be written to the cache must not leave a
+		file behind
+		"""
+		def add_database(self, *args, **kwargs):
+			fake_add_database(self, *args, **kwargs)
+			# functions cannot be pickled
+			self.unpicklable = lambda: None
+		imr_utils.DataBaseSummary.add_database = add_database
+		self.assertRaises(Exception, imr_utils.summarize_database, self.files[0], cache_dir = self.cache_dir)
+		self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+#
+# the zero lag segment test as it was done before get_event_fars() made it
+# on arrays:  in the database, with a function calling
+# time_within_segments() for each event
+#
+
+
+def coalesced(seglist):
+	# segmentlist.__contains__() bisects, so time_within_segments() needs
+	# a coalesced list
+	if seglist is None:
+		return None
+	return segments.segmentlist(seglist).coalesce()
+
+
+def sql_event_fars(connection, segments):
+	segments = coalesced(segments)
+	connection.create_function("event_in_requested_segments", 2, lambda end_time, end_time_ns: imr_utils.time_within_segments(end_time, end_time_ns, segments))
+	return [(frozenset(lsctables.instrument_set_from_ifos(inst)), far, ts) for inst, far, ts in connection.cursor().execute('SELECT coinc_event.instruments, coinc_inspiral.combined_far AS combined_far, EXISTS(SELECT * FROM time_slide WHERE time_slide.time_slide_id == coinc_event.time_slide_id AND time_slide.offset != 0) FROM coinc_inspiral JOIN coinc_event ON (coinc_inspiral.coinc_event_id == coinc_event.coinc_event_id) WHERE event_in_requested_segments(coinc_inspiral.end_time, coinc_inspiral.end_time_ns);')]
+
+
+def random_time(rnd):
+	# many times fall exactly on the segment boundaries below
+	return rnd.randint(100, 200), rnd.choice([0, 500000000, rnd.randint(0, 999999999)])
+
+
+def random_segmentlists(rnd):
+	"""
+	Return segment lists with boundaries on the grid of random_time(),
+	some of them overlapping or touching, and infinite and empty ones
+	"""
+	def random_segmentlist(n):
+		seglist = segments.segmentlist()
+		for i in range(n):
+			start = lsctables.LIGOTimeGPS(*random_time(rnd))
+			seglist.append(segments.segment(start, start + rnd.choice([0.5, 1, rnd.uniform(0., 20.)])))
+		return seglist
+	return [
+		None,
+		segments.segmentlist(),
+		segments.segmentlist([segments.segment(segments.NegInfinity, segments.PosInfinity)]),
+		segments.segmentlist([segments.segment(segments.NegInfinity, lsctables.LIGOTimeGPS(150, 500000000)), segments.segment(lsctables.LIGOTimeGPS(170), segments.PosInfinity)]),
+		random_segmentlist(1),
+		random_segmentlist(10),
+		random_segmentlist(40)
+	]
+
+
+class test_event_fars(unittest.TestCase):
+	def test_times_within_segments(self):
+		"""
+		times_within_segments() must agree with time_within_segments(),
+		including for times on the [start, end) boundaries
+		"""
+		rnd = random.Random(0)
+		times = [random_time(rnd) for i in range(2000)]
+		end_times, end_times_ns = zip(*times)
+		for seglist in random_segmentlists(rnd):
+			keep = imr_utils.times_within_segments(end_times, end_times_ns, imr_utils.segments_to_boundaries(seglist))
+			expected = [bool(imr_utils.time_within_segments(end_time, end_time_ns, coalesced(seglist))) for end_time, end_time_ns in times]
+			self.assertTrue(keep.tolist() == expected)
+		self.assertEqual(imr_utils.times_within_segments([], [], imr_utils.segments_to_boundaries(seglist)).tolist(), [])
+
+	def test_segments_to_boundaries(self):
+		seglist = segments.segmentlist([segments.segment(lsctables.LIGOTimeGPS(120), lsctables.LIGOTimeGPS(130)), segments.segment(lsctables.LIGOTimeGPS(100, 5), lsctables.LIGOTimeGPS(110)), segments.segment(lsctables.LIGOTimeGPS(110), lsctables.LIGOTimeGPS(115))])
+		starts, ends = imr_utils.segments_to_boundaries(seglist)
+		self.assertEqual(starts.tolist(), [100000000005, 120000000000])
+		self.assertEqual(ends.tolist(), [115000000000, 130000000000])
+		self.assertEqual(imr_utils.segments_to_boundaries(None), None)
+		# the argument is not modified
+		self.assertEqual(len(seglist), 3)
+
+	def test_get_event_fars(self):
+		"""
+		get_event_fars() must return the events of the database query it
+		replaced, in the same order, including when there are more rows
+		than it fetches at a time
+		"""
+		rnd = random.Random(1)
+		connection = sqlite3.connect(":memory:")
+		connection.executescript("""
+CREATE TABLE coinc_inspiral (coinc_event_id TEXT, combined_far REAL, end_time INTEGER, end_time_ns INTEGER);
+CREATE TABLE coinc_event (coinc_event_id TEXT, instruments TEXT, time_slide_id TEXT);
+CREATE TABLE time_slide (time_slide_id TEXT, instrument TEXT, offset REAL);
+INSERT INTO time_slide VALUES ('time_slide:time_slide_id:0', 'H1', 0.);
+INSERT INTO time_slide VALUES ('time_slide:time_slide_id:1', 'H1', 5.);
+""")
+		# more than the 10000 rows get_event_fars() fetches at a time
+		for i in range(25000):
+			coinc_event_id = "coinc_event:coinc_event_id:%d" % i
+			connection.execute("INSERT INTO coinc_inspiral VALUES (?, ?, ?, ?)", (coinc_event_id, rnd.random()) + random_time(rnd))
+			connection.execute("INSERT INTO coinc_event VALUES (?, ?, ?)", (coinc_event_id, rnd.choice(["H1,L1", "H1,L1,V1"]), rnd.choice(["time_slide:time_slide_id:0", "time_slide:time_slide_id:1"])))
+		for seglist in random_segmentlists(rnd):
+			fars = list(imr_utils.get_event_fars(connection, "coinc_inspiral", segments = seglist))
+			self.assertTrue(fars == sql_event_fars(connection, seglist))
+		self.assertEqual(len(list(imr_utils.get_event_fars(connection, "coinc_inspiral"))), 25000)
+		self.assertRaises(ValueError, list, imr_utils.get_event_fars(connection, "sngl_inspiral"))
+		connection.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
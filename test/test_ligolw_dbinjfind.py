@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import random
+import sqlite3
+import unittest
+import warnings
+
+from pylal import ligolw_sqlutils as sqlutils
+from pylal import ligolw_dataUtils as dataUtils
+from pylal import ligolw_dbinjfind
+
+
+#
+# the query ligolw_dbinjfind.dbinjfind() used to find injections before it
+# used an interval join: every injection is tested against every eligible
+# event from the same injection job by a function created in the database
+# for each criterion
+#
+
+def sql_dbinjfind( connection, simulation_table, recovery_table, match_criteria, rough_match = None, rejection_criteria = [] ):
+    simColumns = sqlutils.get_column_names_from_table( connection, simulation_table )
+    recColumns = sqlutils.get_column_names_from_table( connection, recovery_table )
+    SimDataRow = dataUtils.createDataRowClass( simulation_table, columns = simColumns )
+    RecDataRow = dataUtils.createDataRowClass( recovery_table, columns = recColumns )
+    ligolw_dbinjfind.make_rec_sngls_table( connection, recovery_table )
+
+    rough_match_test = ''
+    if rough_match is not None:
+        simRough, recRough, winRough = rough_match
+        rough_match_test = "rec_sngls.%s >= sim.%s - %f AND rec_sngls.%s <= sim.%s + %f AND\n" %( recRough, simRough, winRough, recRough, simRough, winRough )
+
+    if rejection_criteria != []:
+        connection.cursor().execute( ''.join(['''
+            CREATE TEMP TABLE all_data_sngls AS
+                SELECT
+                    ''', recovery_table, '''.*
+                FROM
+                ''', recovery_table, '''
+                ''', sqlutils.join_experiment_tables_to_sngl_table( recovery_table ), '''
+                WHERE
+                    experiment_summary.datatype == "all_data"''' ]) )
+        rejection_tests = []
+        for n, (thisFunc, window) in enumerate(rejection_criteria):
+            compF = dataUtils.CompareDataRows(RecDataRow, RecDataRow)
+            funcName = 'matches_all_data%i' % n
+            compF.set_matchCriteriaA( thisFunc )
+            compF.set_matchCriteriaB( thisFunc )
+            compF.create_dbCompF( connection, compF.diffRowARowB, funcName, window, recColumns, recColumns )
+            simSnglCols = ','.join(['rec_sngls.%s' %(col) for col in compF.neededColumnsA])
+            allSnglCols = ','.join(['all_data_sngls.%s' %(col) for col in compF.neededColumnsB])
+            rejection_tests.append( '%s(%s, %s)' %(funcName, simSnglCols, allSnglCols) )
+        connection.cursor().execute( ''.join([ '''
+            DELETE FROM
+                rec_sngls
+            WHERE EXISTS (
+                SELECT
+                    *
+                FROM
+                    all_data_sngls
+                WHERE
+                    ''', '\nAND '.join( rejection_tests ), ')' ]) )
+
+    match_tests = []
+    for n, (simFunc, snglFunc, window) in enumerate(match_criteria):
+        compF = dataUtils.CompareDataRows(SimDataRow, RecDataRow)
+        funcName = 'are_match%i' % n
+        compF.set_matchCriteriaA( simFunc )
+        compF.set_matchCriteriaB( snglFunc )
+        compF.create_dbCompF( connection, compF.diffSimSngl, funcName, window, simColumns, recColumns )
+        simCols = ','.join(['sim.%s'%(col) for col in compF.neededColumnsA])
+        snglCols = ','.join(['rec_sngls.%s'%(col) for col in compF.neededColumnsB])
+        match_tests.append( '%s(%s, %s)' %(funcName, simCols, snglCols) )
+
+    return set( connection.cursor().execute( ''.join(["""
+    SELECT
+        sim.simulation_id,
+        rec_sngls.event_id
+    FROM
+        """, simulation_table, """ AS sim, rec_sngls
+    WHERE
+        sim.process_id == rec_sngls.sim_proc_id AND
+        """, rough_match_test, '\n\t\tAND '.join( match_tests ) ]) ) )
+
+def make_database( rnd, nsims = 60, nsngls = 500 ):
+    """
+    Returns an in-memory database with nsims injections made by three
+    injection jobs, and nsngls single-ifo events. About half of the events
+    are near an injection, and some are copied into all_data.
+    """
+    connection = sqlite3.connect( ":memory:" )
+    connection.executescript( """
+    CREATE TABLE sim_inspiral (simulation_id TEXT, process_id TEXT, h_end_time INTEGER, h_end_time_ns INTEGER, l_end_time INTEGER, l_end_time_ns INTEGER, geocent_end_time INTEGER, geocent_end_time_ns INTEGER, mchirp REAL);
+    CREATE TABLE sngl_inspiral (event_id TEXT, process_id TEXT, ifo TEXT, end_time INTEGER, end_time_ns INTEGER, mchirp REAL, snr REAL);
+    CREATE TABLE experiment (experiment_id TEXT);
+    CREATE TABLE experiment_summary (experiment_summ_id TEXT, experiment_id TEXT, datatype TEXT, sim_proc_id TEXT);
+    CREATE TABLE experiment_map (experiment_summ_id TEXT, coinc_event_id TEXT);
+    CREATE TABLE coinc_event_map (coinc_event_id TEXT, table_name TEXT, event_id TEXT);
+    """ )
+    connection.execute( "INSERT INTO experiment VALUES ('experiment:experiment_id:0')" )
+    esids = []
+    for n in range(3):
+        esids.append( "experiment_summary:experiment_summ_id:%d" % n )
+        connection.execute( "INSERT INTO experiment_summary VALUES (?, ?, ?, ?)", (esids[-1], "experiment:experiment_id:0", "simulation", "process:process_id:%d" % n) )
+    all_data = "experiment_summary:experiment_summ_id:3"
+    connection.execute( "INSERT INTO experiment_summary VALUES (?, ?, ?, ?)", (all_data, "experiment:experiment_id:0", "all_data", None) )
+
+    sims = []
+    for n in range(nsims):
+        t, t_ns = rnd.randint(1000, 1100), rnd.randint(0, 999999999)
+        mchirp = rnd.uniform(1., 5.)
+        sims.append( (t, t_ns, mchirp) )
+        connection.execute( "INSERT INTO sim_inspiral VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", ("sim_inspiral:simulation_id:%d" % n, "process:process_id:%d" % rnd.randrange(3), t, t_ns, t + rnd.choice([0, 1]), rnd.randint(0, 999999999), t, t_ns, mchirp) )
+
+    def add_sngl( n, esid, ifo, t, t_ns, mchirp ):
+        event_id = "sngl_inspiral:event_id:%d" % n
+        coinc_event_id = "coinc_event:coinc_event_id:%d" % n
+        connection.execute( "INSERT INTO sngl_inspiral VALUES (?, ?, ?, ?, ?, ?, ?)", (event_id, "process:process_id:9", ifo, t, t_ns, mchirp, rnd.uniform(5., 10.)) )
+        connection.execute( "INSERT INTO coinc_event_map VALUES (?, ?, ?)", (coinc_event_id, "sngl_inspiral", event_id) )
+        connection.execute( "INSERT INTO experiment_map VALUES (?, ?)", (esid, coinc_event_id) )
+
+    sngls = []
+    for n in range(nsngls):
+        if rnd.random() < 0.5:
+            t, t_ns, mchirp = rnd.choice( sims )
+            t_ns += int( rnd.gauss(0., 0.02) * 1e9 )
+            t, t_ns = t + t_ns // 1000000000, t_ns % 1000000000
+            mchirp += rnd.gauss(0., 0.05)
+        else:
+            t, t_ns, mchirp = rnd.randint(1000, 1100), rnd.randint(0, 999999999), rnd.uniform(1., 5.)
+        sngls.append( (rnd.choice(["H1", "L1"]), t, t_ns, mchirp) )
+        add_sngl( n, rnd.choice(esids + [all_data]), *sngls[-1] )
+    for n in range(nsngls // 10):
+        add_sngl( nsngls + n, all_data, *rnd.choice(sngls) )
+    return connection
+
+class test_dbinjfind(unittest.TestCase):
+
+    def test_matches_sql(self):
+        '''
+        found_inj must hold the same (sim_id, event_id) pairs as the SQL
+        query dbinjfind used to run
+        '''
+        configs = [
+            dict( match_criteria = [("endTime", "endTime", 0.03)] ),
+            dict( match_criteria = [("mchirp", "mchirp", 0.02)] ),
+            dict( match_criteria = [("endTime", "endTime", 0.03), ("mchirp", "mchirp", 0.05)] ),
+            dict( match_criteria = [("endTime", "endTime", 0.05)], rough_match = ("geocent_end_time", "end_time", 2) ),
+            dict( match_criteria = [("endTime", "endTime", 0.03)], rejection_criteria = [("endTime", 0.)] ),
+            dict( match_criteria = [("endTime", "endTime", 0.03)], rejection_criteria = [("endTime", 0.001), ("mchirp", 0.)] )
+        ]
+        for seed in range(2):
+            for config in configs:
+                expected = sql_dbinjfind( make_database( random.Random(seed) ), "sim_inspiral", "sngl_inspiral", **config )
+                self.assertTrue( expected )
+                connection = make_database( random.Random(seed) )
+                ligolw_dbinjfind.dbinjfind( connection, "sim_inspiral", "sngl_inspiral", **config )
+                found = connection.cursor().execute( "SELECT sim_id, event_id FROM found_inj" ).fetchall()
+                self.assertEqual( len(found), len(set(found)) )
+                self.assertEqual( set(found), expected )
+
+    def test_null_values(self):
+        '''
+        an event with a NULL in a match criterion matches nothing, and
+        does not cause warnings
+        '''
+        connection = make_database( random.Random(0) )
+        connection.execute( "UPDATE sngl_inspiral SET mchirp = NULL WHERE rowid % 2 == 0" )
+        with warnings.catch_warnings():
+            warnings.simplefilter( "error", RuntimeWarning )
+            ligolw_dbinjfind.dbinjfind( connection, "sim_inspiral", "sngl_inspiral", [("endTime", "endTime", 0.03), ("mchirp", "mchirp", 0.05)] )
+        found = connection.cursor().execute( "SELECT found_inj.sim_id, sngl_inspiral.mchirp FROM found_inj JOIN sngl_inspiral ON (sngl_inspiral.event_id == found_inj.event_id)" ).fetchall()
+        self.assertTrue( found )
+        self.assertTrue( None not in [mchirp for sim_id, mchirp in found] )
+
+if __name__ == '__main__':
+    unittest.main()
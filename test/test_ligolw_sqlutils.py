@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+import random
+import sqlite3
+import unittest
+
+from pylal import ligolw_sqlutils as sqlutils
+
+
+#
+# the clustering ligolw_cbc_cluster_coincs did in SQL before it used
+# cluster_losers(): a trigger is deleted if a better one with the same
+# esid, ifos and param_grouping lies in its window
+#
+
+def sql_cluster_losers( connection, window, rank_by ):
+    return set( emid for (emid,) in connection.cursor().execute( ''.join(["""
+        SELECT
+            emid
+        FROM
+            clustered AS deltrigs
+        WHERE EXISTS (
+            SELECT *
+            FROM
+                clustered AS reftrigs
+            WHERE
+                reftrigs.esid == deltrigs.esid
+                AND reftrigs.ifos == deltrigs.ifos
+                AND reftrigs.param_grouping == deltrigs.param_grouping
+                AND reftrigs.ranking_stat """, rank_by, """ deltrigs.ranking_stat
+                AND reftrigs.gps_time > ( deltrigs.gps_time - """, repr(window), """ )
+                AND reftrigs.gps_time <= ( deltrigs.gps_time + """, repr(window), """ )
+            LIMIT 1)"""]) ) )
+
+def random_clustered_table( connection, n, rnd ):
+    """
+    Fill a scratch table like the one ligolw_cbc_cluster_coincs builds
+    with n coincs, each mapped to one or two esids.  Times lie on a coarse
+    grid so that many triggers sit exactly on each other's window edges,
+    ranking stats are small integers so that ties are common, and a few
+    rows have NULLs.
+    """
+    connection.execute( "CREATE TABLE clustered (emid INTEGER PRIMARY KEY, esid, ifos, param_grouping, gps_time, ranking_stat)" )
+    for k in range(n):
+        for esid in rnd.sample( ["experiment_summary:experiment_summ_id:%d" % i for i in range(3)], rnd.randint(1, 2) ):
+            gps_time = sqlutils.end_time_in_ns( rnd.choice([1000000000, 960000000]), 0 ) + rnd.randint(0, 10**4) * rnd.choice([1, 100, 1000])
+            ranking_stat = float( rnd.randint(0, 20) )
+            ifos = rnd.choice( ["H1,L1", "H1,V1"] )
+            if rnd.random() < 0.03:
+                ranking_stat = None
+            if rnd.random() < 0.03:
+                ifos = None
+            connection.execute( "INSERT INTO clustered (esid, ifos, param_grouping, gps_time, ranking_stat) VALUES (?, ?, ?, ?, ?)", (esid, ifos, rnd.choice([0, 1]), gps_time, ranking_stat) )
+
+class test_cluster_losers(unittest.TestCase):
+
+    def test_matches_sql(self):
+        '''
+        cluster_losers() must remove the same triggers as the SQL query it
+        replaced, for both ranking directions
+        '''
+        rnd = random.Random(0)
+        for n in (1, 5, 50, 400):
+            for window in (1e3, 1e4, 1e5, 3e5):
+                connection = sqlite3.connect( ":memory:" )
+                random_clustered_table( connection, n, rnd )
+                for rank_by in (">", "<"):
+                    expected = sql_cluster_losers( connection, window, rank_by )
+                    losers = sqlutils.cluster_losers( connection.cursor().execute( "SELECT emid, esid, ifos, param_grouping, gps_time, ranking_stat FROM clustered" ), window, rank_by )
+                    self.assertEqual( losers, expected )
+                    if n >= 50:
+                        self.assertTrue( expected )
+                connection.close()
+
+    def test_window_edges(self):
+        '''
+        a better trigger exactly window before a trigger is outside its
+        window, exactly window after it is inside
+        '''
+        rows = [(0, "es", "H1,L1", 0, 100., 1.), (1, "es", "H1,L1", 0, 90., 2.), (2, "es", "H1,L1", 0, 110., 2.)]
+        self.assertEqual( sqlutils.cluster_losers( [rows[0], rows[1]], 10., ">" ), set() )
+        self.assertEqual( sqlutils.cluster_losers( [rows[0], rows[2]], 10., ">" ), set([0]) )
+        # so the window is not symmetric
+        self.assertEqual( sqlutils.cluster_losers( [rows[0], rows[2]], 10., "<" ), set() )
+        self.assertEqual( sqlutils.cluster_losers( [], 10., ">" ), set() )
+
+def random_summaries( rnd, integer_durations ):
+    """
+    Fill a Summaries with the background of two experiments, each with a
+    zero-lag and three slide experiment_summ_ids, and return it with the
+    (id, eid, esid, ifos, param_group, stat) rows of some triggers.  Stats
+    are small integers, so that ties with the background are common, and
+    include 0.
+    """
+    summaries = sqlutils.Summaries()
+    esids = {}
+    for eid in range(2):
+        esids[eid] = ["experiment_summary:experiment_summ_id:%d" % (4 * eid + i) for i in range(4)]
+        summaries.append_zero_lag_id( eid, esids[eid][0] )
+        for esid in esids[eid]:
+            summaries.store_datatypes( eid, esid, esid == esids[eid][0] and "all_data" or "slide" )
+            summaries.append_duration( eid, esid, integer_durations and rnd.randint(100, 1000) or rnd.uniform(100., 1000.) )
+    summaries.calc_bkg_durs()
+    rows = []
+    for n in range(2000):
+        eid = rnd.randint(0, 1)
+        row = (n, eid, rnd.choice(esids[eid]), rnd.choice(["H1,L1", "H1,V1"]), rnd.randint(0, 1), float( rnd.randint(0, 30) ))
+        summaries.add_to_bkg_stats( *row[1:] )
+        rows.append( row )
+    return summaries, rows
+
+class test_Summaries(unittest.TestCase):
+
+    def test_calc_ufars(self):
+        '''
+        calc_ufars() must give the ufars of calc_ufar_by_max() and
+        calc_ufar_by_min(), including their types
+        '''
+        rnd = random.Random(1)
+        for integer_durations in (False, True):
+            summaries, rows = random_summaries( rnd, integer_durations )
+            self.assertTrue( [row for row in rows if row[5] == 0.] )
+            for rank_by, calc_ufar in (('MAX', summaries.calc_ufar_by_max), ('MIN', summaries.calc_ufar_by_min)):
+                summaries.sort_bkg_stats()
+                ufars = summaries.calc_ufars( rows, rank_by = rank_by )
+                self.assertEqual( sorted( id for ufar, id in ufars ), range(len(rows)) )
+                ufars = dict( (id, ufar) for ufar, id in ufars )
+                for row in rows:
+                    ufar = calc_ufar( *row[1:] )
+                    self.assertEqual( (ufars[row[0]], type(ufars[row[0]])), (ufar, type(ufar)) )
+                # more stats can be added after sorting
+                for row in rows[:100]:
+                    summaries.add_to_bkg_stats( *row[1:] )
+        self.assertRaises( ValueError, summaries.calc_ufars, rows, rank_by = 'ASC' )
+
+    def test_calc_cfars(self):
+        '''
+        calc_cfars() must give the cfars of calc_cfar(), including for
+        ufars equal to a max_bkg_far
+        '''
+        rnd = random.Random(2)
+        summaries = sqlutils.Summaries()
+        keys = [("experiment_summary:experiment_summ_id:%d" % i, ifo_group) for i in range(3) for ifo_group in ("ALL_IFOS", "H1,L1")]
+        for n in range(2):
+            for key in keys:
+                for i in range(rnd.randint(1, 20)):
+                    summaries.append_max_bkg_far( key[0], key[1], rnd.choice([rnd.random(), rnd.randint(0, 3) / 4.]) )
+            summaries.sort_max_bkg_fars()
+            self.assertTrue( isinstance(summaries.max_bkg_fars[keys[0]], list) )
+            rows = [(i, ) + rnd.choice(keys) + (rnd.choice([rnd.uniform(0., 1.1), rnd.randint(0, 4) / 4., 0.]), ) for i in range(1000)]
+            cfars = summaries.calc_cfars( rows )
+            self.assertEqual( sorted( id for cfar, id in cfars ), range(len(rows)) )
+            cfars = dict( (id, cfar) for cfar, id in cfars )
+            for row in rows:
+                self.assertEqual( cfars[row[0]], summaries.calc_cfar( *row[1:] ) )
+
+class test_update_column_by_id(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = sqlite3.connect( ":memory:" )
+        self.connection.execute( "CREATE TABLE coinc_inspiral (coinc_event_id, false_alarm_rate)" )
+        self.ids = ["coinc_event:coinc_event_id:%d" % i for i in range(500)]
+        # one id appears twice
+        self.connection.executemany( "INSERT INTO coinc_inspiral VALUES (?, NULL)", [(id,) for id in self.ids + self.ids[:1]] )
+
+    def tearDown(self):
+        self.connection.close()
+
+    def indexes(self):
+        return [name for (name,) in self.connection.execute( "SELECT name FROM sqlite_master WHERE type == 'index'" )]
+
+    def check(self):
+        rnd = random.Random(3)
+        values = [(rnd.random(), id) for id in self.ids if rnd.random() < 0.7]
+        expected = dict( (id, None) for id in self.ids )
+        expected.update( (id, value) for value, id in values )
+        sqlutils.update_column_by_id( self.connection, "coinc_inspiral", "false_alarm_rate", "coinc_event_id", values )
+        rows = self.connection.execute( "SELECT coinc_event_id, false_alarm_rate FROM coinc_inspiral" ).fetchall()
+        self.assertEqual( len(rows), len(self.ids) + 1 )
+        for id, value in rows:
+            self.assertEqual( value, expected[id] )
+
+    def test_update(self):
+        '''
+        the rows must get the values of their ids, and the index made for
+        the update must be removed
+        '''
+        self.check()
+        self.assertEqual( self.indexes(), [] )
+
+    def test_existing_index(self):
+        '''
+        an index of the same name made by someone else must be left alone
+        '''
+        self.connection.execute( "CREATE INDEX coinc_inspiral_coinc_event_id_update_idx ON coinc_inspiral (coinc_event_id)" )
+        self.check()
+        self.assertEqual( self.indexes(), ["coinc_inspiral_coinc_event_id_update_idx"] )
+
+    def test_failure(self):
+        '''
+        the index must also be removed if the update fails
+        '''
+        self.assertRaises( sqlite3.Error, sqlutils.update_column_by_id, self.connection, "coinc_inspiral", "no_such_column", "coinc_event_id", [(1., self.ids[0])] )
+        self.assertEqual( self.indexes(), [] )
+
+
+if __name__ == '__main__':
+    unittest.main()
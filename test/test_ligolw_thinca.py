@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+import numpy
+
+from glue import segments
+from glue.ligolw import ligolw
+from glue.ligolw import lsctables
+from glue.ligolw.utils import process as ligolw_process
+from glue.ligolw.utils import search_summary as ligolw_search_summary
+from glue import offsetvector
+from pylal import ligolw_thinca
+from pylal.xlal.datatypes.ligotimegps import LIGOTimeGPS
+
+
+def random_sngl_inspiral(ifo, end, rnd):
+	"""
+	Return a sngl_inspiral event from instrument ifo ending at about the
+	LIGOTimeGPS end, drawn from a small bank of templates so that
+	events with equal masses are common.
+	"""
+	row = ligolw_thinca.SnglInspiral()
+	row.ifo = ifo
+	row.search = "inspiral"
+	row.set_end(end + rnd.uniform(-0.005, 0.005))
+	row.mass1, row.mass2 = rnd.choice([(1.4, 1.4), (1.4, 10.), (5., 5.)])
+	row.tau0 = 10. + rnd.uniform(0., 0.01)
+	row.tau3 = 1. + rnd.uniform(0., 0.01)
+	# a positive-definite (t, tau0, tau3) metric
+	for i in range(10):
+		setattr(row, "Gamma%d" % i, 0.)
+	row.Gamma0, row.Gamma3, row.Gamma5 = 1e6, 1e4, 1e4
+	return row
+
+
+def copy_sngl_inspiral(row, ifo):
+	copy = ligolw_thinca.SnglInspiral()
+	for attr in ("search", "end_time", "end_time_ns", "mass1", "mass2", "tau0", "tau3") + tuple("Gamma%d" % i for i in range(10)):
+		setattr(copy, attr, getattr(row, attr))
+	copy.ifo = ifo
+	return copy
+
+
+class test_inspiral_coinc_compare_batch(unittest.TestCase):
+	def test_exact_batch_matches_scalar(self):
+		"""
+		inspiral_coinc_compare_exact_batch() must agree with
+		inspiral_coinc_compare_exact() on every pair
+		"""
+		rnd = random.Random(0)
+		t0 = LIGOTimeGPS(1000000000)
+		lista = ligolw_thinca.InspiralEventList("H1")
+		listb = ligolw_thinca.InspiralEventList("L1")
+		lista.extend(random_sngl_inspiral("H1", t0, rnd) for i in range(100))
+		listb.extend(random_sngl_inspiral("L1", t0, rnd) for i in range(50))
+		# identical copies are coincident at zero offset
+		listb.extend(copy_sngl_inspiral(row, "L1") for row in lista[:50])
+		lista.make_index()
+		listb.make_index()
+
+		for offseta, offsetb in ((LIGOTimeGPS(0), LIGOTimeGPS(0)), (LIGOTimeGPS(0), LIGOTimeGPS(0, 3000000))):
+			indexesa = numpy.array([rnd.randrange(len(lista)) for i in range(2000)] + range(len(lista)))
+			indexesb = numpy.array([rnd.randrange(len(listb)) for i in range(2000)] + range(len(listb)))
+			batch = ligolw_thinca.inspiral_coinc_compare_exact_batch(lista, indexesa, offseta, listb, indexesb, offsetb, 0.01, 0.5)
+			scalar = [ligolw_thinca.inspiral_coinc_compare_exact(lista[i], offseta, listb[j], offsetb, 0.01, 0.5) for i, j in zip(indexesa, indexesb)]
+			self.assertEqual(map(bool, batch), scalar)
+			self.assertTrue(True in scalar)
+		# the zero-offset pass includes the identical copies
+		self.assertTrue(False in [ligolw_thinca.inspiral_coinc_compare_exact(a, LIGOTimeGPS(0), b, LIGOTimeGPS(0), 0.01, 0.5) for a in lista for b in listb])
+
+
+#
+# a document with a time_slide table and instrument segments, and a
+# stream of sngl_inspiral events in which the instruments have seen the
+# same signals at times shifted by the offset vectors
+#
+
+
+def new_document(offset_vectors, instruments, seg):
+	xmldoc = ligolw.Document()
+	xmldoc.appendChild(ligolw.LIGO_LW())
+	process = ligolw_process.register_to_xmldoc(xmldoc, u"inspiral", {})
+	ligolw_search_summary.append_search_summary(xmldoc, process, ifos = instruments, inseg = seg, outseg = seg)
+	time_slide_table = xmldoc.childNodes[0].appendChild(lsctables.New(lsctables.TimeSlideTable))
+	for offset_vector in offset_vectors:
+		time_slide_table.append_offsetvector(offset_vector, process)
+	xmldoc.childNodes[0].appendChild(lsctables.New(lsctables.SnglInspiralTable))
+	return xmldoc, process.process_id
+
+
+def random_signal_events(instruments, offset_vectors, t0, duration, n, rnd):
+	sngl_inspiral_table = lsctables.New(lsctables.SnglInspiralTable)
+	events = []
+	for i in range(n):
+		t = t0 + rnd.uniform(0., duration)
+		offset_vector = rnd.choice(offset_vectors)
+		signal = random_sngl_inspiral(instruments[0], LIGOTimeGPS(0), rnd)
+		for ifo in rnd.sample(instruments, rnd.randint(1, len(instruments))):
+			row = copy_sngl_inspiral(signal, ifo)
+			row.set_end(t - offset_vector[ifo] + rnd.uniform(-0.0002, 0.0002))
+			row.mchirp = (row.mass1 * row.mass2)**0.6 / (row.mass1 + row.mass2)**0.2
+			row.snr = 8.
+			row.chisq = 0.
+			row.event_id = sngl_inspiral_table.get_next_id()
+			events.append(row)
+	return events
+
+
+def get_coincs(xmldoc):
+	coinc_events = {}
+	for row in lsctables.CoincMapTable.get_table(xmldoc):
+		coinc_events.setdefault(row.coinc_event_id, set()).add(row.event_id)
+	return dict(((coinc.time_slide_id, frozenset(coinc_events[coinc.coinc_event_id])), coinc.instruments) for coinc in lsctables.CoincTable.get_table(xmldoc))
+
+
+class test_stream_thinca(unittest.TestCase):
+	instruments = ["H1", "L1", "V1"]
+	offset_vectors = [
+		offsetvector.offsetvector({"H1": 0., "L1": 0., "V1": 0.}),
+		offsetvector.offsetvector({"H1": 0., "L1": 5., "V1": 10.}),
+		offsetvector.offsetvector({"H1": 0., "L1": -5., "V1": 5.})
+	]
+
+	def batch_coincs(self, events, seg, max_dt):
+		xmldoc, process_id = new_document(self.offset_vectors, self.instruments, seg)
+		lsctables.SnglInspiralTable.get_table(xmldoc).extend(events)
+		ligolw_thinca.ligolw_thinca(xmldoc, process_id, ligolw_thinca.InspiralCoincDef, ligolw_thinca.inspiral_coinc_compare_exact, 0.5, max_dt = max_dt)
+		return get_coincs(xmldoc)
+
+	def stream_coincs(self, chunks, seg, max_dt, **kwargs):
+		xmldoc, process_id = new_document(self.offset_vectors, self.instruments, seg)
+		sngl_inspiral_table = lsctables.SnglInspiralTable.get_table(xmldoc)
+		stream = ligolw_thinca.StreamThinca(xmldoc, process_id, ligolw_thinca.InspiralCoincDef, ligolw_thinca.inspiral_coinc_compare_exact, 0.5, max_dt, **kwargs)
+		nevents = sum(len(chunk) for chunk in chunks)
+		max_buffered = 0
+		for chunk in chunks:
+			sngl_inspiral_table.extend(chunk)
+			stream.add_events(chunk)
+			max_buffered = max(max_buffered, len(stream.sngl_index))
+			# every buffered event is in the sorted buffers
+			self.assertEqual(len(stream.sngl_index), sum(len(eventlist) for eventlist in stream.eventlists.values()))
+			for eventlist in stream.eventlists.values():
+				self.assertTrue((numpy.diff(eventlist.end_ns) >= 0).all())
+				self.assertEqual(list(eventlist.end_ns), [event.end_time * 1000000000 + event.end_time_ns for event in eventlist])
+		stream.flush()
+		self.assertEqual(len(stream.sngl_index), 0)
+		# old events have been retired as the stream advanced
+		self.assertTrue(max_buffered < nevents / 4)
+		return get_coincs(xmldoc)
+
+	def test_stream_matches_batch(self):
+		"""
+		the coincs StreamThinca records from time-ordered chunks of
+		shuffled events must be those ligolw_thinca() constructs from
+		the complete set
+		"""
+		rnd = random.Random(1)
+		t0 = LIGOTimeGPS(1000000000)
+		seg = segments.segment(t0 - 100, t0 + 700)
+		events = random_signal_events(self.instruments, self.offset_vectors, t0, 600., 300, rnd)
+		max_dt = ligolw_thinca.inspiral_max_dt(events, 0.5)
+
+		expected = self.batch_coincs(events, seg, max_dt)
+		self.assertTrue(set(len(ids) for time_slide_id, ids in expected) >= set([2, 3]))
+		self.assertTrue(len(set(time_slide_id for time_slide_id, ids in expected)) == len(self.offset_vectors))
+
+		events.sort(key = lambda event: event.get_end())
+		for chunk_size in (1, 7, 40):
+			# cut the stream into chunks of random length, so
+			# that many signals straddle a chunk boundary, and
+			# shuffle the events within each chunk
+			chunks = []
+			i = 0
+			while i < len(events):
+				n = rnd.randint(1, chunk_size)
+				chunks.append(events[i:i + n])
+				rnd.shuffle(chunks[-1])
+				i += n
+			self.assertEqual(self.stream_coincs(chunks, seg, max_dt), expected)
+		self.assertEqual(self.stream_coincs(chunks, seg, max_dt, event_batch_comparefunc = ligolw_thinca.inspiral_coinc_compare_exact_batch), expected)
+
+	def test_empty_time_slide_table(self):
+		xmldoc, process_id = new_document([], self.instruments, segments.segment(LIGOTimeGPS(0), LIGOTimeGPS(1)))
+		self.assertRaises(ValueError, ligolw_thinca.StreamThinca, xmldoc, process_id, ligolw_thinca.InspiralCoincDef, ligolw_thinca.inspiral_coinc_compare_exact, 0.5, 0.1)
+
+
+if __name__ == '__main__':
+	unittest.main()
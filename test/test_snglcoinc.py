@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+import bisect
+import itertools
+import random
+import unittest
+import numpy
+
+from glue import offsetvector
+from glue import segments
+from glue.ligolw import lsctables
+from pylal import rate
+from pylal import snglcoinc
+
+
+#
+# a minimal event type, with integer nanosecond times, and the event list
+# and comparison functions needed by both pair search engines
+#
+
+
+class Event(object):
+	def __init__(self, event_id, ifo, time_ns):
+		self.event_id = event_id
+		self.ifo = ifo
+		self.time_ns = time_ns
+
+
+class EventList(snglcoinc.EventList):
+	def make_index(self):
+		self.sort(key = lambda event: event.time_ns)
+		self.times_ns = numpy.array([event.time_ns for event in self], dtype = "int64")
+
+	def get_times_ns(self):
+		return self.times_ns
+
+	def get_window_ns(self, light_travel_time, threshold):
+		return threshold
+
+	def get_coincs(self, event_a, offset_a, light_travel_time, threshold, comparefunc):
+		t = event_a.time_ns + offset_a.ns() - self.offset.ns()
+		lo = bisect.bisect_left(self.times_ns, t - threshold)
+		hi = bisect.bisect_right(self.times_ns, t + threshold)
+		return [event_b for event_b in self[lo:hi] if not comparefunc(event_a, offset_a, event_b, self.offset, light_travel_time, threshold)]
+
+
+def comparefunc(a, offseta, b, offsetb, light_travel_time, threshold):
+	return abs((a.time_ns + offseta.ns()) - (b.time_ns + offsetb.ns())) > threshold
+
+
+def batch_comparefunc(eventlista, indexesa, offseta, eventlistb, indexesb, offsetb, light_travel_time, threshold):
+	return abs((eventlista.times_ns[indexesa] + offseta.ns()) - (eventlistb.times_ns[indexesb] + offsetb.ns())) > threshold
+
+
+def random_eventlists(instruments, n, rnd):
+	events = []
+	for ifo in instruments:
+		for i in range(n):
+			events.append(Event(len(events), ifo, rnd.randrange(0, 2000000000)))
+	rnd.shuffle(events)
+	return snglcoinc.EventListDict(EventList, events)
+
+
+def random_offset_vectors(instruments, n, rnd):
+	offset_vectors = {"time_slide:time_slide_id:0": offsetvector.offsetvector((instrument, 0.) for instrument in instruments)}
+	while len(offset_vectors) < n:
+		offset_vectors["time_slide:time_slide_id:%d" % len(offset_vectors)] = offsetvector.offsetvector((instrument, float(rnd.randrange(-2, 3))) for instrument in instruments)
+	return offset_vectors
+
+
+def brute_force_coincs(eventlists, offset_vectors, window):
+	"""
+	The coincs of each offset vector are the largest sets of events,
+	at most one from each instrument, that are pairwise coincident.
+	"""
+	result = set()
+	for time_slide_id, offset_vector in offset_vectors.items():
+		times = dict((event.event_id, event.time_ns + lsctables.LIGOTimeGPS(offset_vector[event.ifo]).ns()) for instrument in offset_vector for event in eventlists[instrument])
+		ifos = dict((event.event_id, event.ifo) for instrument in offset_vector for event in eventlists[instrument])
+		cliques = set(frozenset((a, b)) for a, b in itertools.combinations(times, 2) if ifos[a] != ifos[b] and abs(times[a] - times[b]) <= window)
+		maximal = set()
+		while cliques:
+			bigger = set()
+			for clique in cliques:
+				extended = False
+				for event_id in times:
+					if ifos[event_id] not in set(ifos[e] for e in clique) and all(abs(times[event_id] - times[e]) <= window for e in clique):
+						bigger.add(clique | frozenset([event_id]))
+						extended = True
+				if not extended:
+					maximal.add(clique)
+			cliques = bigger
+		result |= set((time_slide_id, clique) for clique in maximal)
+	return result
+
+
+class test_time_slide_graph(unittest.TestCase):
+	window = 20000000
+
+	def coincs(self, eventlists, offset_vectors, **kwargs):
+		instruments = set(eventlists)
+		thresholds = dict(((a, b), self.window) for a in instruments for b in instruments if a != b)
+		graph = snglcoinc.TimeSlideGraph(offset_vectors)
+		coincs = [(node.time_slide_id, frozenset(coinc)) for node, coinc in graph.get_coincs(eventlists, kwargs.pop("event_comparefunc", comparefunc), thresholds, **kwargs)]
+		# no coinc may be reported twice
+		self.assertEqual(len(coincs), len(set(coincs)))
+		return set(coincs)
+
+	def check(self, instruments, seed):
+		rnd = random.Random(seed)
+		eventlists = random_eventlists(instruments, 12, rnd)
+		offset_vectors = random_offset_vectors(instruments, 4, rnd)
+		expected = brute_force_coincs(eventlists, offset_vectors, self.window)
+		self.assertTrue(expected)
+		self.assertEqual(self.coincs(eventlists, offset_vectors), expected)
+		self.assertEqual(self.coincs(eventlists, offset_vectors, nproc = 3), expected)
+		self.assertEqual(self.coincs(eventlists, offset_vectors, stream = True), expected)
+		self.assertEqual(self.coincs(eventlists, offset_vectors, doubles_func = snglcoinc.get_doubles_array, event_comparefunc = batch_comparefunc), expected)
+		self.assertEqual(self.coincs(eventlists, offset_vectors, doubles_func = snglcoinc.get_doubles_array, event_comparefunc = snglcoinc.batched_comparefunc(comparefunc), nproc = 2, stream = True), expected)
+
+	def test_three_instruments(self):
+		for seed in range(5):
+			self.check(("H1", "L1", "V1"), seed)
+
+	def test_four_instruments(self):
+		for seed in range(3):
+			self.check(("G1", "H1", "L1", "V1"), seed)
+
+	def test_get_doubles_array(self):
+		rnd = random.Random(10)
+		eventlists = random_eventlists(("H1", "L1"), 200, rnd)
+		thresholds = {("H1", "L1"): self.window, ("L1", "H1"): self.window}
+		for offset in (0., 1., -0.5):
+			eventlists.offsetvector = offsetvector.offsetvector({"H1": 0., "L1": offset})
+			expected = set(frozenset((a.event_id, b.event_id)) for a, b in snglcoinc.get_doubles(eventlists, comparefunc, ("H1", "L1"), thresholds))
+			for blocksize in (1, 7, 16384):
+				pairs = list(snglcoinc.get_doubles_array(eventlists, batch_comparefunc, ("H1", "L1"), thresholds, blocksize = blocksize))
+				self.assertEqual(len(pairs), len(expected))
+				self.assertEqual(set(frozenset((a.event_id, b.event_id)) for a, b in pairs), expected)
+
+
+class test_segment_index(unittest.TestCase):
+	def test_matches_segmentlists(self):
+		rnd = random.Random(0)
+		seglists = segments.segmentlistdict()
+		for instrument in ("H1", "L1", "V1"):
+			seglists[instrument] = segments.segmentlist()
+			for i in range(20):
+				start = lsctables.LIGOTimeGPS(rnd.randint(0, 990), rnd.randrange(1000000000))
+				seglists[instrument].append(segments.segment(start, start + rnd.uniform(0., 10.)))
+			seglists[instrument].coalesce()
+		index = snglcoinc.SegmentIndex(seglists)
+		for i in range(2000):
+			t = lsctables.LIGOTimeGPS(rnd.randint(0, 1000), rnd.randrange(1000000000))
+			if i % 10 == 0:
+				# on a segment boundary
+				instrument = rnd.choice(seglists.keys())
+				t = rnd.choice(seglists[instrument])[rnd.randint(0, 1)]
+			offset_vector = offsetvector.offsetvector((instrument, lsctables.LIGOTimeGPS(rnd.choice((0., 1.5, -3.)))) for instrument in ("H1", "L1", "V1"))
+			expected = set(instrument for instrument, seglist in seglists.items() if t - offset_vector[instrument] in seglist)
+			self.assertEqual(index.instruments_on(t.ns(), offset_vector), expected)
+			self.assertEqual(set(instrument for instrument in seglists if index.contains(instrument, numpy.array([(t - offset_vector[instrument]).ns()]))[0]), expected)
+
+	def test_missing_offset(self):
+		index = snglcoinc.SegmentIndex(segments.segmentlistdict({"H1": segments.segmentlist([segments.segment(0, 10)]), "L1": segments.segmentlist()}))
+		self.assertEqual(index.instruments_on(5000000000, {"H1": 0., "L1": 0.}), set(["H1"]))
+		self.assertRaises(KeyError, index.instruments_on, 5000000000, {"H1": 0.})
+
+
+class CoincParamsDistributions(snglcoinc.CoincParamsDistributions):
+	binnings = {
+		"snr": rate.NDBins((rate.LinearBins(0., 10., 5), rate.LogarithmicBins(1., 100., 4))),
+		"dt": rate.NDBins((rate.ATanBins(-0.01, +0.01, 6),))
+	}
+
+
+class test_random_params(unittest.TestCase):
+	def test_block_matches_scalar(self):
+		"""
+		the blocks drawn with .random_params_block() must follow the
+		distribution of the samples drawn by .random_params(), and
+		assign them the same ln P
+		"""
+		distributions = CoincParamsDistributions()
+		n = 20000
+		random.seed(0)
+		scalar = list(itertools.islice(distributions.random_params(), n))
+		params, lnP = distributions.random_params_block(n, rng = 0)
+		self.assertEqual(sorted(params), sorted(distributions.binnings))
+		self.assertEqual(lnP.shape, (n,))
+		for name, binning in distributions.binnings.items():
+			self.assertEqual(len(params[name]), len(binning))
+			block_index = numpy.ravel_multi_index(binning[params[name]], binning.shape)
+			scalar_index = numpy.array([numpy.ravel_multi_index(binning[p[name]], binning.shape) for p, l in scalar])
+			# the fraction of samples in each bin agree to within
+			# a few standard deviations
+			block_counts = numpy.bincount(block_index, minlength = numpy.prod(binning.shape)) / float(n)
+			scalar_counts = numpy.bincount(scalar_index, minlength = numpy.prod(binning.shape)) / float(n)
+			sigma = numpy.sqrt(scalar_counts * (1. - scalar_counts) / n * 2.) + 1. / n
+			self.assertTrue((abs(block_counts - scalar_counts) < 5. * sigma).all())
+		# ln P depends only on the bins of the parameters
+		def bin_key(p):
+			return tuple(binning[tuple(c)] for name, binning in sorted(distributions.binnings.items()) for c in [p[name]])
+		scalar_lnP = dict((bin_key(p), l) for p, l in scalar)
+		for i in range(0, n, 97):
+			key = bin_key(dict((name, tuple(c[i] for c in coords)) for name, coords in params.items()))
+			self.assertAlmostEqual(lnP[i], scalar_lnP[key])
+
+	def test_blocks(self):
+		distributions = CoincParamsDistributions()
+		blocks = distributions.random_params_blocks(100, rng = 1)
+		(params1, lnP1), (params2, lnP2) = blocks.next(), blocks.next()
+		self.assertEqual(lnP1.shape, (100,))
+		# successive blocks are independent
+		self.assertFalse((params1["snr"][0] == params2["snr"][0]).all())
+
+
+class test_finish(unittest.TestCase):
+	def fill(self, distributions, seed):
+		rnd = numpy.random.RandomState(seed)
+		for fill in (distributions.fill_zero_lag, distributions.fill_background, distributions.fill_injection):
+			fill({"snr": (rnd.uniform(0., 10., 1000), rnd.uniform(1., 100., 1000)), "dt": (rnd.uniform(-0.1, 0.1, 1000),)})
+
+	def test_serial_matches_concurrent(self):
+		a = CoincParamsDistributions()
+		self.fill(a, 0)
+		b = a.copy()
+		a.finish()
+		b.finish(nproc = 4)
+		for pdfa, pdfb in ((a.zero_lag_pdf, b.zero_lag_pdf), (a.background_pdf, b.background_pdf), (a.injection_pdf, b.injection_pdf)):
+			self.assertEqual(sorted(pdfa), sorted(pdfb))
+			for key in pdfa:
+				self.assertTrue((pdfa[key].array == pdfb[key].array).all())
+		self.assertEqual(a.lnP_noise({"snr": (5., 10.), "dt": (0.,)}), b.lnP_noise({"snr": (5., 10.), "dt": (0.,)}))
+
+	def test_pdf_from_rates_func(self):
+		seen = []
+		def snr_pdf_from_rates(key, pdf_dict):
+			# the PDFs already computed are available
+			seen.append(sorted(pdf_dict))
+			pdf_dict[key].to_pdf()
+		distributions = CoincParamsDistributions()
+		distributions.pdf_from_rates_func = {"snr": snr_pdf_from_rates}
+		self.fill(distributions, 1)
+		order = list(distributions.background_rates)
+		distributions.finish()
+		self.assertEqual(len(seen), 3)
+		self.assertEqual(seen[1], sorted(order[:order.index("snr") + 1]))
+		# the function is run again, whatever the cache holds
+		distributions.finish(nproc = 4)
+		self.assertEqual(len(seen), 6)
+		self.assertEqual(seen[4], seen[1])
+		distributions.pdf_from_rates_func = {"snr": None}
+		distributions.finish()
+		self.assertEqual(len(seen), 6)
+		self.assertTrue((distributions.background_pdf["snr"].array == distributions.background_rates["snr"].array).all())
+
+	def test_dependent_pdf_from_rates_func(self):
+		"""
+		a function that reads another entry of the PDF dictionary
+		must see that entry's current PDF, for any nproc
+		"""
+		def snr_pdf_from_rates(key, pdf_dict):
+			pdf_dict[key].to_pdf()
+			pdf_dict[key].array *= pdf_dict["dt"].array.max()
+		distributions = CoincParamsDistributions()
+		distributions.pdf_from_rates_func = {"snr": snr_pdf_from_rates}
+		self.assertEqual(list(distributions.background_rates), ["dt", "snr"])
+		self.fill(distributions, 2)
+		for nproc in (1, 4, 1):
+			# change only the dt counts
+			distributions.background_rates["dt"].array[0] += 1000.
+			distributions.finish(nproc = nproc)
+			expected = distributions.copy()
+			expected.pdf_from_rates_func = distributions.pdf_from_rates_func
+			expected.finish()
+			for pdfa, pdfb in ((distributions.zero_lag_pdf, expected.zero_lag_pdf), (distributions.background_pdf, expected.background_pdf), (distributions.injection_pdf, expected.injection_pdf)):
+				for key in pdfb:
+					self.assertTrue((pdfa[key].array == pdfb[key].array).all())
+			self.assertEqual(distributions.lnP_noise({"snr": (5., 10.), "dt": (0.,)}), expected.lnP_noise({"snr": (5., 10.), "dt": (0.,)}))
+
+
+if __name__ == '__main__':
+	unittest.main()